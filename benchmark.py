@@ -0,0 +1,1545 @@
+"""Benchmarks del bot sin red.
+
+Uso:
+    python benchmark.py votes --voters 500 --gifs 50
+    python benchmark.py sessions --threads 8 --rounds 8
+    python benchmark.py handlers --users 1000 --gifs 200 --votes 20000
+    python benchmark.py concurrency --users 50 --presses 10 --api-latency-ms 20
+    python benchmark.py callbacks --votes 1000 --commit-ms 2 --api-latency-ms 20
+    python benchmark.py scheduler --chats 20 --per-chat 8 --retry-afters 2
+    python benchmark.py sqlite --votes 100000
+    python benchmark.py workers --workers 1,2,4 --api-latency-ms 20
+    python benchmark.py memory --voters 10000
+    python benchmark.py startup --budget-ms 1500
+    python benchmark.py dedup --gifs 200
+    python benchmark.py contests --past 3 --votes 50000
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import gc
+import json
+import logging
+import multiprocessing
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Any, Dict, List
+
+from sqlalchemy import event, text
+from telegram import Update
+from telegram.ext import ApplicationBuilder, TypeHandler
+from telegram.request import BaseRequest, RequestData
+
+from controllers import AsyncChristmasDB, ChristmasDB, VoteResult
+from metrics import TELEGRAM_ERRORS
+from models import Gif, Vote
+from rate_limiter import OutboundScheduler
+from work_queue import WorkerSupervisor, WorkQueue, consume
+from vote_buffer import VoteBuffer
+from vote_journal import VoteJournal
+
+# ------------------ Utilidades ------------------
+
+
+def temp_db(**kwargs) -> ChristmasDB:
+    """Crea una BD SQLite vacía en un directorio temporal"""
+    path = os.path.join(tempfile.mkdtemp(prefix="christmas-bench-"), "db.sqlite")
+    return ChristmasDB(f"sqlite:///{path}", **kwargs)
+
+
+def seed_gifs(db: ChristmasDB, gifs: int):
+    """Crea `gifs` autores con un GIF cada uno (telegram_id negativos)"""
+    return [db.add_gif(-i, f"autor{i}", i, f"file{i}").id for i in range(1, gifs + 1)]
+
+
+def random_votes(gif_ids, voters: int):
+    votes = [
+        (voter, f"user{voter}", gif_id)
+        for voter in range(1, voters + 1)
+        for gif_id in gif_ids
+    ]
+    random.shuffle(votes)
+    return votes
+
+
+def latency_report(name: str, latencies: List[float], elapsed: float):
+    """Throughput y percentiles de una lista de latencias en segundos"""
+    p50, p99 = (
+        (statistics.quantiles(latencies, n=100)[i] * 1000 for i in (49, 98))
+        if len(latencies) > 1
+        else (latencies[0] * 1000,) * 2
+    )
+    print(
+        f"{name:<20} {len(latencies):>7} upd  {len(latencies) / elapsed:9.1f} upd/s"
+        f"  p50 {p50:7.2f} ms  p99 {p99:7.2f} ms"
+    )
+
+
+def report(name: str, count: int, elapsed: float):
+    print(
+        f"{name:<12} {count:>8} votos  {elapsed:8.3f} s  {count / elapsed:10.1f} votos/s"
+    )
+
+
+# ------------------ Votos ------------------
+
+
+async def bench_direct(votes, gifs: int):
+    db = AsyncChristmasDB(temp_db())
+    gif_ids = seed_gifs(db.db, gifs)
+    votes = [(voter, name, gif_ids[gif % len(gif_ids)]) for voter, name, gif in votes]
+    start = time.perf_counter()
+    await asyncio.gather(*(db.vote_gif(*vote) for vote in votes))
+    elapsed = time.perf_counter() - start
+    db.close()
+    return elapsed
+
+
+async def bench_buffer(votes, gifs: int, flush_ms: int, max_batch: int):
+    db = AsyncChristmasDB(temp_db())
+    gif_ids = seed_gifs(db.db, gifs)
+    votes = [(voter, name, gif_ids[gif % len(gif_ids)]) for voter, name, gif in votes]
+    buffer = VoteBuffer(db, flush_interval=flush_ms / 1000, max_batch=max_batch)
+    buffer.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(buffer.vote_gif(*vote) for vote in votes))
+    await buffer.stop()
+    elapsed = time.perf_counter() - start
+    db.close()
+    return elapsed
+
+
+async def bench_journal(votes, gifs: int, snapshot_ms: int):
+    """VoteBuffer con diario; luego una caída antes de volcar y la recuperación.
+
+    Devuelve el tiempo de los votos con diario, el de la recuperación y
+    cuántos votos se recuperaron.
+    """
+    db = AsyncChristmasDB(temp_db())
+    gif_ids = seed_gifs(db.db, gifs)
+    votes = [(voter, name, gif_ids[gif % len(gif_ids)]) for voter, name, gif in votes]
+    directory = tempfile.mkdtemp(prefix="christmas-journal-")
+    buffer = VoteBuffer(
+        db, flush_interval=snapshot_ms / 1000, journal=VoteJournal(directory)
+    )
+    buffer.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(buffer.vote_gif(*vote) for vote in votes))
+    await buffer.stop()
+    journaled = time.perf_counter() - start
+
+    # Caída: los votos están en el diario pero nunca se volcaron a la BD
+    db = AsyncChristmasDB(temp_db())
+    seed_gifs(db.db, gifs)
+    buffer = VoteBuffer(
+        db,
+        flush_interval=3600,
+        max_batch=len(votes) + 1,
+        journal=VoteJournal(directory),
+    )
+    buffer.start()
+    await asyncio.gather(*(buffer.vote_gif(*vote) for vote in votes))
+    buffer._task.cancel()
+    await buffer.journal.close()
+
+    db = AsyncChristmasDB(db.db)
+    start = time.perf_counter()
+    recovered = await VoteBuffer(db, journal=VoteJournal(directory)).recover()
+    elapsed = time.perf_counter() - start
+    db.close()
+    return journaled, elapsed, recovered
+
+
+async def check_pending_reads(gifs: int) -> List[str]:
+    """Las lecturas a través de VoteBuffer ven los votos aún sin volcar"""
+    db = AsyncChristmasDB(temp_db())
+    gif_ids = seed_gifs(db.db, gifs)
+    buffer = VoteBuffer(db, flush_interval=3600)
+    await db.add_user(1, "user1")
+
+    async def reads():
+        page = await buffer.get_votable_gifs_page(1, limit=gifs)
+        leaderboard = await buffer.get_leaderboard(top=1)
+        return (
+            await buffer.count_votable_gifs(1),
+            gif_ids[0] in {gif_id for gif_id, _ in page},
+            (leaderboard[0]["gif_id"], leaderboard[0]["votes"]),
+            (await buffer.get_user_info(1))["votes_given"],
+            (await buffer.get_user_info(-1))["votes_received"],
+        )
+
+    await buffer.vote_gif(1, "user1", gif_ids[0])
+    expected = (gifs - 1, False, (gif_ids[0], 1), 1, 1)
+    errors = []
+    pending = await reads()
+    if pending != expected:
+        errors.append(f"antes de volcar {pending}, se esperaba {expected}")
+    await buffer.flush()
+    flushed = await reads()
+    if flushed != expected:
+        errors.append(f"después de volcar {flushed}, se esperaba {expected}")
+    db.close()
+    return errors
+
+
+def check_fresh_db() -> List[str]:
+    """Escrituras como primera operación sobre una BD recién creada.
+
+    El concurso activo se crea al usarlo por primera vez: no puede esperar al
+    bloqueo de escritura de la propia operación.
+    """
+    errors = []
+    calls = {
+        "vote_gif": lambda db: db.vote_gif(1, "user1", 1),
+        "add_votes": lambda db: db.add_votes([(1, "user1", 1)]),
+        "add_user": lambda db: db.add_user(1, "user1"),
+    }
+    for name, call in calls.items():
+        db = temp_db()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                call(db)
+        except Exception as e:
+            errors.append(f"{name} en una BD nueva: {str(e).splitlines()[0]}")
+        db.engine.dispose()
+    return errors
+
+
+def run_votes(args):
+    votes = random_votes(range(args.gifs), args.voters)
+    with contextlib.redirect_stdout(io.StringIO()):
+        direct = asyncio.run(bench_direct(votes, args.gifs))
+        buffered = asyncio.run(
+            bench_buffer(votes, args.gifs, args.flush_ms, args.max_batch)
+        )
+        journaled, recovery, recovered = asyncio.run(
+            bench_journal(votes, args.gifs, args.snapshot_ms)
+        )
+    report("por voto", len(votes), direct)
+    report("por lotes", len(votes), buffered)
+    report("con diario", len(votes), journaled)
+    report("recuperación", recovered, recovery)
+    if recovered != len(votes):
+        print(f"❌ Recuperados {recovered} de {len(votes)} votos")
+        sys.exit(1)
+    errors = asyncio.run(check_pending_reads(args.gifs))
+    for error in errors:
+        print(f"❌ Lecturas con votos pendientes: {error}")
+    fresh = check_fresh_db()
+    for error in fresh:
+        print(f"❌ {error}")
+    if errors or fresh:
+        sys.exit(1)
+
+
+# ------------------ Sesiones ------------------
+
+
+def session_calls(voters, gif_ids, votes_per_voter: int):
+    """add_user y vote_gif de varios votantes mezclados; cada voto va dos veces"""
+    calls = []
+    for voter in voters:
+        calls.append((voter, f"user{voter}", None))
+        for gif_id in random.sample(gif_ids, votes_per_voter):
+            calls += [(voter, f"user{voter}", gif_id)] * 2
+    random.shuffle(calls)
+    return calls
+
+
+async def bench_sessions(args):
+    """Rondas de llamadas mezcladas desde varios hilos sobre AsyncChristmasDB.
+
+    Cada ronda usa votantes nuevos. Devuelve los errores encontrados, la
+    memoria tras cada ronda y las llamadas por segundo.
+    """
+    db = AsyncChristmasDB(
+        temp_db(max_cached_users=args.cached_users), max_workers=args.threads
+    )
+    gif_ids = seed_gifs(db.db, args.gifs)
+    errors = []
+    memory = []
+    calls = 0
+    pairs = 0
+    elapsed = 0.0
+
+    async def call(voter: int, name: str, gif_id: int | None, results: Counter):
+        if gif_id is None:
+            user = await db.add_user(voter, name)
+            if user.username != name:
+                errors.append(f"add_user({voter}) devuelve a {user.username}")
+        else:
+            results[voter, gif_id, await db.vote_gif(voter, name, gif_id)] += 1
+
+    tracemalloc.start()
+    for n in range(args.rounds):
+        first = n * args.voters + 1
+        batch = session_calls(
+            range(first, first + args.voters), gif_ids, args.votes_per_voter
+        )
+        results: Counter = Counter()
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            await asyncio.gather(*(call(*c, results) for c in batch))
+        elapsed += time.perf_counter() - start
+        calls += len(batch)
+
+        # Cada voto repetido: uno se registra y el otro es un duplicado
+        voted = {(voter, gif_id) for voter, gif_id, _ in results}
+        for voter, gif_id in voted:
+            ok = results[voter, gif_id, VoteResult.OK]
+            duplicate = results[voter, gif_id, VoteResult.DUPLICATE]
+            if (ok, duplicate) != (1, 1):
+                errors.append(
+                    f"voto {voter}->{gif_id}: {ok} OK, {duplicate} duplicados"
+                )
+        pairs += len(voted)
+        del batch, results, voted
+        gc.collect()
+        memory.append(tracemalloc.get_traced_memory()[0])
+    tracemalloc.stop()
+
+    with db.db.engine.connect() as connection:
+        votes, counted, users, wrong = connection.execute(
+            text(
+                "SELECT (SELECT COUNT(*) FROM votes),"
+                " (SELECT SUM(vote_count) FROM gifs),"
+                " (SELECT COUNT(*) FROM users),"
+                " (SELECT COUNT(*) FROM gifs WHERE vote_count !="
+                "  (SELECT COUNT(*) FROM votes WHERE votes.gif_id = gifs.id))"
+            )
+        ).one()
+    expected_users = args.gifs + args.rounds * args.voters
+    if (votes, counted, users, wrong) != (pairs, pairs, expected_users, 0):
+        errors.append(
+            f"{votes} votos, {counted} en vote_count y {users} usuarios"
+            f" ({wrong} GIFs descuadrados); se esperaban {pairs} votos"
+            f" y {expected_users} usuarios"
+        )
+    db.close()
+    return errors, memory, calls / elapsed
+
+
+def run_sessions(args):
+    errors, memory, rate = asyncio.run(bench_sessions(args))
+    print(
+        f"{args.rounds} rondas de {args.voters} votantes en {args.threads} hilos:"
+        f" {rate:.0f} llamadas/s"
+    )
+    for n, used in enumerate(memory, 1):
+        print(f"ronda {n:>3}  {used / 1024:10.0f} KiB")
+    # Las primeras rondas llenan la caché de usuarios y la de sentencias
+    warm = memory[min(args.warmup, len(memory)) - 1]
+    growth = (memory[-1] - warm) / 1024
+    print(f"crecimiento tras la ronda {args.warmup}: {growth:.0f} KiB")
+    for error in errors[:10]:
+        print(f"❌ {error}")
+    if errors:
+        sys.exit(1)
+    if growth > args.max_growth_kib:
+        print(f"❌ La memoria crece más de {args.max_growth_kib} KiB")
+        sys.exit(1)
+
+
+# ------------------ Handlers ------------------
+
+
+class FakeBotAPI(BaseRequest):
+    """Bot API local: responde al momento a cualquier llamada.
+
+    `failures` asigna a números de llamada (desde 1) un código de error: 429
+    responde con RetryAfter de `retry_after` segundos y 400 con BadRequest.
+    Con `record`, `log` guarda (instante, endpoint, chat_id, código) de cada
+    llamada. Como Telegram, rechaza con 400 un segundo answerCallbackQuery
+    del mismo callback; `answers` cuenta los intentos de cada uno.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0,
+        failures: Dict[int, int] | None = None,
+        retry_after: int = 1,
+        record: bool = False,
+    ):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_ids = itertools.count(1)
+        self.failures = failures or {}
+        self.retry_after = retry_after
+        self.log: List[tuple] | None = [] if record else None
+        self.answers: Counter = Counter()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def do_request(
+        self, url: str, method: str, request_data: RequestData | None = None, **kwargs
+    ):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        params = request_data.parameters if request_data else {}
+        status = self.failures.get(self.calls.total(), 200)
+        if endpoint == "answerCallbackQuery":
+            query_id = params.get("callback_query_id")
+            self.answers[query_id] += 1
+            if self.answers[query_id] > 1:
+                status = 400
+        if self.log is not None:
+            self.log.append((time.monotonic(), endpoint, params.get("chat_id"), status))
+        if status == 429:
+            error = {
+                "ok": False,
+                "error_code": 429,
+                "description": "Too Many Requests",
+                "parameters": {"retry_after": self.retry_after},
+            }
+            return 429, json.dumps(error).encode()
+        if status != 200:
+            error = {"ok": False, "error_code": status, "description": "Bad Request"}
+            return status, json.dumps(error).encode()
+
+        result: Any
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bot"}
+        elif endpoint.startswith(("answer", "set", "delete")):
+            result = True
+        else:
+            result = {
+                "message_id": next(self._message_ids),
+                "date": 0,
+                "chat": {"id": params.get("chat_id", 1), "type": "private"},
+            }
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+_update_ids = itertools.count(1)
+
+
+def _user(telegram_id: int) -> Dict[str, Any]:
+    return {
+        "id": telegram_id,
+        "is_bot": False,
+        "first_name": "Bench",
+        "username": f"user{telegram_id}",
+    }
+
+
+def message_update(telegram_id: int, text: str = "", **extra) -> Dict[str, Any]:
+    """Update de un mensaje privado; los textos con / son comandos"""
+    message = {
+        "message_id": next(_update_ids),
+        "date": 0,
+        "chat": {"id": telegram_id, "type": "private"},
+        "from": _user(telegram_id),
+        **extra,
+    }
+    if text:
+        message["text"] = text
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [
+                {"type": "bot_command", "offset": 0, "length": len(command)}
+            ]
+    return {"update_id": next(_update_ids), "message": message}
+
+
+def _animation(file_id: str) -> Dict[str, Any]:
+    return {
+        "file_id": file_id,
+        "file_unique_id": file_id,
+        "width": 1,
+        "height": 1,
+        "duration": 1,
+    }
+
+
+def gif_update(telegram_id: int, file_id: str) -> Dict[str, Any]:
+    return message_update(telegram_id, animation=_animation(file_id))
+
+
+def callback_update(telegram_id: int, data: str) -> Dict[str, Any]:
+    """Update de una pulsación de botón sobre un mensaje del carrusel"""
+    message = message_update(telegram_id, animation=_animation("carrusel"))["message"]
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "chat_instance": "bench",
+            "data": data,
+            "from": _user(telegram_id),
+            "message": message,
+        },
+    }
+
+
+def seed_contest(
+    db: ChristmasDB, users: int, gifs: int, votes: int, offset: int = 0
+) -> List[int]:
+    """Crea `users` usuarios (1..users), los `gifs` primeros con GIF, y
+    `votes` votos aleatorios. Devuelve los ids de los GIFs.
+
+    Los mensajes y ficheros de los GIFs se numeran desde `offset` + 1.
+    """
+    gif_ids = [
+        db.add_gif(i, f"user{i}", offset + i, f"file{offset + i}").id
+        for i in range(1, gifs + 1)
+    ]
+    for i in range(gifs + 1, users + 1):
+        db.add_user(i, f"user{i}")
+    pairs = set()
+    while len(pairs) < min(votes, users * gifs - gifs):
+        voter, gif = random.randint(1, users), random.randint(1, gifs)
+        if voter != gif:
+            pairs.add((voter, gif))
+    pairs = list(pairs)
+    for start in range(0, len(pairs), 5000):
+        db.add_votes(
+            [
+                (voter, f"user{voter}", gif_ids[gif - 1])
+                for voter, gif in pairs[start : start + 5000]
+            ]
+        )
+    return gif_ids
+
+
+async def drive(app, updates: List[Dict[str, Any]], concurrency: int):
+    """Procesa las updates con `concurrency` a la vez y mide cada una"""
+    latencies: List[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(data):
+        async with semaphore:
+            start = time.perf_counter()
+            await app.process_update(Update.de_json(data, app.bot))
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(process(data) for data in updates))
+    return latencies, time.perf_counter() - start
+
+
+async def bench_handlers(args):
+    # main crea la BD al importarse: apuntarla antes a una temporal
+    path = os.path.join(tempfile.mkdtemp(prefix="christmas-bench-"), "db.sqlite")
+    os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+    import main
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        gif_ids = seed_contest(main.DB.db, args.users, args.gifs, args.votes)
+    fake_api = FakeBotAPI(latency=args.api_latency_ms / 1000)
+    app = main.build_application(
+        ApplicationBuilder()
+        .token("123456:BENCH")
+        .request(fake_api)
+        .get_updates_request(FakeBotAPI())
+    )
+
+    voters = random.sample(range(1, args.users + 1), min(args.users, args.updates))
+    new_users = range(args.users + 1, args.users + 1 + len(voters))
+    scenarios = {
+        "show_memes_to_vote": [message_update(v, "/votaciones") for v in voters],
+        "vote_callback": [
+            callback_update(v, f"vote:{random.choice(gif_ids)}") for v in voters
+        ],
+        "navigation": [
+            callback_update(v, random.choice(("next", "prev"))) for v in voters
+        ],
+        "show_leaderboard": [message_update(v, "/ranking") for v in voters],
+        "my_stats": [message_update(v, "/mis_stats") for v in voters],
+        # Usuarios nuevos: primero abren la conversación y luego envían el GIF
+        "send_meme_start": [message_update(v, "/mandar_meme") for v in new_users],
+        "receive_meme": [gif_update(v, f"new{v}") for v in new_users],
+    }
+
+    failed = False
+    async with app:
+        for name, updates in scenarios.items():
+            fake_api.calls.clear()
+            fake_api.answers.clear()
+            # Silenciar los print() de los handlers
+            with contextlib.redirect_stdout(io.StringIO()):
+                latencies, elapsed = await drive(app, updates, args.concurrency)
+            latency_report(name, latencies, elapsed)
+            calls = sum(fake_api.calls.values())
+            print(f"{'':<20} {calls / len(updates):7.2f} llamadas a la API por update")
+            # Cada botón se responde una vez: ni se queda cargando ni da 400
+            queries = [
+                u["callback_query"]["id"] for u in updates if "callback_query" in u
+            ]
+            if any(fake_api.answers[query] != 1 for query in queries):
+                print(f"❌ {name} no responde exactamente una vez a cada botón")
+                failed = True
+    main.DB.close()
+    if failed:
+        sys.exit(1)
+
+
+def run_handlers(args):
+    asyncio.run(bench_handlers(args))
+
+
+# ------------------ Concurrencia ------------------
+
+
+def interleaved_presses(users: int, presses: int, gif_ids: List[int]):
+    """/votaciones y luego `presses` botones por usuario, mezclando usuarios
+    pero manteniendo el orden de cada uno"""
+    sequences = [
+        [message_update(user, "/votaciones")]
+        + [
+            callback_update(
+                user, random.choice(("next", "prev", f"vote:{random.choice(gif_ids)}"))
+            )
+            for _ in range(presses)
+        ]
+        for user in range(1, users + 1)
+    ]
+    updates = []
+    while sequences:
+        sequence = random.choice(sequences)
+        updates.append(sequence.pop(0))
+        if not sequence:
+            sequences.remove(sequence)
+    return updates
+
+
+async def run_interleaved(main, concurrent: int, updates, api_latency: float):
+    """Pasa las updates por la cola de la aplicación y comprueba el orden.
+
+    Devuelve el tiempo total, cuántas updates empezaron antes de que
+    terminara la anterior del mismo usuario o fuera de orden, y cuándo
+    terminó la última de cada usuario.
+    """
+    main.CONCURRENT_UPDATES = concurrent
+    app = main.build_application(
+        ApplicationBuilder()
+        .token("123456:BENCH")
+        .request(FakeBotAPI(latency=api_latency))
+        .get_updates_request(FakeBotAPI())
+    )
+    # (update_id, inicio, fin) de cada update, por usuario
+    spans: Dict[int, List[List[float]]] = {}
+    done = asyncio.Event()
+    finished = 0
+
+    async def begin(update, context):
+        spans.setdefault(update.effective_user.id, []).append(
+            [update.update_id, time.perf_counter(), 0]
+        )
+
+    async def end(update, context):
+        nonlocal finished
+        for span in spans[update.effective_user.id]:
+            if span[0] == update.update_id:
+                span[2] = time.perf_counter()
+        finished += 1
+        if finished == len(updates):
+            done.set()
+
+    # Antes y después de todos los grupos de handlers de main
+    app.add_handler(TypeHandler(Update, begin), group=-1)
+    app.add_handler(TypeHandler(Update, end), group=100)
+
+    async with app:
+        await app.start()
+        start = time.perf_counter()
+        for data in updates:
+            await app.update_queue.put(Update.de_json(data, app.bot))
+        await done.wait()
+        elapsed = time.perf_counter() - start
+        await app.stop()
+
+    violations = 0
+    for user_spans in spans.values():
+        for previous, current in zip(user_spans, user_spans[1:]):
+            if current[0] < previous[0] or current[1] < previous[2]:
+                violations += 1
+    last_end = {
+        user: max(span[2] for span in user_spans) - start
+        for user, user_spans in spans.items()
+    }
+    return elapsed, violations, last_end
+
+
+def burst_presses(users: int, presses: int, gif_ids: List[int]):
+    """Un usuario que pulsa `presses` botones seguidos y, detrás, un
+    /votaciones de cada uno de los otros `users`"""
+    burst = users + 1
+    return (
+        [message_update(burst, "/votaciones")]
+        + [
+            callback_update(burst, f"vote:{random.choice(gif_ids)}")
+            for _ in range(presses)
+        ]
+        + [message_update(user, "/votaciones") for user in range(1, users + 1)]
+    )
+
+
+async def bench_concurrency(args):
+    logging.disable(logging.INFO)
+    path = os.path.join(tempfile.mkdtemp(prefix="christmas-bench-"), "db.sqlite")
+    os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+    import main
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        gif_ids = seed_contest(main.DB.db, args.users, args.gifs, args.votes)
+    updates = interleaved_presses(args.users, args.presses, gif_ids)
+
+    failed = False
+    for concurrent in (1, args.concurrent):
+        with contextlib.redirect_stdout(io.StringIO()):
+            elapsed, violations, _ = await run_interleaved(
+                main, concurrent, updates, args.api_latency_ms / 1000
+            )
+        print(
+            f"{concurrent:>4} a la vez {len(updates):>7} upd  {elapsed:8.3f} s"
+            f"  {len(updates) / elapsed:9.1f} upd/s  {violations} fuera de orden"
+        )
+        failed = failed or violations > 0
+
+    # Un usuario con más pulsaciones pendientes que huecos: las que esperan
+    # su turno no deben dejar sin sitio a los demás usuarios
+    slots = args.burst_slots
+    burst = burst_presses(slots * 4, slots * 8, gif_ids)
+    with contextlib.redirect_stdout(io.StringIO()):
+        elapsed, violations, last_end = await run_interleaved(
+            main, slots, burst, args.api_latency_ms / 1000
+        )
+    burst_end = last_end.pop(slots * 4 + 1)
+    others_end = max(last_end.values())
+    print(
+        f"{slots:>4} a la vez  ráfaga de {slots * 8} pulsaciones  {burst_end:8.3f} s"
+        f"  resto de usuarios {others_end:8.3f} s  {violations} fuera de orden"
+    )
+    failed = failed or violations > 0
+    if others_end > burst_end / 2:
+        print("❌ La ráfaga de un usuario retrasa a todos los demás")
+        failed = True
+    main.DB.close()
+    if failed:
+        sys.exit(1)
+
+
+def run_concurrency(args):
+    asyncio.run(bench_concurrency(args))
+
+
+async def bench_callbacks(args):
+    """Votos de usuarios distintos, primero de uno en uno y luego a la vez.
+
+    Cada commit tarda además `commit_ms` en el hilo que lo hace, como un
+    fsync lento de SQLite. Devuelve, para cada modo, el tiempo por voto y
+    cuántas sentencias SQL se ejecutaron en el hilo del event loop.
+    """
+    logging.disable(logging.INFO)
+    path = os.path.join(tempfile.mkdtemp(prefix="christmas-bench-"), "db.sqlite")
+    os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+    import main
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        gif_ids = seed_contest(main.DB.db, args.gifs + args.votes, args.gifs, 0)
+    loop_thread = threading.get_ident()
+    on_loop = 0
+
+    def before_execute(*_):
+        nonlocal on_loop
+        if threading.get_ident() == loop_thread:
+            on_loop += 1
+
+    engine = main.DB.db.engine
+    event.listen(engine, "before_cursor_execute", before_execute)
+    event.listen(engine, "commit", lambda _: time.sleep(args.commit_ms / 1000))
+    updates = [
+        callback_update(voter, f"vote:{random.choice(gif_ids)}")
+        for voter in range(args.gifs + 1, args.gifs + 1 + args.votes)
+    ]
+    serial = min(args.serial, len(updates) // 2)
+
+    results = {}
+    for concurrent, batch in (
+        (1, updates[:serial]),
+        (args.concurrent, updates[serial:]),
+    ):
+        on_loop = 0
+        with contextlib.redirect_stdout(io.StringIO()):
+            elapsed, _, _ = await run_interleaved(
+                main, concurrent, batch, args.api_latency_ms / 1000
+            )
+        results[concurrent] = (elapsed / len(batch), on_loop)
+    main.DB.close()
+    return results
+
+
+def run_callbacks(args):
+    results = asyncio.run(bench_callbacks(args))
+    for concurrent, (per_vote, on_loop) in results.items():
+        print(
+            f"{concurrent:>4} a la vez  {per_vote * 1000:8.2f} ms/voto"
+            f"  {1 / per_vote:9.1f} votos/s  {on_loop} consultas en el event loop"
+        )
+    (serial, _), (concurrent, on_loop) = results.values()
+    speedup = serial / concurrent
+    print(f"{speedup:.1f}x más rápido a la vez")
+    failed = False
+    if speedup < args.min_speedup:
+        print(f"❌ Los votos a la vez no llegan a {args.min_speedup}x: se serializan")
+        failed = True
+    if any(on_loop for _, on_loop in results.values()):
+        print("❌ Hay consultas a la BD que bloquean el event loop")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+# ------------------ Planificador ------------------
+
+
+def bucket_excess(times: List[float], rate: float, capacity: float) -> float:
+    """Máximo de llamadas por encima de un cubo de tokens en cualquier ventana"""
+    times = sorted(times)
+    return max(
+        (
+            (j - i + 1) - (capacity + rate * (times[j] - times[i]))
+            for i in range(len(times))
+            for j in range(i, len(times))
+        ),
+        default=0,
+    )
+
+
+async def bench_scheduler(args):
+    """Mensajes a muchos chats a través de OutboundScheduler con errores.
+
+    Devuelve el registro de la API falsa, los resultados de cada envío, el
+    tiempo total y las llamadas con error inyectadas por código.
+    """
+    messages = [chat for chat in range(1, args.chats + 1) for _ in range(args.per_chat)]
+    random.shuffle(messages)
+    # La llamada 1 es getMe; los errores caen entre los envíos
+    calls = random.sample(range(2, len(messages) + 2), args.retry_afters + 1)
+    failures = dict.fromkeys(calls[1:], 429)
+    failures[calls[0]] = 400
+    api = FakeBotAPI(failures=failures, retry_after=args.retry_after, record=True)
+    scheduler = OutboundScheduler(
+        global_rate=args.global_rate, private_rate=args.private_rate, burst=args.burst
+    )
+    app = (
+        ApplicationBuilder()
+        .token("123456:BENCH")
+        .request(api)
+        .get_updates_request(FakeBotAPI())
+        .rate_limiter(scheduler)
+        .build()
+    )
+    errors_before = TELEGRAM_ERRORS.values.get(("sendMessage",), 0)
+    async with app:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = await asyncio.gather(
+                *(app.bot.send_message(chat, "🎄") for chat in messages),
+                return_exceptions=True,
+            )
+        elapsed = time.perf_counter() - start
+    errors = TELEGRAM_ERRORS.values.get(("sendMessage",), 0) - errors_before
+    return api.log, results, elapsed, scheduler.stats, errors
+
+
+def run_scheduler(args):
+    log, results, elapsed, stats, errors = asyncio.run(bench_scheduler(args))
+    sent = [entry for entry in log if entry[1] == "sendMessage"]
+    ok = [entry for entry in sent if entry[3] == 200]
+    print(
+        f"{len(results)} mensajes a {args.chats} chats en {elapsed:.2f} s"
+        f" ({len(ok) / elapsed:.1f}/s, límite {args.global_rate}/s)"
+        f"  {stats['retries']} reintentos  {stats['throttled']} esperas"
+    )
+
+    failed = []
+    # Un margen de una llamada por los despertares casi simultáneos
+    excess = bucket_excess([t for t, *_ in ok], args.global_rate, args.global_rate)
+    if excess > 1:
+        failed.append(f"{excess:.1f} llamadas por encima del límite global")
+    chats: Dict[Any, List[float]] = {}
+    for t, _, chat_id, _ in ok:
+        chats.setdefault(chat_id, []).append(t)
+    excess = max(
+        bucket_excess(times, args.private_rate, args.burst) for times in chats.values()
+    )
+    if excess > 1:
+        failed.append(f"{excess:.1f} llamadas por encima del límite por chat")
+    # Tras un RetryAfter no sale nada hasta que pasa el plazo, salvo las
+    # llamadas que ya estaban en vuelo (10 ms de margen)
+    for t, _, _, status in sent:
+        if status != 429:
+            continue
+        early = [u for u, *_ in ok if t + 0.01 < u < t + args.retry_after - 0.01]
+        if early:
+            failed.append(f"{len(early)} llamadas durante la pausa de un RetryAfter")
+    raised = [r for r in results if isinstance(r, Exception)]
+    if len(ok) != len(results) - 1 or len(raised) != 1:
+        failed.append(f"{len(ok)} entregados y {len(raised)} errores")
+    if errors != args.retry_afters + 1:
+        failed.append(f"{errors} errores en {TELEGRAM_ERRORS.name}")
+    for error in failed:
+        print(f"❌ {error}")
+    if failed:
+        sys.exit(1)
+
+
+# ------------------ Memoria ------------------
+
+
+def deep_size(obj, seen=None) -> int:
+    """sys.getsizeof recursivo para dicts, listas y tuplas"""
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_size(item, seen) for item in obj)
+    return size
+
+
+def orm_carousel_size(db: ChristmasDB, voters: List[int]) -> float:
+    """Bytes por votante de la lista de objetos Gif que guardaba el carrusel
+    original en user_data["votable_gifs"]"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    carousels = {}
+    for telegram_id in voters:
+        with db.Session() as session:
+            carousels[telegram_id] = (
+                session.query(Gif).filter(*db._votable_filter(telegram_id)).all()
+            )
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return size / len(voters)
+
+
+async def bench_memory(args):
+    path = os.path.join(tempfile.mkdtemp(prefix="christmas-bench-"), "db.sqlite")
+    os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+    import main
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        seed_contest(main.DB.db, args.voters + args.gifs, args.gifs, 0)
+    app = main.build_application(
+        ApplicationBuilder()
+        .token("123456:BENCH")
+        .request(FakeBotAPI())
+        .get_updates_request(FakeBotAPI())
+    )
+    voters = range(args.gifs + 1, args.gifs + 1 + args.voters)
+
+    async with app:
+        with contextlib.redirect_stdout(io.StringIO()):
+            # Todos abren el carrusel y avanzan un GIF
+            await drive(app, [message_update(v, "/votaciones") for v in voters], 64)
+            await drive(app, [callback_update(v, "next") for v in voters], 64)
+        await app.update_persistence()
+        stored = await main.DB.get_states("user_data")
+    main.DB.close()
+
+    # app.user_data es un mappingproxy de solo lectura
+    in_memory = deep_size(dict(app.user_data)) / args.voters
+    persisted = sum(len(data) for data in stored.values()) / args.voters
+    sample = random.sample(voters, min(args.sample, args.voters))
+    orm = orm_carousel_size(main.DB.db, sample)
+    print(f"{args.voters} votantes con el carrusel abierto ({args.gifs} GIFs)")
+    print(f"{'cursor en user_data':<28} {in_memory:10.0f} B/votante")
+    print(f"{'cursor en bot_state (JSON)':<28} {persisted:10.0f} B/votante")
+    print(f"{'lista de objetos Gif (ORM)':<28} {orm:10.0f} B/votante")
+    print(
+        f"{'total en memoria':<28} {in_memory * args.voters / 2**20:8.1f} MiB"
+        f" frente a {orm * args.voters / 2**20:.1f} MiB"
+    )
+
+
+def run_memory(args):
+    asyncio.run(bench_memory(args))
+
+
+# ------------------ Workers ------------------
+
+
+def bench_worker(shard: int, api_latency: float, results=None):
+    """Proceso worker: vacía su shard de la cola contra la API falsa"""
+    import main
+
+    logging.disable(logging.INFO)
+    app = main.build_application(
+        ApplicationBuilder()
+        .token("123456:BENCH")
+        .request(FakeBotAPI(latency=api_latency))
+        .get_updates_request(FakeBotAPI())
+    )
+    queue = WorkQueue(main.QUEUE_URL, main.WORKERS)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        asyncio.run(consume(app, queue, shard, drain=True))
+    if results is not None:
+        results.put(time.perf_counter() - start)
+
+
+def crashing_worker(shard: int):
+    """Worker que muere la primera vez que arranca y luego vacía su shard"""
+    marker = os.path.join(os.environ["BENCH_DIR"], f"crashed-{shard}")
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        os._exit(1)
+    bench_worker(shard, 0)
+
+
+def fill_queue(queue: WorkQueue, users: int, gif_ids: List[int], count: int):
+    for _ in range(count):
+        voter = random.randint(1, users)
+        queue.put(
+            random.choice(
+                (
+                    message_update(voter, "/votaciones"),
+                    callback_update(voter, f"vote:{random.choice(gif_ids)}"),
+                    callback_update(voter, "next"),
+                )
+            )
+        )
+
+
+def run_workers(args):
+    directory = tempfile.mkdtemp(prefix="christmas-bench-")
+    # Las variables de entorno las heredan los workers al importar main
+    os.environ["DATABASE_URL"] = f"sqlite:///{directory}/db.sqlite"
+    os.environ["QUEUE_URL"] = f"sqlite:///{directory}/queue.sqlite"
+    os.environ["DB_PROFILE"] = "production"
+    with contextlib.redirect_stdout(io.StringIO()):
+        db = ChristmasDB(os.environ["DATABASE_URL"], profile="production")
+        gif_ids = seed_contest(db, args.users, args.gifs, args.votes)
+        db.engine.dispose()
+
+    context = multiprocessing.get_context("spawn")
+    for workers in [int(n) for n in args.workers.split(",")]:
+        os.environ["WORKERS"] = str(workers)
+        queue = WorkQueue(os.environ["QUEUE_URL"], workers)
+        fill_queue(queue, args.users, gif_ids, args.updates)
+
+        results = context.Queue()
+        processes = [
+            context.Process(
+                target=bench_worker, args=(shard, args.api_latency_ms / 1000, results)
+            )
+            for shard in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        # Tiempo del worker más lento, sin contar el arranque del proceso
+        elapsed = max(results.get() for _ in processes)
+        for process in processes:
+            process.join()
+        print(
+            f"{workers:>2} workers {args.updates:>8} upd  {elapsed:8.3f} s"
+            f"  {args.updates / elapsed:10.1f} upd/s"
+        )
+
+    # Cada worker muere al arrancar: WorkerSupervisor debe arrancarlo de nuevo
+    # y que la cola se vacíe igualmente
+    os.environ["BENCH_DIR"] = directory
+    queue = WorkQueue(os.environ["QUEUE_URL"], workers)
+    fill_queue(queue, args.users, gif_ids, args.updates)
+    supervisor = WorkerSupervisor(crashing_worker, workers, check_interval=0.2)
+    start = time.perf_counter()
+    supervisor.start()
+    deadline = time.monotonic() + 120
+    while queue.depth() and time.monotonic() < deadline:
+        time.sleep(0.2)
+    elapsed = time.perf_counter() - start
+    supervisor.stop()
+    print(
+        f"{workers:>2} workers que caen al arrancar: {supervisor.restarts} reinicios,"
+        f" {queue.depth()} updates pendientes tras {elapsed:.1f} s"
+    )
+    if queue.depth() or supervisor.restarts < workers:
+        print("❌ Los workers caídos no han vaciado la cola")
+        sys.exit(1)
+
+
+# ------------------ Arranque ------------------
+
+# Proceso nuevo por ronda: el tiempo de `import main` solo es real en frío
+STARTUP_CHILD = """
+import time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+import benchmark
+benchmark.measure_startup(start, imported, {latency})
+"""
+
+
+def measure_startup(start: float, imported: float, api_latency: float):
+    """Arranque completo de main.py hasta procesar la primera update.
+
+    Imprime en JSON los milisegundos desde `start` hasta cada fase.
+    """
+    import main
+
+    async def boot():
+        main.DB.preload()
+        app = main.build_application(
+            ApplicationBuilder()
+            .token("123456:BENCH")
+            .request(FakeBotAPI(latency=api_latency))
+            .get_updates_request(FakeBotAPI())
+        )
+        # Como webserver.serve: el webhook a la vez que la persistencia
+        await app.bot.initialize()
+        webhook = asyncio.create_task(app.bot.set_webhook(url="https://bench.invalid/"))
+        async with app:
+            await app.post_init(app)
+            await webhook
+            ready = time.perf_counter()
+            await app.process_update(
+                Update.de_json(message_update(1, "/start"), app.bot)
+            )
+            first = time.perf_counter()
+            await app.post_shutdown(app)
+        return ready, first
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        ready, first = asyncio.run(boot())
+    phases = {"import": imported, "webhook": ready, "first_update": first}
+    print(json.dumps({k: (t - start) * 1000 for k, t in phases.items()}))
+
+
+def run_startup(args):
+    timings: Dict[str, List[float]] = {}
+    for _ in range(args.rounds):
+        directory = tempfile.mkdtemp(prefix="christmas-bench-")
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{directory}/db.sqlite")
+        child = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                STARTUP_CHILD.format(latency=args.api_latency_ms / 1000),
+            ],
+            env=env,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        result = json.loads(child.stdout.splitlines()[-1])
+        for phase, ms in result.items():
+            timings.setdefault(phase, []).append(ms)
+
+    for phase, values in timings.items():
+        print(f"{phase:<14} mediana {statistics.median(values):8.1f} ms")
+    first_update = statistics.median(timings["first_update"])
+    if first_update > args.budget_ms:
+        print(f"❌ Primera update en {first_update:.0f} ms > {args.budget_ms} ms")
+        sys.exit(1)
+    print(f"✅ Primera update en {first_update:.0f} ms <= {args.budget_ms} ms")
+
+
+# ------------------ GIFs repetidos ------------------
+
+
+def fixture_gifs(count: int, frames: int = 4) -> List[bytes]:
+    """GIFs distintos: manchas suaves al azar que se mueven un poco"""
+    from PIL import Image
+
+    gifs = []
+    for _ in range(count):
+        base = Image.new("L", (6, 6))
+        base.putdata([random.randrange(256) for _ in range(36)])
+        sequence = [
+            base.rotate(i * 3).resize((320, 240), Image.Resampling.BILINEAR)
+            for i in range(frames)
+        ]
+        out = io.BytesIO()
+        sequence[0].save(out, "GIF", save_all=True, append_images=sequence[1:])
+        gifs.append(out.getvalue())
+    return gifs
+
+
+def fixture_variant(data: bytes) -> bytes:
+    """El mismo GIF como lo reenviaría alguien: reescalado, con otra paleta
+    o convertido en la miniatura JPEG de Telegram"""
+    from PIL import Image, ImageEnhance
+
+    with Image.open(io.BytesIO(data)) as image:
+        frame = image.convert("RGB")
+    kind = random.choice(("resize", "jpeg", "brightness"))
+    if kind == "resize":
+        frame = frame.resize((160, 120))
+    elif kind == "brightness":
+        frame = ImageEnhance.Brightness(frame).enhance(1.1)
+    out = io.BytesIO()
+    frame.save(out, "JPEG" if kind == "jpeg" else "GIF", quality=70)
+    return out.getvalue()
+
+
+async def bench_dedup(args):
+    import dedup
+
+    if not dedup.available():
+        print("❌ Hace falta Pillow: pip install pillow")
+        sys.exit(1)
+
+    originals = fixture_gifs(args.gifs)
+    variants = [fixture_variant(data) for data in originals]
+    files = {f"orig{i}": data for i, data in enumerate(originals)}
+    files.update({f"copy{i}": data for i, data in enumerate(variants)})
+
+    async def stub_downloader(file_id: str) -> bytes:
+        return files[file_id]
+
+    checker = dedup.PerceptualDedup(
+        stub_downloader, threshold=args.threshold, max_workers=args.processes
+    )
+    # Arrancar los procesos del pool fuera de la medida
+    await checker.hash_file("orig0")
+
+    start = time.perf_counter()
+    hashes = await asyncio.gather(*(checker.hash_file(name) for name in files))
+    elapsed = time.perf_counter() - start
+    checker.close()
+    by_name = dict(zip(files, hashes))
+
+    # Se envían los originales y luego las copias, como receive_meme
+    false_positives = 0
+    for i in range(args.gifs):
+        if checker.index.find(by_name[f"orig{i}"]) is not None:
+            false_positives += 1
+        else:
+            checker.index.add(i, by_name[f"orig{i}"])
+    start = time.perf_counter()
+    found = [checker.index.find(by_name[f"copy{i}"]) for i in range(args.gifs)]
+    lookup = (time.perf_counter() - start) / args.gifs * 1e6
+    detected = sum(gif_id == i for i, gif_id in enumerate(found))
+
+    print(
+        f"hash         {len(files):>7} GIFs  {elapsed:8.3f} s"
+        f"  {len(files) / elapsed:8.1f} GIFs/s con {args.processes} procesos"
+    )
+    print(f"búsqueda     {lookup:8.2f} µs por GIF en un índice de {len(checker.index)}")
+    # Otro worker: su índice solo conoce los GIFs a través de la BD, que se
+    # van añadiendo mientras tanto
+    db = temp_db()
+    other = dedup.PerceptualDedup(stub_downloader, threshold=args.threshold)
+    half = args.gifs // 2
+    for part in (range(half), range(half, args.gifs)):
+        for i in part:
+            phash = dedup.to_signed(by_name[f"orig{i}"])
+            db.add_gif(i + 1, f"autor{i}", i + 1, f"orig{i}", f"orig{i}", phash)
+        other.load(db.get_gif_hashes(other.index.last_id))
+    other.close()
+    db.engine.dispose()
+    shared = sum(
+        other.index.find(by_name[f"copy{i}"]) is not None for i in range(args.gifs)
+    )
+
+    print(f"copias detectadas {detected}/{args.gifs}")
+    print(f"copias detectadas desde otro worker {shared}/{args.gifs}")
+    print(f"originales rechazados por error {false_positives}/{args.gifs}")
+    if detected < args.gifs * 0.95 or false_positives or shared != detected:
+        sys.exit(1)
+
+
+def run_dedup(args):
+    asyncio.run(bench_dedup(args))
+
+
+# ------------------ SQLite ------------------
+
+# Índices de búsqueda que se comparan en el benchmark
+TUNING_INDEXES = ("ix_gifs_contest_user", "ix_votes_contest_voter")
+
+
+def time_queries(
+    db: ChristmasDB, users: int, gif_ids: List[int], rounds: int
+) -> Dict[str, float]:
+    """Tiempo medio en ms de cada consulta para usuarios aleatorios"""
+    sample = random.sample(range(1, users + 1), rounds)
+    queries = {
+        "has_user_submitted_gif": db.has_user_submitted_gif,
+        "count_votable_gifs": db.count_votable_gifs,
+        "get_votable_gifs_page": db.get_votable_gifs_page,
+        "get_user_info": db.get_user_info,
+        "vote_gif": lambda u: db.vote_gif(u, f"user{u}", random.choice(gif_ids)),
+    }
+    timings = {}
+    for name, query in queries.items():
+        start = time.perf_counter()
+        for telegram_id in sample:
+            query(telegram_id)
+        timings[name] = (time.perf_counter() - start) / rounds * 1000
+    return timings
+
+
+def run_sqlite(args):
+    path = os.path.join(tempfile.mkdtemp(prefix="christmas-bench-"), "db.sqlite")
+    url = f"sqlite:///{path}"
+    with contextlib.redirect_stdout(io.StringIO()):
+        db = ChristmasDB(url)
+        gif_ids = seed_contest(db, args.users, args.gifs, args.votes)
+        db.engine.dispose()
+
+        # Antes: perfil por defecto y sin los índices nuevos
+        db = ChristmasDB(url, max_cached_users=0)
+        with db.engine.begin() as connection:
+            for index in TUNING_INDEXES:
+                connection.execute(text(f"DROP INDEX {index}"))
+        before = time_queries(db, args.users, gif_ids, args.rounds)
+        db.engine.dispose()
+
+        # Después: perfil de producción con los índices de la migración 9
+        db = ChristmasDB(url, max_cached_users=0, profile="production")
+        with db.engine.begin() as connection:
+            for index in (*Gif.__table__.indexes, *Vote.__table__.indexes):
+                if index.name in TUNING_INDEXES:
+                    index.create(connection)
+        after = time_queries(db, args.users, gif_ids, args.rounds)
+        db.engine.dispose()
+
+    print(f"{'consulta':<24} {'antes':>10} {'después':>10}")
+    for name in before:
+        print(f"{name:<24} {before[name]:8.3f}ms {after[name]:8.3f}ms")
+
+
+# ------------------ Concursos ------------------
+
+
+def gif_of(info: Dict[str, Any]):
+    return info.get("gif_id"), info["total_gifs"]
+
+
+def run_contests(args):
+    """Consultas del concurso en curso con `past` concursos anteriores en las
+    tablas gifs y votes, y después de archivarlos. Luego, dos concursos que
+    se archivan uno tras otro"""
+    path = os.path.join(tempfile.mkdtemp(prefix="christmas-bench-"), "db.sqlite")
+    url = f"sqlite:///{path}"
+    past = [f"edicion-{n}" for n in range(1, args.past + 1)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        # Los mismos usuarios participan en todas las ediciones
+        for n, name in enumerate(past):
+            db = ChristmasDB(url, contest=name)
+            seed_contest(db, args.users, args.gifs, args.votes, n * args.gifs)
+            db.engine.dispose()
+        db = ChristmasDB(url, contest="actual", max_cached_users=0)
+        gif_ids = seed_contest(
+            db, args.users, args.gifs // 10, args.votes // 10, len(past) * args.gifs
+        )
+        sample = random.sample(range(1, args.users + 1), 20)
+        expected = [db.get_user_info(telegram_id) for telegram_id in sample]
+
+        before = time_queries(db, args.users, gif_ids, args.rounds)
+        start = time.perf_counter()
+        archived = [db.archive_contest(name) for name in past]
+        archiving = time.perf_counter() - start
+        after = time_queries(db, args.users, gif_ids, args.rounds)
+        # time_queries añade votos: se comparan solo los GIFs
+        changed = [
+            telegram_id
+            for telegram_id, info in zip(sample, expected)
+            if gif_of(db.get_user_info(telegram_id)) != gif_of(info)
+        ]
+        db.engine.dispose()
+
+        # Concursos seguidos: el siguiente empieza con las tablas vacías y los
+        # dos usan los mismos ficheros y mensajes mientras siguen abiertos
+        db.archive_contest("actual")
+        following = ["siguiente-1", "siguiente-2"]
+        for name in following:
+            db = ChristmasDB(url, contest=name)
+            seed_contest(db, args.users, args.gifs // 10, args.votes // 10)
+            db.engine.dispose()
+        for name in following:
+            db.archive_contest(name)
+        # `db` sigue apuntando a siguiente-2, como un bot que no se ha parado
+        try:
+            db.add_gif(args.users + 1, "tarde", 1, "tarde")
+            late = True
+        except ValueError:
+            late = False
+        contests = db.get_contests()
+        db.engine.dispose()
+
+    gifs = sum(g for g, _ in archived)
+    votes = sum(v for _, v in archived)
+    print(
+        f"{len(past)} concursos archivados en {archiving:.2f} s"
+        f" ({gifs} GIFs, {votes} votos)"
+    )
+    print(f"{'consulta':<24} {'sin archivar':>12} {'archivados':>12}")
+    for name in before:
+        print(f"{name:<24} {before[name]:10.3f}ms {after[name]:10.3f}ms")
+    # get_contests cuenta también las tablas de archivo
+    expected_gifs = dict.fromkeys(past, args.gifs)
+    expected_gifs.update(dict.fromkeys(["actual", *following], args.gifs // 10))
+    kept = {c["name"]: c["gifs"] for c in contests if c["archived_at"]}
+    if gifs != args.past * args.gifs or kept != expected_gifs:
+        print("❌ El archivo no conserva todos los GIFs")
+        sys.exit(1)
+    if changed:
+        print(f"❌ Cambian los datos de {len(changed)} usuarios al archivar")
+        sys.exit(1)
+    if late:
+        print("❌ Se aceptan GIFs en un concurso ya archivado")
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    votes = commands.add_parser("votes", help="Commit por voto frente a VoteBuffer")
+    votes.add_argument("--voters", type=int, default=200)
+    votes.add_argument("--gifs", type=int, default=20)
+    votes.add_argument("--flush-ms", type=int, default=50)
+    votes.add_argument("--max-batch", type=int, default=500)
+    votes.add_argument("--snapshot-ms", type=int, default=1000)
+    votes.set_defaults(func=run_votes)
+
+    sessions = commands.add_parser(
+        "sessions", help="add_user y vote_gif mezclados desde varios hilos"
+    )
+    sessions.add_argument("--threads", type=int, default=8)
+    sessions.add_argument("--rounds", type=int, default=8)
+    sessions.add_argument("--voters", type=int, default=100)
+    sessions.add_argument("--gifs", type=int, default=50)
+    sessions.add_argument("--votes-per-voter", type=int, default=4)
+    sessions.add_argument("--cached-users", type=int, default=100)
+    sessions.add_argument("--warmup", type=int, default=3)
+    sessions.add_argument("--max-growth-kib", type=int, default=256)
+    sessions.set_defaults(func=run_sessions)
+
+    handlers = commands.add_parser(
+        "handlers", help="Handlers de main.py con updates sintéticas"
+    )
+    handlers.add_argument("--users", type=int, default=500)
+    handlers.add_argument("--gifs", type=int, default=100)
+    handlers.add_argument("--votes", type=int, default=5000)
+    handlers.add_argument("--updates", type=int, default=300)
+    handlers.add_argument("--concurrency", type=int, default=32)
+    handlers.add_argument("--api-latency-ms", type=float, default=0)
+    handlers.set_defaults(func=run_handlers)
+
+    concurrency = commands.add_parser(
+        "concurrency", help="Botones de muchos usuarios mezclados: orden y throughput"
+    )
+    concurrency.add_argument("--users", type=int, default=50)
+    concurrency.add_argument("--gifs", type=int, default=100)
+    concurrency.add_argument("--votes", type=int, default=1000)
+    concurrency.add_argument("--presses", type=int, default=10)
+    concurrency.add_argument("--concurrent", type=int, default=64)
+    concurrency.add_argument("--api-latency-ms", type=float, default=20)
+    concurrency.add_argument("--burst-slots", type=int, default=4)
+    concurrency.set_defaults(func=run_concurrency)
+
+    callbacks = commands.add_parser(
+        "callbacks", help="Votos de muchos usuarios a la vez con commits lentos"
+    )
+    callbacks.add_argument("--gifs", type=int, default=50)
+    callbacks.add_argument("--votes", type=int, default=1000)
+    callbacks.add_argument("--serial", type=int, default=50)
+    callbacks.add_argument("--concurrent", type=int, default=64)
+    callbacks.add_argument("--commit-ms", type=float, default=2)
+    callbacks.add_argument("--api-latency-ms", type=float, default=20)
+    callbacks.add_argument("--min-speedup", type=float, default=3)
+    callbacks.set_defaults(func=run_callbacks)
+
+    scheduler = commands.add_parser(
+        "scheduler", help="Ritmo de OutboundScheduler con RetryAfter inyectados"
+    )
+    scheduler.add_argument("--chats", type=int, default=20)
+    scheduler.add_argument("--per-chat", type=int, default=8)
+    scheduler.add_argument("--retry-afters", type=int, default=2)
+    scheduler.add_argument("--retry-after", type=int, default=1)
+    scheduler.add_argument("--global-rate", type=float, default=30)
+    scheduler.add_argument("--private-rate", type=float, default=1)
+    scheduler.add_argument("--burst", type=int, default=5)
+    scheduler.set_defaults(func=run_scheduler)
+
+    memory = commands.add_parser(
+        "memory", help="Memoria del estado del carrusel por votante"
+    )
+    memory.add_argument("--voters", type=int, default=10_000)
+    memory.add_argument("--gifs", type=int, default=100)
+    memory.add_argument("--sample", type=int, default=200)
+    memory.set_defaults(func=run_memory)
+
+    workers = commands.add_parser(
+        "workers", help="Webhook con cola y N procesos worker"
+    )
+    workers.add_argument("--workers", default="1,2,4")
+    workers.add_argument("--users", type=int, default=500)
+    workers.add_argument("--gifs", type=int, default=100)
+    workers.add_argument("--votes", type=int, default=5000)
+    workers.add_argument("--updates", type=int, default=600)
+    workers.add_argument("--api-latency-ms", type=float, default=20)
+    workers.set_defaults(func=run_workers)
+
+    sqlite = commands.add_parser(
+        "sqlite", help="Perfil por defecto frente a DB_PROFILE=production"
+    )
+    sqlite.add_argument("--users", type=int, default=5000)
+    sqlite.add_argument("--gifs", type=int, default=500)
+    sqlite.add_argument("--votes", type=int, default=100_000)
+    sqlite.add_argument("--rounds", type=int, default=200)
+    sqlite.set_defaults(func=run_sqlite)
+
+    startup = commands.add_parser(
+        "startup", help="Tiempo de arranque en frío hasta la primera update"
+    )
+    startup.add_argument("--rounds", type=int, default=5)
+    startup.add_argument("--api-latency-ms", type=float, default=50)
+    startup.add_argument("--budget-ms", type=float, default=1500)
+    startup.set_defaults(func=run_startup)
+
+    dedup = commands.add_parser(
+        "dedup", help="Hash perceptual de GIFs de prueba y sus copias retocadas"
+    )
+    dedup.add_argument("--gifs", type=int, default=200)
+    dedup.add_argument("--threshold", type=int, default=6)
+    dedup.add_argument("--processes", type=int, default=2)
+    dedup.set_defaults(func=run_dedup)
+
+    contests = commands.add_parser(
+        "contests", help="Concurso en curso con concursos anteriores archivados"
+    )
+    contests.add_argument("--past", type=int, default=3)
+    contests.add_argument("--users", type=int, default=2000)
+    contests.add_argument("--gifs", type=int, default=500)
+    contests.add_argument("--votes", type=int, default=50_000)
+    contests.add_argument("--rounds", type=int, default=200)
+    contests.set_defaults(func=run_contests)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
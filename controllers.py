@@ -1,224 +1,1207 @@
-from typing import Any, Dict, List
+import asyncio
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from enum import Enum
+from typing import (
+    Any,
+    Callable,
+    Collection,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Set,
+    Tuple,
+)
 
-from sqlalchemy import create_engine, func, select, update
+from sqlalchemy import (
+    BigInteger,
+    Integer,
+    bindparam,
+    column,
+    create_engine,
+    delete,
+    event,
+    exists,
+    func,
+    make_url,
+    select,
+    text,
+    update,
+    values,
+)
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, aliased, sessionmaker
 
-from models import Base, Gif, User, Vote
+from metrics import instrument_engine, track_db_method
+from migrations import migrate
+from models import (
+    DEFAULT_CONTEST,
+    BotState,
+    Carol,
+    Contest,
+    Gif,
+    GifArchive,
+    User,
+    Vote,
+    VoteArchive,
+)
+
+
+class VoteResult(Enum):
+    """Resultado de ChristmasDB.vote_gif"""
+
+    OK = "ok"
+    DUPLICATE = "duplicate"
+    OWN_GIF = "own_gif"
+    MISSING_GIF = "missing_gif"
+
+
+class CachedUser(NamedTuple):
+    """Datos de un usuario guardados en la caché de ChristmasDB"""
+
+    id: int
+    username: str | None
+    has_gif: bool
+
+
+# Perfiles de PRAGMAs de SQLite que se aplican en cada conexión nueva
+SQLITE_PROFILES: Dict[str, Dict[str, Any]] = {
+    "default": {},
+    "production": {
+        # WAL: los lectores no bloquean al escritor y los commits no
+        # reescriben el journal; NORMAL solo hace fsync en los checkpoints
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,  # En KiB: 64 MiB
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+}
+
+
+def apply_pragmas(engine, pragmas: Dict[str, Any]):
+    """Ejecuta los PRAGMAs de SQLite al abrir cada conexión del engine"""
+    if not pragmas:
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+# INSERT con ON CONFLICT de cada dialecto soportado
+UPSERT_INSERTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+
+# Votos por sentencia en add_votes: dos parámetros cada uno, lejos del límite
+# de SQLite (32766 desde la 3.32)
+VOTE_BATCH_SIZE = 1000
+
+
+def normalize_url(db_path: str) -> str:
+    """Usa psycopg 3 para las URL de PostgreSQL (Render da postgres://...)"""
+    for prefix in ("postgres://", "postgresql://"):
+        if db_path.startswith(prefix):
+            return "postgresql+psycopg://" + db_path[len(prefix) :]
+    return db_path
 
 
 class ChristmasDB:
-    def __init__(self, db_path="sqlite:///db.sqlite"):
-        self.engine = create_engine(db_path, echo=False)
-        Base.metadata.create_all(self.engine)
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+    def __init__(
+        self,
+        db_path="sqlite:///db.sqlite",
+        pool_size: int = 5,
+        max_overflow: int = 10,
+        leaderboard_ttl: float = 60,
+        max_cached_users: int = 10_000,
+        profile: str = "default",
+        contest: str = DEFAULT_CONTEST,
+    ):
+        engine_kwargs: Dict[str, Any] = {}
+        if make_url(db_path).database not in (None, "", ":memory:"):
+            engine_kwargs.update(
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_pre_ping=True,
+            )
+        self.engine = create_engine(normalize_url(db_path), echo=False, **engine_kwargs)
+        dialect = self.engine.dialect.name
+        if dialect not in UPSERT_INSERTS:
+            raise ValueError(f"Base de datos no soportada: {dialect}")
+        self.insert = UPSERT_INSERTS[dialect]
+        instrument_engine(self.engine)
+        if dialect == "sqlite":
+            apply_pragmas(self.engine, SQLITE_PROFILES[profile])
+        migrate(self.engine)
+        # Una sesión por operación: el identity map se libera al cerrarla y
+        # los objetos devueltos siguen siendo legibles tras el commit
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+        # Todas las operaciones se limitan al concurso activo, que se crea
+        # al usarlo por primera vez: import puede traer antes sus ids
+        self.contest = contest
+        self._contest_id: int | None = None
+
+        # Caché del ranking por `top`; se invalida con cada voto o GIF nuevo
+        self.leaderboard_ttl = leaderboard_ttl
+        self.leaderboard_stats = {"hits": 0, "misses": 0}
+        self._leaderboard_cache: Dict[int, Tuple[float, List[Dict[str, Any]]]] = {}
+        self._leaderboard_generation = 0
+        self._leaderboard_lock = threading.Lock()
+
+        # Caché LRU telegram_id -> CachedUser para no consultar users en
+        # cada pulsación; se escribe a la vez que la BD
+        self.max_cached_users = max_cached_users
+        self.user_cache_stats = {"hits": 0, "misses": 0}
+        self._users: OrderedDict[int, CachedUser] = OrderedDict()
+        self._users_lock = threading.Lock()
+
+    # --------------------
+    # CONCURSOS
+    # --------------------
+    @property
+    def contest_id(self) -> int:
+        if self._contest_id is None:
+            self._contest_id = self._get_or_create_contest(self.contest)
+        return self._contest_id
+
+    def _get_or_create_contest(self, name: str) -> int:
+        """Id del concurso `name`, que se crea si no existe"""
+        stmt = self.insert(Contest.__table__).values(name=name)
+        with self.Session() as session:
+            session.execute(stmt.on_conflict_do_nothing(index_elements=["name"]))
+            contest_id, archived_at = session.execute(
+                select(Contest.id, Contest.archived_at).where(Contest.name == name)
+            ).one()
+            session.commit()
+        if archived_at is not None:
+            raise ValueError(f"El concurso {name} está archivado")
+        return contest_id
+
+    def get_contests(self) -> List[Dict[str, Any]]:
+        """Concursos con su número de GIFs y votos, activos o archivados"""
+        counts = {}
+        with self.Session() as session:
+            for gifs, votes in ((Gif, Vote), (GifArchive.c, VoteArchive.c)):
+                for contest_id, count in session.execute(
+                    select(gifs.contest_id, func.count()).group_by(gifs.contest_id)
+                ):
+                    counts.setdefault(contest_id, [0, 0])[0] += count
+                for contest_id, count in session.execute(
+                    select(votes.contest_id, func.count()).group_by(votes.contest_id)
+                ):
+                    counts.setdefault(contest_id, [0, 0])[1] += count
+            contests = session.execute(select(Contest).order_by(Contest.id)).scalars()
+            return [
+                {
+                    "id": contest.id,
+                    "name": contest.name,
+                    "created_at": contest.created_at,
+                    "archived_at": contest.archived_at,
+                    "gifs": counts.get(contest.id, [0, 0])[0],
+                    "votes": counts.get(contest.id, [0, 0])[1],
+                }
+                for contest in contests
+            ]
+
+    def archive_contest(self, name: str) -> Tuple[int, int]:
+        """Mueve los GIFs y votos de un concurso a las tablas de archivo.
+
+        Las tablas gifs y votes se quedan solo con los concursos en curso.
+        Devuelve cuántos GIFs y votos se han movido.
+        """
+        with self.engine.begin() as connection:
+            contest = connection.execute(
+                select(Contest.id, Contest.archived_at).where(Contest.name == name)
+            ).first()
+            if contest is None:
+                raise ValueError(f"No existe el concurso {name}")
+            if contest.archived_at is not None:
+                raise ValueError(f"El concurso {name} ya está archivado")
+
+            moved = []
+            # Votos antes que GIFs: claves ajenas de votes a gifs
+            for hot, cold in (
+                (Vote.__table__, VoteArchive),
+                (Gif.__table__, GifArchive),
+            ):
+                in_contest = hot.c.contest_id == contest.id
+                connection.execute(
+                    cold.insert().from_select(
+                        hot.columns.keys(), select(hot).where(in_contest)
+                    )
+                )
+                moved.append(connection.execute(delete(hot).where(in_contest)).rowcount)
+            connection.execute(
+                update(Contest)
+                .where(Contest.id == contest.id)
+                .values(archived_at=func.now())
+            )
+        if contest.id == self._contest_id:
+            self.invalidate_leaderboard()
+            with self._users_lock:
+                self._users.clear()
+        votes, gifs = moved
+        return gifs, votes
 
     # --------------------
     # USERS - CORREGIDOS
     # --------------------
-    def add_user(self, telegram_id: int, username: str) -> User:
-        """Añade o actualiza un usuario usando telegram_id"""
-        user = self.session.query(User).filter_by(telegram_id=telegram_id).first()
+    def _get_or_create_user(
+        self, session: Session, telegram_id: int, username: str
+    ) -> User:
+        """Obtiene o crea un usuario dentro de la sesión dada"""
+        user = session.query(User).filter_by(telegram_id=telegram_id).first()
         if not user:
             user = User(telegram_id=telegram_id, username=username)
-            self.session.add(user)
+            try:
+                # Insertar en un savepoint por si otro hilo lo ha creado a la vez
+                with session.begin_nested():
+                    session.add(user)
+            except IntegrityError:
+                user = session.query(User).filter_by(telegram_id=telegram_id).one()
         elif user.username != username:
-            user_update = (
-                update(User)
-                .where(User.telegram_id.is_(telegram_id))
-                .values(username=username)
-            )
-            self.session.execute(user_update)
+            user.username = username
+        return user
 
-        try:
-            self.session.commit()
-        except IntegrityError:
-            self.session.rollback()
+    def _cached_user(self, telegram_id: int) -> CachedUser | None:
+        """Busca un usuario en la caché LRU"""
+        with self._users_lock:
+            user = self._users.get(telegram_id)
+            if user is None:
+                self.user_cache_stats["misses"] += 1
+                return None
+            self._users.move_to_end(telegram_id)
+            self.user_cache_stats["hits"] += 1
+            return user
+
+    def _cache_user(self, telegram_id: int, user: CachedUser):
+        """Guarda un usuario en la caché LRU tras escribirlo en la BD"""
+        with self._users_lock:
+            self._users[telegram_id] = user
+            self._users.move_to_end(telegram_id)
+            if len(self._users) > self.max_cached_users:
+                self._users.popitem(last=False)
+
+    def _write_user(
+        self, session: Session, telegram_id: int, username: str, contest_id: int
+    ):
+        """Crea o actualiza el usuario y devuelve sus datos para la caché"""
+        session.execute(
+            self._user_upsert(), {"telegram_id": telegram_id, "username": username}
+        )
+        user_id, has_gif = (
+            session.query(User.id, self._has_gif(User.id, contest_id))
+            .filter(User.telegram_id == telegram_id)
+            .one()
+        )
+        return CachedUser(user_id, username, bool(has_gif))
+
+    def add_user(self, telegram_id: int, username: str) -> CachedUser:
+        """Añade o actualiza un usuario usando telegram_id"""
+        user = self._cached_user(telegram_id)
+        if user is not None and user.username == username:
+            return user
+        # Antes de abrir la sesión: crear el concurso usa otra transacción, que
+        # esperaría al bloqueo de escritura de esta
+        contest_id = self.contest_id
+        with self.Session() as session:
+            user = self._write_user(session, telegram_id, username, contest_id)
+            session.commit()
+        self._cache_user(telegram_id, user)
         return user
 
     # --------------------
     # GIFS - CORREGIDOS
     # --------------------
     def add_gif(
-        self, telegram_id: int, username: str, message_id: int, file_id: str
+        self,
+        telegram_id: int,
+        username: str,
+        message_id: int,
+        file_id: str,
+        file_unique_id: str | None = None,
+        phash: int | None = None,
     ) -> Gif:
         """Añade un GIF usando telegram_id del usuario"""
-        # Obtener/crear usuario por telegram_id
-        user = self.add_user(telegram_id, username)
+        contest_id = self.contest_id
+        with self.Session() as session:
+            # ❌ El mismo fichero ya está en el concurso (ix_gifs_contest_file)
+            if (
+                file_unique_id is not None
+                and session.query(
+                    exists().where(
+                        Gif.contest_id == contest_id,
+                        Gif.file_unique_id == file_unique_id,
+                    )
+                ).scalar()
+            ):
+                raise ValueError("Ese GIF ya está en el concurso.")
 
-        # Crear el GIF
-        gif = Gif(
-            message_id=message_id,
-            file_id=file_id,
-            user_id=user.id,  # Usar el id interno de la BD
-        )
+            # Obtener/crear usuario por telegram_id
+            user = self._get_or_create_user(session, telegram_id, username)
+
+            # ❌ Un GIF por usuario y concurso (ix_gifs_contest_user)
+            if session.query(self._has_gif(user.id, contest_id)).scalar():
+                raise ValueError("Ya has enviado un GIF anteriormente.")
 
-        self.session.add(gif)
-        self.session.commit()
-        return gif
+            # ❌ El concurso se ha archivado con el bot en marcha
+            if not session.query(self._contest_open(contest_id)).scalar():
+                raise ValueError("El concurso ya ha terminado.")
+
+            # Crear el GIF
+            gif = Gif(
+                contest_id=contest_id,
+                message_id=message_id,
+                file_id=file_id,
+                file_unique_id=file_unique_id,
+                phash=phash,
+                user=user,  # Se resuelve al id interno de la BD
+            )
+
+            session.add(gif)
+            user_id = user.id
+            try:
+                session.commit()
+            except IntegrityError:
+                # Un envío simultáneo ganó la carrera a un índice único
+                session.rollback()
+                if session.query(self._has_gif(user_id, contest_id)).scalar():
+                    raise ValueError("Ya has enviado un GIF anteriormente.")
+                raise ValueError("Ese GIF ya está en el concurso.")
+            self._cache_user(telegram_id, CachedUser(user.id, username, True))
+            self.invalidate_leaderboard()
+            return gif
+
+    def find_gif_by_unique_id(self, file_unique_id: str) -> int | None:
+        """Id del GIF con ese file_unique_id, si ya está en el concurso"""
+        with self.Session() as session:
+            return session.execute(
+                select(Gif.id).where(
+                    Gif.contest_id == self.contest_id,
+                    Gif.file_unique_id == file_unique_id,
+                )
+            ).scalar()
+
+    def get_gif_hashes(self, after_id: int = 0) -> List[Tuple[int, int]]:
+        """(gif_id, phash) de los GIFs con hash perceptual y id > `after_id`"""
+        with self.Session() as session:
+            rows = session.execute(
+                select(Gif.id, Gif.phash).where(
+                    Gif.contest_id == self.contest_id,
+                    Gif.phash.is_not(None),
+                    Gif.id > after_id,
+                )
+            )
+            return [(gif_id, phash) for gif_id, phash in rows]
+
+    @staticmethod
+    def _contest_open(contest_id: int):
+        """Si el concurso sigue sin archivar.
+
+        El id del concurso activo se guarda al empezar: sin esta condición,
+        `manage.py archive` con el bot en marcha no impediría nuevas
+        escrituras en el concurso archivado.
+        """
+        return exists().where(Contest.id == contest_id, Contest.archived_at.is_(None))
+
+    @staticmethod
+    def _has_gif(user_id, contest_id: int):
+        """Si el usuario tiene GIF en el concurso"""
+        return exists().where(Gif.contest_id == contest_id, Gif.user_id == user_id)
 
     def has_user_submitted_gif(self, telegram_id: int) -> bool:
         """Verifica si un usuario ya ha enviado un GIF"""
+        user = self._cached_user(telegram_id)
+        if user is not None:
+            return user.has_gif
+
         try:
-            # Buscar usuario por telegram_id
-            user = self.session.query(User).filter_by(telegram_id=telegram_id).first()
+            contest_id = self.contest_id
+            with self.Session() as session:
+                result = (
+                    session.query(
+                        User.id, User.username, self._has_gif(User.id, contest_id)
+                    )
+                    .filter(User.telegram_id == telegram_id)
+                    .first()
+                )
 
-            if not user:
+            if result is None:
                 return False
-
-            # Verificar si tiene un GIF
-            result = (
-                self.session.query(Gif.id)
-                # Buscar por id interno del usuario
-                .filter_by(user_id=user.id).first()
-            )
-
-            return result is not None
+            user_id, username, has_gif = result
+            self._cache_user(telegram_id, CachedUser(user_id, username, bool(has_gif)))
+            return bool(has_gif)
 
         except Exception as e:
             print(f"Error en has_user_submitted_gif: {str(e)}")
             return False
 
     def get_gif(self, gif_id: int) -> Gif | None:
-        return self.session.query(Gif).filter_by(id=gif_id).first()
+        with self.Session() as session:
+            return (
+                session.query(Gif)
+                .filter_by(id=gif_id, contest_id=self.contest_id)
+                .first()
+            )
 
     # --------------------
     # VOTING - CORREGIDOS
     # --------------------
-    def vote_gif(self, telegram_id: int, username: str, gif_id: int) -> Vote | None:
-        """Registra un voto para un GIF"""
-        # Obtener/crear usuario por telegram_id
-        user = self.add_user(telegram_id, username)
+    def _user_upsert(self):
+        """INSERT de usuario que actualiza el username si ya existe"""
+        stmt = self.insert(User.__table__)
+        return stmt.on_conflict_do_update(
+            index_elements=[User.telegram_id],
+            set_={"username": stmt.excluded.username},
+            where=User.username.is_distinct_from(stmt.excluded.username),
+        )
 
-        # Obtener el GIF
-        gif = self.get_gif(gif_id)
-        if not gif:
-            print(f"GIF con ID {gif_id} no encontrado")
-            return None
+    def _vote_insert(self, contest_id: int):
+        """INSERT ... SELECT de un voto que descarta autovotos y duplicados"""
+        # Con tipo explícito: PostgreSQL no lo deduce en la lista del SELECT
+        voter_id = bindparam("voter_id", type_=Integer)
+        # ❌ No votarte a ti mismo / ❌ No votar dos veces (unique_vote)
+        # ❌ Solo GIFs del concurso activo y sin archivar
+        return (
+            self.insert(Vote.__table__)
+            .from_select(
+                ["contest_id", "gif_id", "voter_id"],
+                select(Gif.contest_id, Gif.id, voter_id).where(
+                    Gif.id == bindparam("target_gif_id", type_=Integer),
+                    Gif.contest_id == contest_id,
+                    Gif.user_id != voter_id,
+                    self._contest_open(contest_id),
+                ),
+            )
+            .on_conflict_do_nothing(index_elements=["gif_id", "voter_id"])
+        )
 
-        # ❌ No votarte a ti mismo
-        if gif.user_id == user.id:  # Comparar IDs internos
-            print(f"Usuario {telegram_id} intentó votar su propio GIF")
-            return None
+    def _votes_insert(self, votes: List[Tuple[int, int]], contest_id: int):
+        """Como _vote_insert, para un lote de votos (telegram_id, gif_id).
 
-        # ❌ No votar dos veces el mismo GIF
-        existing_vote = (
-            self.session.query(Vote).filter_by(gif_id=gif.id, voter_id=user.id).first()
+        Devuelve el gif_id de cada voto insertado (RETURNING). Los votos van
+        en un CTE con VALUES: a diferencia de executemany, una sola sentencia
+        admite RETURNING en SQLite y PostgreSQL.
+        """
+        batch = (
+            values(
+                column("telegram_id", BigInteger),
+                column("gif_id", Integer),
+                name="batch",
+            )
+            .data(votes)
+            .cte("batch")
         )
-        if existing_vote:
-            print(f"Usuario {telegram_id} ya votó este GIF {gif_id}")
-            return None
-
-        # Crear voto
-        vote = Vote(
-            gif_id=gif.id,
-            voter_id=user.id,  # Usar id interno
+        return (
+            self.insert(Vote.__table__)
+            .from_select(
+                ["contest_id", "gif_id", "voter_id"],
+                select(Gif.contest_id, Gif.id, User.id)
+                .select_from(batch)
+                .join(Gif, Gif.id == batch.c.gif_id)
+                .join(User, User.telegram_id == batch.c.telegram_id)
+                .where(
+                    Gif.contest_id == contest_id,
+                    Gif.user_id != User.id,
+                    self._contest_open(contest_id),
+                ),
+            )
+            .on_conflict_do_nothing(index_elements=["gif_id", "voter_id"])
+            .returning(Vote.gif_id)
         )
 
-        try:
-            self.session.add(vote)
-            self.session.commit()
-            print(f"Voto registrado: usuario {telegram_id} votó GIF {gif_id}")
-            return vote
-        except IntegrityError as e:
-            self.session.rollback()
-            print(f"Error de integridad al votar: {e}")
-            return None
+    def vote_gif(self, telegram_id: int, username: str, gif_id: int) -> VoteResult:
+        """Registra un voto para un GIF en una única transacción de escritura"""
+        contest_id = self.contest_id
+        with self.Session() as session:
+            # Obtener/crear usuario por telegram_id, salvo que esté en caché
+            user = self._cached_user(telegram_id)
+            if user is None or user.username != username:
+                user = self._write_user(session, telegram_id, username, contest_id)
+            inserted = session.execute(
+                self._vote_insert(contest_id),
+                {"voter_id": user.id, "target_gif_id": gif_id},
+            ).rowcount
+            if inserted:
+                session.execute(
+                    update(Gif)
+                    .where(Gif.id == gif_id)
+                    .values(vote_count=Gif.vote_count + 1)
+                )
+            session.commit()
+            self._cache_user(telegram_id, user)
+
+            if inserted:
+                self.invalidate_leaderboard()
+                print(f"Voto registrado: usuario {telegram_id} votó GIF {gif_id}")
+                return VoteResult.OK
+
+        # Solo en el camino de rechazo averiguamos el motivo
+        owner = self.get_gif_owner(gif_id)
+        if owner is None:
+            print(f"GIF con ID {gif_id} no encontrado")
+            return VoteResult.MISSING_GIF
+        if owner == telegram_id:
+            print(f"Usuario {telegram_id} intentó votar su propio GIF")
+            return VoteResult.OWN_GIF
+        print(f"Usuario {telegram_id} ya votó este GIF {gif_id}")
+        return VoteResult.DUPLICATE
+
+    def add_votes(self, votes: List[Tuple[int, str, int]]) -> int:
+        """Registra un lote de votos (telegram_id, username, gif_id) en una
+        sola transacción. Devuelve cuántos se han insertado"""
+        if not votes:
+            return 0
+        usernames = {telegram_id: username for telegram_id, username, _ in votes}
+        contest_id = self.contest_id
+        with self.Session() as session:
+            session.execute(
+                self._user_upsert(),
+                [
+                    {"telegram_id": telegram_id, "username": username}
+                    for telegram_id, username in usernames.items()
+                ],
+            )
+            inserted: Counter[int] = Counter()
+            pairs = [(telegram_id, gif_id) for telegram_id, _, gif_id in votes]
+            # Por tandas: SQLite limita los parámetros de una sentencia
+            for start in range(0, len(pairs), VOTE_BATCH_SIZE):
+                chunk = pairs[start : start + VOTE_BATCH_SIZE]
+                inserted.update(
+                    session.execute(self._votes_insert(chunk, contest_id)).scalars()
+                )
+            # Sumar a cada contador sus votos nuevos. Recontarlos desde votes
+            # perdería votos: con READ COMMITTED, otra transacción no ve los
+            # votos aún sin confirmar de esta y escribiría un recuento menor
+            if inserted:
+                gifs = Gif.__table__
+                session.execute(
+                    update(gifs)
+                    .where(gifs.c.id == bindparam("gif"))
+                    .values(vote_count=gifs.c.vote_count + bindparam("added")),
+                    [{"gif": gif, "added": added} for gif, added in inserted.items()],
+                )
+            session.commit()
+            if inserted:
+                self.invalidate_leaderboard()
+            return inserted.total()
+
+    def get_gif_owner(self, gif_id: int) -> int | None:
+        """Devuelve el telegram_id del autor de un GIF"""
+        with self.Session() as session:
+            return (
+                session.query(User.telegram_id)
+                .join(Gif, Gif.user_id == User.id)
+                .filter(Gif.id == gif_id, Gif.contest_id == self.contest_id)
+                .scalar()
+            )
 
-    def get_votable_gifs(self, telegram_id: int, username: str) -> List[Gif]:
-        """Obtiene GIFs que un usuario puede votar"""
-        # Obtener/crear usuario por telegram_id
-        user = self.add_user(telegram_id, username)
+    def get_voted_gif_ids(self, telegram_id: int) -> Set[int]:
+        """Devuelve los ids de los GIFs que un usuario ya ha votado"""
+        with self.Session() as session:
+            rows = (
+                session.query(Vote.gif_id)
+                .join(User, Vote.voter_id == User.id)
+                .filter(
+                    Vote.contest_id == self.contest_id,
+                    User.telegram_id == telegram_id,
+                )
+            )
+            return {gif_id for (gif_id,) in rows}
 
-        # Subquery para GIFs ya votados por este usuario
-        voted_gifs_subq = select(Vote.gif_id).where(Vote.voter_id == user.id)
+    def _votable_filter(self, telegram_id: int, exclude: Collection[int] = ()):
+        """Condiciones para que un GIF sea votable por un usuario.
 
-        # Consulta principal
-        gifs = (
-            self.session.query(Gif)
-            .filter(Gif.user_id != user.id)  # Excluir GIFs propios
-            .filter(~Gif.id.in_(voted_gifs_subq))  # Excluir ya votados
-            .all()
+        `exclude` son ids de GIFs que tampoco cuentan como votables, como los
+        votos aceptados por VoteBuffer que aún no están en la BD.
+        """
+        voter_id = (
+            select(User.id).where(User.telegram_id == telegram_id).scalar_subquery()
         )
+        conditions = [
+            Gif.contest_id == self.contest_id,
+            Gif.user_id.is_distinct_from(voter_id),  # Excluir GIFs propios
+            ~exists().where(  # Excluir ya votados (índice unique_vote)
+                Vote.gif_id == Gif.id, Vote.voter_id == voter_id
+            ),
+        ]
+        if exclude:
+            conditions.append(Gif.id.notin_(exclude))
+        return conditions
+
+    def count_votable_gifs(
+        self, telegram_id: int, exclude: Collection[int] = ()
+    ) -> int:
+        """Cuenta los GIFs que un usuario puede votar"""
+        with self.Session() as session:
+            return (
+                session.query(func.count(Gif.id))
+                .filter(*self._votable_filter(telegram_id, exclude))
+                .scalar()
+            )
+
+    def get_votable_gifs_page(
+        self,
+        telegram_id: int,
+        after_id: int | None = None,
+        before_id: int | None = None,
+        limit: int = 10,
+        exclude: Collection[int] = (),
+    ) -> List[Tuple[int, str]]:
+        """Obtiene una página de (gif_id, file_id) votables ordenada por id.
 
-        return gifs
+        Paginación por clave: `after_id` devuelve los siguientes GIFs y
+        `before_id` los anteriores, sin cargar el resto de la lista.
+        """
+        with self.Session() as session:
+            query = session.query(Gif.id, Gif.file_id).filter(
+                *self._votable_filter(telegram_id, exclude)
+            )
+            if before_id is not None:
+                rows = (
+                    query.filter(Gif.id < before_id)
+                    .order_by(Gif.id.desc())
+                    .limit(limit)
+                    .all()
+                )
+                rows.reverse()
+            else:
+                if after_id is not None:
+                    query = query.filter(Gif.id > after_id)
+                rows = query.order_by(Gif.id).limit(limit).all()
+            return [(gif_id, file_id) for gif_id, file_id in rows]
 
     # --------------------
     # RANKING
     # --------------------
+    def invalidate_leaderboard(self):
+        """Descarta el ranking cacheado"""
+        with self._leaderboard_lock:
+            self._leaderboard_generation += 1
+            self._leaderboard_cache.clear()
+
     def get_leaderboard(self, top: int = 10) -> List[Dict[str, Any]]:
         """Obtiene el ranking de GIFs más votados"""
-        try:
-            results = (
-                self.session.query(
-                    Gif.id.label("gif_id"),
-                    User.username.label("username"),
-                    func.count(Vote.id).label("votes"),
-                    Gif.file_id.label("file_id"),
-                )
-                .join(User, Gif.user_id == User.id)
-                .outerjoin(Vote, Vote.gif_id == Gif.id)
-                .group_by(Gif.id, User.username, Gif.file_id)
-                .order_by(func.count(Vote.id).desc(), Gif.id.desc())
-                .limit(top)
-                .all()
-            )
+        with self._leaderboard_lock:
+            cached = self._leaderboard_cache.get(top)
+            if cached and time.monotonic() - cached[0] < self.leaderboard_ttl:
+                self.leaderboard_stats["hits"] += 1
+                return [dict(entry) for entry in cached[1]]
+            self.leaderboard_stats["misses"] += 1
+            generation = self._leaderboard_generation
 
-            leaderboard = []
-            for gif_id, username, votes, file_id in results:
-                leaderboard.append(
-                    {
-                        "gif_id": gif_id,
-                        "username": username or "Anónimo",
-                        "votes": votes or 0,
-                        "file_id": file_id,
-                    }
+        try:
+            with self.Session() as session:
+                results = (
+                    self._leaderboard_query(session)
+                    # Usa el índice ix_gifs_contest_ranking
+                    .order_by(Gif.vote_count.desc(), Gif.id.desc())
+                    .limit(top)
+                    .all()
                 )
+            leaderboard = self._leaderboard_entries(results)
 
-            return leaderboard
+            with self._leaderboard_lock:
+                # No guardar un ranking calculado antes de una invalidación
+                if generation == self._leaderboard_generation:
+                    self._leaderboard_cache[top] = (time.monotonic(), leaderboard)
+            return [dict(entry) for entry in leaderboard]
 
         except Exception as e:
             print(f"Error al obtener leaderboard: {str(e)}")
             return []
 
+    def get_leaderboard_entries(self, gif_ids: Collection[int]) -> List[Dict[str, Any]]:
+        """Entradas del ranking, sin ordenar, de unos GIFs concretos"""
+        with self.Session() as session:
+            results = self._leaderboard_query(session).filter(Gif.id.in_(gif_ids)).all()
+        return self._leaderboard_entries(results)
+
+    def _leaderboard_query(self, session: Session):
+        return (
+            session.query(
+                Gif.id.label("gif_id"),
+                User.username.label("username"),
+                Gif.vote_count.label("votes"),
+                Gif.file_id.label("file_id"),
+            )
+            .join(User, Gif.user_id == User.id)
+            .filter(Gif.contest_id == self.contest_id)
+        )
+
+    @staticmethod
+    def _leaderboard_entries(results) -> List[Dict[str, Any]]:
+        return [
+            {
+                "gif_id": gif_id,
+                "username": username or "Anónimo",
+                "votes": votes or 0,
+                "file_id": file_id,
+            }
+            for gif_id, username, votes, file_id in results
+        ]
+
+    def _ranking_query(self):
+        """Todos los GIFs en orden de ranking; los empates comparten puesto"""
+        return (
+            select(
+                func.rank().over(order_by=Gif.vote_count.desc()).label("rank"),
+                Gif.id.label("gif_id"),
+                User.username.label("username"),
+                Gif.vote_count.label("votes"),
+                Gif.file_id.label("file_id"),
+            )
+            .join(User, Gif.user_id == User.id)
+            .where(Gif.contest_id == self.contest_id)
+            .order_by(Gif.vote_count.desc(), Gif.id.desc())
+        )
+
+    @staticmethod
+    def _ranking_entry(row) -> Dict[str, Any]:
+        entry = dict(row)
+        entry["username"] = entry["username"] or "Anónimo"
+        return entry
+
+    def iter_ranking(self, batch_size: int = 1000) -> Iterator[Dict[str, Any]]:
+        """Recorre el ranking completo en lotes, con memoria constante"""
+        with self.engine.connect() as connection:
+            result = connection.execution_options(yield_per=batch_size).execute(
+                self._ranking_query()
+            )
+            for row in result.mappings():
+                yield self._ranking_entry(row)
+
+    def get_ranking_page(
+        self, page: int, page_size: int = 10
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        """Una página (desde 1) del ranking completo y el número de páginas"""
+        with self.Session() as session:
+            total = (
+                session.query(func.count(Gif.id))
+                .filter(Gif.contest_id == self.contest_id)
+                .scalar()
+            )
+            rows = session.execute(
+                self._ranking_query().offset((page - 1) * page_size).limit(page_size)
+            ).mappings()
+            entries = [self._ranking_entry(row) for row in rows]
+        return entries, max((total + page_size - 1) // page_size, 1)
+
+    @staticmethod
+    def _recount(session: Session, gif_ids=None) -> int:
+        """Recalcula vote_count desde la tabla votes"""
+        real_count = (
+            select(func.count(Vote.id)).where(Vote.gif_id == Gif.id).scalar_subquery()
+        )
+        stmt = update(Gif).where(Gif.vote_count != real_count)
+        if gif_ids is not None:
+            stmt = stmt.where(Gif.id.in_(gif_ids))
+        return session.execute(stmt.values(vote_count=real_count)).rowcount
+
+    def recount_votes(self) -> int:
+        """Repara los contadores de votos. Devuelve cuántos GIFs se han corregido"""
+        with self.Session() as session:
+            fixed = self._recount(session)
+            session.commit()
+            self.invalidate_leaderboard()
+            return fixed
+
+    # --------------------
+    # VILLANCICOS
+    # --------------------
+    def get_carol_file_ids(self) -> Dict[str, str]:
+        """Devuelve los file_id de Telegram de los villancicos ya subidos"""
+        with self.Session() as session:
+            return dict(session.query(Carol.filename, Carol.file_id).all())
+
+    def set_carol_file_id(self, filename: str, file_id: str):
+        """Guarda el file_id de Telegram de un villancico"""
+        stmt = self.insert(Carol.__table__).values(filename=filename, file_id=file_id)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Carol.filename], set_={"file_id": stmt.excluded.file_id}
+        )
+        with self.Session() as session:
+            session.execute(stmt)
+            session.commit()
+
+    # --------------------
+    # IMPORTAR / EXPORTAR
+    # --------------------
+    def iter_rows(self, table, batch_size: int = 10_000) -> Iterator[Dict[str, Any]]:
+        """Recorre una tabla por id en lotes, sin cargarla entera en memoria"""
+        with self.engine.connect() as connection:
+            result = connection.execution_options(yield_per=batch_size).execute(
+                select(table).order_by(table.c.id)
+            )
+            for row in result.mappings():
+                yield dict(row)
+
+    def insert_rows(self, table, rows: List[Dict[str, Any]]) -> int:
+        """Inserta un lote de filas en una transacción con executemany.
+
+        Las filas que chocan con una clave existente se ignoran. Devuelve
+        cuántas se han insertado.
+        """
+        if not rows:
+            return 0
+        # Compilar una vez y pasar las filas tal cual al executemany del
+        # driver: construir los parámetros fila a fila es la mitad del coste
+        compiled = (
+            self.insert(table)
+            .on_conflict_do_nothing()
+            .compile(dialect=self.engine.dialect, column_keys=list(rows[0]))
+        )
+        if compiled.positional:
+            params = [tuple(row[key] for key in compiled.positiontup) for row in rows]
+        else:
+            params = rows
+        with self.engine.begin() as connection:
+            return connection.exec_driver_sql(compiled.string, params).rowcount
+
+    @contextmanager
+    def deferred_indexes(self, table):
+        """Carga masiva en una tabla vacía sin sus índices no únicos.
+
+        Los índices se borran al empezar y se crean al terminar: construirlos
+        de una vez es varias veces más rápido que mantenerlos fila a fila.
+        """
+        with self.engine.connect() as connection:
+            empty = connection.execute(select(table.c.id).limit(1)).first() is None
+        indexes = (
+            [index for index in table.indexes if not index.unique] if empty else []
+        )
+        with self.engine.begin() as connection:
+            for index in indexes:
+                index.drop(connection, checkfirst=True)
+        try:
+            yield
+        finally:
+            with self.engine.begin() as connection:
+                for index in indexes:
+                    index.create(connection, checkfirst=True)
+
+    def reset_sequence(self, table, archive=None):
+        """Tras insertar ids explícitos, los nuevos deben seguir al mayor de la
+        tabla y de su `archive`: si no, repetirían ids ya archivados"""
+        dialect = self.engine.dialect.name
+        autoincrement = table.dialect_options["sqlite"]["autoincrement"]
+        if dialect != "postgresql" and not (dialect == "sqlite" and autoincrement):
+            return
+        params = {"table": table.name}
+        with self.engine.begin() as connection:
+            params["id"] = max(
+                connection.scalar(select(func.coalesce(func.max(t.c.id), 0)))
+                for t in (table, archive)
+                if t is not None
+            )
+            if dialect == "postgresql":
+                connection.execute(
+                    text(
+                        "SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                        ":id + 1, false)"
+                    ),
+                    params,
+                )
+                return
+            # Con AUTOINCREMENT, SQLite sigue al mayor id que guarda en
+            # sqlite_sequence, que solo tiene fila si ya se ha insertado algo
+            connection.execute(
+                text(
+                    "UPDATE sqlite_sequence SET seq = MAX(seq, :id) "
+                    "WHERE name = :table"
+                ),
+                params,
+            )
+            connection.execute(
+                text(
+                    "INSERT INTO sqlite_sequence (name, seq) SELECT :table, :id "
+                    "WHERE NOT EXISTS "
+                    "(SELECT 1 FROM sqlite_sequence WHERE name = :table)"
+                ),
+                params,
+            )
+
+    # --------------------
+    # ESTADO DEL BOT
+    # --------------------
+    def get_states(self, kind: str) -> Dict[str, str]:
+        """Devuelve {key: data} del estado guardado de un tipo"""
+        with self.Session() as session:
+            return dict(
+                session.query(BotState.key, BotState.data)
+                .filter(BotState.kind == kind)
+                .all()
+            )
+
+    def set_states(self, kind: str, states: Dict[str, str | None]):
+        """Guarda el estado de varias claves; `None` borra la clave"""
+        stored = [
+            {"kind": kind, "key": key, "data": data}
+            for key, data in states.items()
+            if data is not None
+        ]
+        deleted = [key for key, data in states.items() if data is None]
+        stmt = self.insert(BotState.__table__)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[BotState.kind, BotState.key],
+            set_={"data": stmt.excluded.data},
+        )
+        with self.Session() as session:
+            if stored:
+                session.execute(stmt, stored)
+            if deleted:
+                session.execute(
+                    delete(BotState).where(
+                        BotState.kind == kind, BotState.key.in_(deleted)
+                    )
+                )
+            session.commit()
+
     # --------------------
     # UTILIDADES
     # --------------------
-    def get_user_info(self, telegram_id: int) -> Dict[str, Any]:
-        """Obtiene información del usuario"""
-        user = self.session.query(User).filter_by(telegram_id=telegram_id).first()
-        if not user:
-            return {"exists": False}
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _user_info_query():
+        """Usuario, su GIF, votos dados, puesto y total de GIFs.
 
-        gif = self.session.query(Gif).filter_by(user_id=user.id).first()
+        Se construye una vez: armar la consulta cuesta más que ejecutarla.
+        """
+        contest_id = bindparam("contest_id", type_=Integer)
+        ahead = aliased(Gif)
         votes_given = (
-            self.session.query(func.count(Vote.id)).filter_by(voter_id=user.id).scalar()
-            or 0
+            select(func.count(Vote.id))
+            .where(Vote.contest_id == contest_id, Vote.voter_id == User.id)
+            .scalar_subquery()
+        )
+        rank = (
+            select(func.count(ahead.id) + 1)
+            .where(ahead.contest_id == contest_id, ahead.vote_count > Gif.vote_count)
+            .scalar_subquery()
+        )
+        total_gifs = (
+            select(func.count(ahead.id))
+            .where(ahead.contest_id == contest_id)
+            .scalar_subquery()
         )
+        return (
+            select(
+                User.id.label("db_id"),
+                User.username,
+                Gif.id.label("gif_id"),
+                Gif.file_id,
+                Gif.vote_count.label("votes_received"),
+                votes_given.label("votes_given"),
+                rank.label("rank"),
+                total_gifs.label("total_gifs"),
+            )
+            .outerjoin(Gif, (Gif.user_id == User.id) & (Gif.contest_id == contest_id))
+            .where(User.telegram_id == bindparam("telegram_id", type_=BigInteger))
+            .limit(1)
+        )
+
+    def get_user_info(self, telegram_id: int) -> Dict[str, Any]:
+        """Información y estadísticas del usuario en una sola consulta.
+
+        Los votos recibidos salen del contador gifs.vote_count y el puesto se
+        calcula como en el ranking (los empates comparten puesto), contando
+        con ix_gifs_contest_ranking los GIFs con más votos.
+        """
+        with self.engine.connect() as connection:
+            row = (
+                connection.execute(
+                    self._user_info_query(),
+                    {"telegram_id": telegram_id, "contest_id": self.contest_id},
+                )
+                .mappings()
+                .first()
+            )
+        if not row:
+            return {"exists": False}
 
         info = {
             "exists": True,
-            "telegram_id": user.telegram_id,
-            "username": user.username,
-            "db_id": user.id,
-            "has_gif": gif is not None,
-            "votes_given": votes_given,
+            "telegram_id": telegram_id,
+            "username": row["username"],
+            "db_id": row["db_id"],
+            "has_gif": row["gif_id"] is not None,
+            "votes_given": row["votes_given"],
+            "total_gifs": row["total_gifs"],
         }
-
-        if gif:
-            votes_received = (
-                self.session.query(func.count(Vote.id))
-                .filter_by(gif_id=gif.id)
-                .scalar()
-                or 0
-            )
+        if info["has_gif"]:
             info.update(
                 {
-                    "gif_id": gif.id,
-                    "file_id": gif.file_id,
-                    "votes_received": votes_received,
+                    "gif_id": row["gif_id"],
+                    "file_id": row["file_id"],
+                    "votes_received": row["votes_received"],
+                    "rank": row["rank"],
                 }
             )
-
         return info
+
+
+class AsyncChristmasDB:
+    """Versión asíncrona de ChristmasDB para usar desde los handlers.
+
+    Cada llamada se ejecuta en un pool de hilos acotado, de modo que un commit
+    lento de SQLite no bloquea el event loop de python-telegram-bot. Cada
+    operación abre su propia sesión, así que los hilos no comparten transacción.
+    """
+
+    def __init__(
+        self,
+        db: ChristmasDB | None = None,
+        max_workers: int = 4,
+        factory: Callable[[], ChristmasDB] = ChristmasDB,
+    ):
+        # Sin `db`, se crea con `factory` (engine y migraciones) en el primer
+        # uso o al llamar a preload(), no al importar el módulo
+        self._db = db
+        self._factory = factory
+        self._db_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="christmas-db"
+        )
+
+    @property
+    def db(self) -> ChristmasDB:
+        if self._db is None:
+            with self._db_lock:
+                if self._db is None:
+                    self._db = self._factory()
+        return self._db
+
+    @property
+    def ready(self) -> bool:
+        """Si la BD ya está creada"""
+        return self._db is not None
+
+    def preload(self):
+        """Crea la BD en segundo plano, en paralelo al arranque del bot"""
+        self.executor.submit(lambda: self.db.contest_id)
+
+    def _call(self, func, *args, **kwargs):
+        # Se ejecuta en el hilo del pool: las métricas SQL se atribuyen al método
+        with track_db_method(func.__name__):
+            return func(self.db, *args, **kwargs)
+
+    async def _run(self, func, *args, **kwargs):
+        """Ejecuta el método `func` de ChristmasDB en el pool de hilos"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, partial(self._call, func, *args, **kwargs)
+        )
+
+    async def add_user(self, telegram_id: int, username: str) -> CachedUser:
+        return await self._run(ChristmasDB.add_user, telegram_id, username)
+
+    async def add_gif(
+        self,
+        telegram_id: int,
+        username: str,
+        message_id: int,
+        file_id: str,
+        file_unique_id: str | None = None,
+        phash: int | None = None,
+    ) -> Gif:
+        return await self._run(
+            ChristmasDB.add_gif,
+            telegram_id,
+            username,
+            message_id,
+            file_id,
+            file_unique_id,
+            phash,
+        )
+
+    async def find_gif_by_unique_id(self, file_unique_id: str) -> int | None:
+        return await self._run(ChristmasDB.find_gif_by_unique_id, file_unique_id)
+
+    async def get_gif_hashes(self, after_id: int = 0) -> List[Tuple[int, int]]:
+        return await self._run(ChristmasDB.get_gif_hashes, after_id)
+
+    async def has_user_submitted_gif(self, telegram_id: int) -> bool:
+        return await self._run(ChristmasDB.has_user_submitted_gif, telegram_id)
+
+    async def get_gif(self, gif_id: int) -> Gif | None:
+        return await self._run(ChristmasDB.get_gif, gif_id)
+
+    async def vote_gif(
+        self, telegram_id: int, username: str, gif_id: int
+    ) -> VoteResult:
+        return await self._run(ChristmasDB.vote_gif, telegram_id, username, gif_id)
+
+    async def add_votes(self, votes: List[Tuple[int, str, int]]) -> int:
+        return await self._run(ChristmasDB.add_votes, votes)
+
+    async def get_gif_owner(self, gif_id: int) -> int | None:
+        return await self._run(ChristmasDB.get_gif_owner, gif_id)
+
+    async def get_voted_gif_ids(self, telegram_id: int) -> Set[int]:
+        return await self._run(ChristmasDB.get_voted_gif_ids, telegram_id)
+
+    async def count_votable_gifs(
+        self, telegram_id: int, exclude: Collection[int] = ()
+    ) -> int:
+        return await self._run(ChristmasDB.count_votable_gifs, telegram_id, exclude)
+
+    async def get_votable_gifs_page(
+        self,
+        telegram_id: int,
+        after_id: int | None = None,
+        before_id: int | None = None,
+        limit: int = 10,
+        exclude: Collection[int] = (),
+    ) -> List[Tuple[int, str]]:
+        return await self._run(
+            ChristmasDB.get_votable_gifs_page,
+            telegram_id,
+            after_id,
+            before_id,
+            limit,
+            exclude,
+        )
+
+    async def get_leaderboard(self, top: int = 10) -> List[Dict[str, Any]]:
+        return await self._run(ChristmasDB.get_leaderboard, top)
+
+    async def get_leaderboard_entries(
+        self, gif_ids: Collection[int]
+    ) -> List[Dict[str, Any]]:
+        return await self._run(ChristmasDB.get_leaderboard_entries, gif_ids)
+
+    async def get_ranking_page(
+        self, page: int, page_size: int = 10
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        return await self._run(ChristmasDB.get_ranking_page, page, page_size)
+
+    async def recount_votes(self) -> int:
+        return await self._run(ChristmasDB.recount_votes)
+
+    async def get_carol_file_ids(self) -> Dict[str, str]:
+        return await self._run(ChristmasDB.get_carol_file_ids)
+
+    async def set_carol_file_id(self, filename: str, file_id: str):
+        return await self._run(ChristmasDB.set_carol_file_id, filename, file_id)
+
+    async def get_states(self, kind: str) -> Dict[str, str]:
+        return await self._run(ChristmasDB.get_states, kind)
+
+    async def set_states(self, kind: str, states: Dict[str, str | None]):
+        return await self._run(ChristmasDB.set_states, kind, states)
+
+    async def get_user_info(self, telegram_id: int) -> Dict[str, Any]:
+        return await self._run(ChristmasDB.get_user_info, telegram_id)
+
+    def close(self):
+        """Espera a que terminen las operaciones pendientes"""
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,150 @@
+"""Detección de GIFs repetidos por hash perceptual.
+
+Telegram da un file_id distinto a cada subida del mismo fichero, pero el
+mismo file_unique_id: eso ya lo descarta la BD. Este módulo cubre el caso de
+un GIF recortado, reescalado o recomprimido, que llega como un fichero nuevo.
+
+Se descarga la miniatura (o el propio GIF si no tiene), se calcula un dHash de
+64 bits de sus primeros fotogramas en un pool de procesos, fuera del event
+loop, y se busca en un índice en memoria con los hashes de los GIFs del
+concurso, que antes de cada búsqueda se completa con los que han llegado a la
+BD desde otros workers. Necesita Pillow; sin él, available() devuelve False y
+el bot solo usa file_unique_id.
+"""
+
+import asyncio
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    from PIL import Image, ImageSequence
+except ImportError:  # Pillow es opcional
+    Image = None
+
+# Lado de la imagen reducida: (HASH_SIZE + 1) x HASH_SIZE -> 64 bits
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+# Bandas del índice: el umbral de bits distintos tiene que ser menor
+INDEX_BANDS = 8
+MAX_THRESHOLD = INDEX_BANDS - 1
+
+Downloader = Callable[[str], Awaitable[bytes]]
+
+
+def available() -> bool:
+    """Si está instalado Pillow"""
+    return Image is not None
+
+
+def dhash(data: bytes, frames: int = 3) -> int:
+    """dHash de la media en gris de los primeros `frames` fotogramas.
+
+    Cada bit indica si un píxel es más claro que el de su derecha en la imagen
+    reducida a 9x8, así que no cambia al reescalar o recomprimir. Se ejecuta
+    en los procesos del pool.
+    """
+    size = (HASH_SIZE + 1, HASH_SIZE)
+    total = [0] * (size[0] * size[1])
+    count = 0
+    with Image.open(io.BytesIO(data)) as image:
+        for frame in ImageSequence.Iterator(image):
+            small = frame.convert("L").resize(size, Image.Resampling.LANCZOS)
+            total = [a + b for a, b in zip(total, small.tobytes())]
+            count += 1
+            if count == frames:
+                break
+
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = total[row * size[0] + col]
+            right = total[row * size[0] + col + 1]
+            value = value << 1 | (left > right)
+    return value
+
+
+def to_signed(value: int) -> int:
+    """Hash de 64 bits sin signo -> BIGINT con signo de la BD"""
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def to_unsigned(value: int) -> int:
+    return value & ((1 << HASH_BITS) - 1)
+
+
+class HashIndex:
+    """Hashes de los GIFs del concurso para buscar los parecidos.
+
+    Se parte cada hash en `bands` bandas de bits. Si dos hashes difieren en
+    menos de `bands` bits, al menos una banda es idéntica, así que basta con
+    comparar con los que comparten alguna banda en vez de con todos.
+    """
+
+    def __init__(self, threshold: int = 6, bands: int = INDEX_BANDS):
+        if threshold >= bands:
+            raise ValueError(f"El umbral debe ser menor que {bands}")
+        self.threshold = threshold
+        self.bands = bands
+        self.band_bits = HASH_BITS // bands
+        self._buckets: List[Dict[int, List[Tuple[int, int]]]] = [
+            {} for _ in range(bands)
+        ]
+        self._ids: Set[int] = set()
+        # Mayor gif_id del índice
+        self.last_id = 0
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def _keys(self, phash: int) -> Iterable[Tuple[int, int]]:
+        mask = (1 << self.band_bits) - 1
+        for band in range(self.bands):
+            yield band, phash >> (band * self.band_bits) & mask
+
+    def add(self, gif_id: int, phash: int):
+        """Añade un GIF; si ya estaba en el índice no hace nada"""
+        if gif_id in self._ids:
+            return
+        for band, key in self._keys(phash):
+            self._buckets[band].setdefault(key, []).append((gif_id, phash))
+        self._ids.add(gif_id)
+        self.last_id = max(self.last_id, gif_id)
+
+    def find(self, phash: int) -> Optional[int]:
+        """GIF más parecido a `phash` dentro del umbral, o None"""
+        best: Optional[Tuple[int, int]] = None
+        for band, key in self._keys(phash):
+            for gif_id, other in self._buckets[band].get(key, ()):
+                distance = (phash ^ other).bit_count()
+                if distance <= self.threshold and (best is None or distance < best[0]):
+                    best = (distance, gif_id)
+        return best[1] if best else None
+
+
+class PerceptualDedup:
+    """Descarga, hash en el pool de procesos e índice de los GIFs ya enviados"""
+
+    def __init__(
+        self, downloader: Downloader, threshold: int = 6, max_workers: int = 2
+    ):
+        self.downloader = downloader
+        self.index = HashIndex(threshold)
+        # spawn: el proceso del bot tiene hilos y un event loop en marcha
+        self.executor = ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def load(self, hashes: Iterable[Tuple[int, int]]):
+        """Carga los (gif_id, phash) de la BD que aún no están en el índice"""
+        for gif_id, phash in hashes:
+            self.index.add(gif_id, to_unsigned(phash))
+
+    async def hash_file(self, file_id: str) -> int:
+        data = await self.downloader(file_id)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, dhash, data)
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
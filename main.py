@@ -1,16 +1,21 @@
+import asyncio
 import logging
 import os
 import random
+from functools import partial
 from pathlib import Path
-from typing import Optional
+from typing import Dict, List, NamedTuple, Optional
 
 from telegram import (
+    Bot,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     InputMediaAnimation,
     Update,
 )
+from telegram.error import BadRequest
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CallbackQueryHandler,
     CommandHandler,
@@ -20,15 +25,101 @@ from telegram.ext import (
     filters,
 )
 
-from controllers import ChristmasDB
+import dedup
+from controllers import AsyncChristmasDB, ChristmasDB, VoteResult
+from metrics import StatsGauge, timed_handler
+from models import DEFAULT_CONTEST
+from persistence import DBPersistence
+from rate_limiter import OutboundScheduler
+from update_processor import SequentialUpdateProcessor
+from vote_buffer import VoteBuffer
+from vote_journal import VoteJournal
+from webserver import run_queue_webhook, run_webhook
+from work_queue import WorkerSupervisor, WorkQueue, run_worker
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
-DB = ChristmasDB()
+# Con WORKERS > 0 el webhook solo encola y N procesos worker procesan las
+# actualizaciones, repartidas por usuario
+WORKERS = int(os.getenv("WORKERS", "0"))
+# DB_PROFILE=production activa WAL y el resto de PRAGMAs de SQLITE_PROFILES.
+# Con WORKERS es obligatorio: sin WAL ni busy_timeout, varios procesos que
+# escriben en la misma BD SQLite fallan con "database is locked"
+DB_PROFILE = "production" if WORKERS else os.getenv("DB_PROFILE", "default")
+# La BD se crea en segundo plano al arrancar (DB.preload), no al importar.
+# CONTEST elige el concurso en curso; los demás no se ven ni se pueden votar
+DB = AsyncChristmasDB(
+    factory=partial(
+        ChristmasDB,
+        os.getenv("DATABASE_URL", "sqlite:///db.sqlite"),
+        profile=DB_PROFILE,
+        contest=os.getenv("CONTEST", DEFAULT_CONTEST),
+    )
+)
+# Con VOTE_JOURNAL=<directorio> cada voto se confirma al escribirse en un
+# diario en disco y la BD se actualiza por lotes (cada 5 s por defecto)
+VOTE_JOURNAL = os.getenv("VOTE_JOURNAL", "")
+# Con VOTE_BUFFER_MS > 0 los votos se escriben por lotes cada N milisegundos
+VOTE_BUFFER_MS = int(os.getenv("VOTE_BUFFER_MS", "5000" if VOTE_JOURNAL else "0"))
+VOTES = (
+    VoteBuffer(
+        DB,
+        flush_interval=VOTE_BUFFER_MS / 1000,
+        journal=VoteJournal(VOTE_JOURNAL) if VOTE_JOURNAL else None,
+    )
+    if VOTE_BUFFER_MS
+    else DB
+)
+QUEUE_URL = os.getenv("QUEUE_URL", "sqlite:///queue.sqlite")
+# Cada worker tiene su planificador: el límite global se reparte entre ellos
+SCHEDULER = OutboundScheduler(global_rate=30 / max(WORKERS, 1))
+# Actualizaciones de usuarios distintos procesadas a la vez (las de un mismo
+# usuario siempre en orden)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+# user_data y conversaciones en la BD: sobreviven a reinicios y entre workers
+PERSISTENCE = DBPersistence(DB)
 TOKEN = os.getenv("TELEGRAM_TOKEN", "")
 WAITING_FOR_GIF = 1
+RANKING_PAGE_SIZE = 10
+CAROLS_DIR = Path("files/")
+CAROLS: List[Path] = []
+CAROL_FILE_IDS: Dict[str, str] = {}
+CAROLS_LOADED: Optional[asyncio.Task] = None
+# Con Pillow instalado se rechazan los GIFs casi iguales a uno del concurso:
+# hasta PHASH_THRESHOLD bits distintos de dHash (-1 lo desactiva)
+PHASH_THRESHOLD = int(os.getenv("PHASH_THRESHOLD", "6"))
+if PHASH_THRESHOLD > dedup.MAX_THRESHOLD:
+    logger.warning(
+        f"PHASH_THRESHOLD={PHASH_THRESHOLD} supera el máximo del índice de"
+        f" hashes; se usa {dedup.MAX_THRESHOLD}"
+    )
+    PHASH_THRESHOLD = dedup.MAX_THRESHOLD
+# Al completar el índice se vuelven a pedir los últimos ids: en PostgreSQL
+# los GIFs de otros workers pueden confirmarse con ids desordenados
+HASH_REFRESH_OVERLAP = 100
+DEDUP: Optional[dedup.PerceptualDedup] = None
+DEDUP_LOADED: Optional[asyncio.Task] = None
+VOTE_ERRORS = {
+    VoteResult.DUPLICATE: "❌ Ya has votado este GIF",
+    VoteResult.OWN_GIF: "❌ No puedes votar tu propio GIF",
+    VoteResult.MISSING_GIF: "❌ Este GIF ya no existe",
+}
+
+
+# Estadísticas de las cachés y del planificador en /metrics (sin crear la BD)
+StatsGauge(
+    "bot_leaderboard_cache",
+    "Caché del ranking",
+    lambda: DB.db.leaderboard_stats if DB.ready else {},
+)
+StatsGauge(
+    "bot_user_cache",
+    "Caché de usuarios",
+    lambda: DB.db.user_cache_stats if DB.ready else {},
+)
+StatsGauge("bot_telegram_scheduler", "Envíos a Telegram", lambda: SCHEDULER.stats)
 
 
 # ------------------ Utilidades ------------------
@@ -45,6 +136,7 @@ def escape_md2(text: str) -> str:
 # ------------------ Comandos ------------------
 
 
+@timed_handler
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     mensaje = escape_md2(
         """
@@ -56,26 +148,77 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /mandar_meme - Mandar meme al ranking
 /votaciones - Da tu voto por el mejor meme
 /ranking - Ver el ranking de los mejores memes
+/ranking <página> - Ver el ranking completo por páginas
+/mis_stats - Tu meme, tus votos y tu puesto
 """
     )
     await update.message.reply_text(mensaje, parse_mode="MarkdownV2")
 
 
+@timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("¡Hola! Bienvenido al bot 🎄")
     await help_command(update, context)
 
 
+async def load_carols():
+    """Escanea files/ una vez y carga los file_id ya subidos a Telegram"""
+    CAROLS[:] = sorted(
+        f for f in CAROLS_DIR.iterdir() if f.is_file() and f.suffix == ".ogg"
+    )
+    CAROL_FILE_IDS.update(await DB.get_carol_file_ids())
+
+
+def failed(task: Optional[asyncio.Task]) -> bool:
+    """Si una tarea de carga terminó con error o cancelada"""
+    return (
+        task is not None
+        and task.done()
+        and (task.cancelled() or task.exception() is not None)
+    )
+
+
+def log_failure(task: asyncio.Task):
+    """Registra el error de una tarea de carga: se relanza en el siguiente uso"""
+    if failed(task) and not task.cancelled():
+        logger.error(f"Falló la {task.get_name()}: {task.exception()}")
+
+
+def carols_task() -> asyncio.Task:
+    """Tarea que carga el catálogo; se lanza al arrancar y, si falla, de
+    nuevo en el siguiente /villancico"""
+    global CAROLS_LOADED
+    if CAROLS_LOADED is None or failed(CAROLS_LOADED):
+        CAROLS_LOADED = asyncio.create_task(load_carols(), name="carga de villancicos")
+        CAROLS_LOADED.add_done_callback(log_failure)
+    return CAROLS_LOADED
+
+
+@timed_handler
 async def carol(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ruta = Path("files/")
     try:
-        archivos_ogg = [f for f in ruta.iterdir() if f.is_file() and f.suffix == ".ogg"]
-        if not archivos_ogg:
+        # El primer /villancico puede llegar antes de que termine la carga
+        await asyncio.shield(carols_task())
+        if not CAROLS:
             await update.message.reply_text("❌ No hay villancicos disponibles.")
             return
-        file = random.choice(archivos_ogg)
+        file = random.choice(CAROLS)
+
+        # Reutilizar el file_id si ya se subió antes
+        file_id = CAROL_FILE_IDS.get(file.name)
+        if file_id:
+            try:
+                await update.message.reply_voice(file_id)
+                return
+            except BadRequest as e:
+                print(f"file_id caducado para {file.name}: {str(e)}")
+                CAROL_FILE_IDS.pop(file.name, None)
+
         with open(file, "rb") as voice:
-            await update.message.reply_voice(voice)
+            message = await update.message.reply_voice(voice)
+        if message.voice:
+            CAROL_FILE_IDS[file.name] = message.voice.file_id
+            await DB.set_carol_file_id(file.name, message.voice.file_id)
     except Exception as e:
         await update.message.reply_text(f"❌ Error al cargar villancicos: {str(e)}")
 
@@ -83,12 +226,13 @@ async def carol(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ------------------ Envío de memes ------------------
 
 
+@timed_handler
 async def send_meme_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     telegram_id = user.id
 
     # Verificar si ya ha subido un GIF
-    if DB.has_user_submitted_gif(telegram_id):
+    if await DB.has_user_submitted_gif(telegram_id):
         await update.message.reply_text(
             "❌ Ya has enviado un GIF. Solo se permite un GIF por persona."
         )
@@ -101,6 +245,7 @@ async def send_meme_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return WAITING_FOR_GIF
 
 
+@timed_handler
 async def receive_meme(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     telegram_id = user.id
@@ -108,30 +253,55 @@ async def receive_meme(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message_id = update.message.message_id
 
     # Verificar si ya ha subido un GIF (por si acaso)
-    if DB.has_user_submitted_gif(telegram_id):
+    if await DB.has_user_submitted_gif(telegram_id):
         await update.message.reply_text("❌ Ya has enviado un GIF anteriormente.")
         return ConversationHandler.END
 
-    # Obtener file_id según el tipo de mensaje
-    file_id: Optional[str] = None
+    # Obtener el fichero según el tipo de mensaje
+    media = None
     if update.message.animation:
-        file_id = update.message.animation.file_id
+        media = update.message.animation
     elif update.message.document and update.message.document.mime_type == "image/gif":
-        file_id = update.message.document.file_id
+        media = update.message.document
 
-    if not file_id:
+    if not media:
         await update.message.reply_text(
             "❌ Por favor envía un GIF válido (como animación o documento GIF)."
         )
         return WAITING_FOR_GIF
 
+    # El mismo fichero reenviado: mismo file_unique_id aunque cambie el file_id
+    if await DB.find_gif_by_unique_id(media.file_unique_id) is not None:
+        await update.message.reply_text(
+            "❌ Ese GIF ya está en el concurso. Envía otro o usa /cancel."
+        )
+        return WAITING_FOR_GIF
+
+    phash = await perceptual_hash(media) if DEDUP else None
+    if phash is not None:
+        # Los GIFs que han recibido otros workers desde la última búsqueda
+        try:
+            await load_gif_hashes()
+        except Exception as e:
+            print(f"No se pudo actualizar el índice de hashes: {str(e)}")
+    if phash is not None and DEDUP.index.find(phash) is not None:
+        await update.message.reply_text(
+            "❌ Ese GIF es casi igual a uno que ya está en el concurso. "
+            "Envía otro o usa /cancel."
+        )
+        return WAITING_FOR_GIF
+
     try:
-        DB.add_gif(
+        gif = await DB.add_gif(
             telegram_id=telegram_id,
             username=username or "",
             message_id=message_id,
-            file_id=file_id,
+            file_id=media.file_id,
+            file_unique_id=media.file_unique_id,
+            phash=None if phash is None else dedup.to_signed(phash),
         )
+        if phash is not None:
+            DEDUP.index.add(gif.id, phash)
         await update.message.reply_text("✅ GIF recibido. ¡Suerte en las votaciones!")
     except ValueError as e:
         await update.message.reply_text(f"❌ {str(e)}")
@@ -141,6 +311,60 @@ async def receive_meme(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+async def download_file(bot: Bot, file_id: str) -> bytes:
+    file = await bot.get_file(file_id)
+    return bytes(await file.download_as_bytearray())
+
+
+async def load_gif_hashes():
+    """Carga en el índice de DEDUP los hashes de los GIFs ya enviados.
+
+    La primera vez los carga todos y después solo los de los GIFs nuevos.
+    """
+    after_id = max(DEDUP.index.last_id - HASH_REFRESH_OVERLAP, 0)
+    DEDUP.load(await DB.get_gif_hashes(after_id))
+
+
+def dedup_task() -> asyncio.Task:
+    """Tarea que carga el índice de hashes; se lanza al arrancar y, si falla,
+    de nuevo en el siguiente GIF"""
+    global DEDUP_LOADED
+    if DEDUP_LOADED is None or failed(DEDUP_LOADED):
+        DEDUP_LOADED = asyncio.create_task(
+            load_gif_hashes(), name="carga del índice de hashes"
+        )
+        DEDUP_LOADED.add_done_callback(log_failure)
+    return DEDUP_LOADED
+
+
+async def perceptual_hash(media) -> Optional[int]:
+    """dHash de la miniatura del GIF, o None si no se puede calcular.
+
+    Las animaciones llegan como MP4, que Pillow no lee: se usa su miniatura
+    (JPEG del primer fotograma) y el propio fichero solo si es un GIF.
+    """
+    if media.thumbnail:
+        file_id = media.thumbnail.file_id
+    elif getattr(media, "mime_type", None) == "image/gif":
+        file_id = media.file_id
+    else:
+        return None
+    try:
+        # El índice tiene que estar cargado antes de buscar en él
+        await asyncio.shield(dedup_task())
+        return await DEDUP.hash_file(file_id)
+    except Exception as e:
+        # Sin hash el GIF se acepta: solo queda la comprobación exacta
+        print(f"No se pudo calcular el hash de {media.file_id}: {str(e)}")
+        return None
+
+
+async def ask_for_gif(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Sin devolver estado: la conversación sigue esperando el GIF
+    await update.message.reply_text("❌ Por favor envía un GIF.")
+
+
+@timed_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ Envío cancelado.")
     return ConversationHandler.END
@@ -149,31 +373,92 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ------------------ Carrusel de votación ------------------
 
 
+class Carousel(NamedTuple):
+    """Estado del carrusel de votación de un usuario en user_data.
+
+    Un cursor sobre los GIFs votables: el GIF actual, su posición y el total.
+    El resto se pide a la BD según se navega. DBPersistence lo guarda como un
+    array JSON de cinco elementos.
+    """
+
+    gif_id: int
+    file_id: str
+    position: int
+    total: int
+    has_next: bool
+
+
+def get_carousel(context: ContextTypes.DEFAULT_TYPE) -> Optional[Carousel]:
+    state = context.user_data.get("carousel")
+    # Tras un reinicio llega de la persistencia como lista
+    return Carousel(*state) if state else None
+
+
+@timed_handler
 async def show_memes_to_vote(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     telegram_id = user.id
     username = user.username or ""
 
-    gifs = DB.get_votable_gifs(telegram_id, username)
-
-    if not gifs:
-        await update.message.reply_text("❌ No hay memes para votar.")
-        return
+    await DB.add_user(telegram_id, username)
+    total = await VOTES.count_votable_gifs(telegram_id)
 
     # Limpiar datos anteriores
     context.user_data.clear()
-    context.user_data["votable_gifs"] = gifs
-    context.user_data["current_index"] = 0
+
+    if not total or not await load_votable_gif(context, telegram_id, 1, total):
+        await update.message.reply_text("❌ No hay memes para votar.")
+        return
 
     await send_current_gif(update, context)
 
 
-async def send_current_gif(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def load_votable_gif(
+    context: ContextTypes.DEFAULT_TYPE,
+    telegram_id: int,
+    position: int,
+    total: int,
+    after_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+) -> bool:
+    """Mueve el carrusel al GIF votable siguiente (o anterior) a un id"""
+    if before_id is not None:
+        page = await VOTES.get_votable_gifs_page(
+            telegram_id, before_id=before_id, limit=1
+        )
+        has_next = True
+    else:
+        # Pedir uno más para saber si hay siguiente
+        page = await VOTES.get_votable_gifs_page(
+            telegram_id, after_id=after_id, limit=2
+        )
+        has_next = len(page) > 1
+
+    if not page:
+        return False
+
+    gif_id, file_id = page[0]
+    context.user_data["carousel"] = Carousel(gif_id, file_id, position, total, has_next)
+    return True
+
+
+def clear_votable_gifs(context: ContextTypes.DEFAULT_TYPE):
+    """Borra el estado del carrusel de votación"""
+    context.user_data.pop("carousel", None)
+
+
+async def send_current_gif(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> Optional[str]:
+    """Muestra el GIF actual del carrusel.
+
+    No responde al callback_query: devuelve el aviso con el que debe
+    responderlo quien lo llama, si no ha podido mostrarse en el mensaje.
+    """
     try:
-        index = context.user_data.get("current_index", 0)
-        gifs = context.user_data.get("votable_gifs", [])
+        carousel = get_carousel(context)
 
-        if not gifs or index >= len(gifs) or index < 0:
+        if not carousel:
             # Limpiar datos y enviar mensaje final
             context.user_data.clear()
 
@@ -186,32 +471,30 @@ async def send_current_gif(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     "✅ Has votado todos los memes disponibles."
                 )
             elif update.callback_query:
-                await update.callback_query.answer(
-                    "✅ Has votado todos los memes disponibles.", show_alert=True
-                )
-            return
+                return "✅ Has votado todos los memes disponibles."
+            return None
 
-        gif = gifs[index]
+        gif_id, file_id, position, total, has_next = carousel
 
         # Crear botones
         buttons = []
 
         # Botón para votar
         buttons.append(
-            [InlineKeyboardButton("⭐ Votar", callback_data=f"vote:{gif.id}")]
+            [InlineKeyboardButton("⭐ Votar", callback_data=f"vote:{gif_id}")]
         )
 
         # Botones de navegación
         nav_buttons = []
-        if index > 0:
+        if position > 1:
             nav_buttons.append(InlineKeyboardButton("⬅️ Anterior", callback_data="prev"))
 
         # Contador de posición
         nav_buttons.append(
-            InlineKeyboardButton(f"{index + 1}/{len(gifs)}", callback_data="counter")
+            InlineKeyboardButton(f"{position}/{total}", callback_data="counter")
         )
 
-        if index < len(gifs) - 1:
+        if has_next:
             nav_buttons.append(
                 InlineKeyboardButton("➡️ Siguiente", callback_data="next")
             )
@@ -227,7 +510,7 @@ async def send_current_gif(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 if update.callback_query.message:
                     await update.callback_query.message.edit_media(
                         media=InputMediaAnimation(
-                            media=gif.file_id, caption="🎄 Vota este meme"
+                            media=file_id, caption="🎄 Vota este meme"
                         ),
                         reply_markup=markup,
                     )
@@ -236,7 +519,7 @@ async def send_current_gif(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     if update.callback_query.from_user:
                         await context.bot.send_animation(
                             chat_id=update.callback_query.from_user.id,
-                            animation=gif.file_id,
+                            animation=file_id,
                             caption="🎄 Vota este meme",
                             reply_markup=markup,
                         )
@@ -245,25 +528,22 @@ async def send_current_gif(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # Fallback: enviar nuevo mensaje
                 if update.callback_query.message:
                     await update.callback_query.message.reply_animation(
-                        animation=gif.file_id,
+                        animation=file_id,
                         caption="🎄 Vota este meme",
                         reply_markup=markup,
                     )
                 elif update.callback_query.from_user:
                     await context.bot.send_animation(
                         chat_id=update.callback_query.from_user.id,
-                        animation=gif.file_id,
+                        animation=file_id,
                         caption="🎄 Vota este meme",
                         reply_markup=markup,
                     )
 
-            # Siempre responder al callback_query
-            await update.callback_query.answer()
-
         else:
             # Mensaje nuevo desde comando
             await update.message.reply_animation(
-                animation=gif.file_id, caption="🎄 Vota este meme", reply_markup=markup
+                animation=file_id, caption="🎄 Vota este meme", reply_markup=markup
             )
 
     except Exception as e:
@@ -277,13 +557,15 @@ async def send_current_gif(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 if update.callback_query.message:
                     await update.callback_query.message.reply_text(error_message)
                 else:
-                    await update.callback_query.answer(error_message, show_alert=True)
+                    return error_message
             except:
                 pass
         elif update.message:
             await update.message.reply_text(error_message)
+    return None
 
 
+@timed_handler
 async def vote_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
 
@@ -291,7 +573,10 @@ async def vote_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not query:
         return
 
-    await query.answer()
+    # Telegram solo admite una respuesta por callback: se da al final, con el
+    # aviso que haya dejado cada rama (sin texto solo quita el "cargando")
+    alert = None
+    notice = None
     data = query.data
 
     if data.startswith("vote:"):
@@ -299,86 +584,159 @@ async def vote_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             gif_id = int(data.split(":")[1])
 
             # Votar en la base de datos
-            vote_result = DB.vote_gif(
+            vote_result = await VOTES.vote_gif(
                 query.from_user.id, query.from_user.username, gif_id
             )
 
-            if not vote_result:
-                await query.answer("❌ No puedes votar este GIF", show_alert=True)
-                return
-
-            # Obtener datos actuales
-            gifs = context.user_data.get("votable_gifs", [])
-            current_index = context.user_data.get("current_index", 0)
-
-            # Mover al siguiente
-            context.user_data["current_index"] = current_index + 1
-
-            # Actualizar mensaje
-            if context.user_data["current_index"] < len(gifs):
-                # Mostrar siguiente GIF
-                await send_current_gif(update, context)
+            if vote_result is not VoteResult.OK:
+                alert = VOTE_ERRORS[vote_result]
             else:
-                # Mostrar mensaje final
-                try:
-                    if query.message:
-                        await query.message.edit_caption(
-                            caption="✅ ¡Gracias por votar todos los memes! ⭐",
-                            reply_markup=None,
-                        )
-                    else:
-                        await query.answer(
-                            "✅ ¡Gracias por votar todos los memes! ⭐", show_alert=True
-                        )
-                except Exception as edit_error:
-                    # Si no se puede editar, enviar mensaje nuevo
-                    if query.message:
+                # El GIF votado sale de la lista: el siguiente ocupa su posición
+                telegram_id = query.from_user.id
+                carousel = get_carousel(context)
+                position = carousel.position if carousel else 1
+                total = max((carousel.total if carousel else 1) - 1, 0)
+                has_more = await load_votable_gif(
+                    context, telegram_id, position, total, after_id=gif_id
+                )
+                if not has_more and total:
+                    # Quedan GIFs anteriores sin votar: volver al principio
+                    has_more = await load_votable_gif(context, telegram_id, 1, total)
+
+                # Actualizar mensaje
+                if has_more:
+                    # Mostrar siguiente GIF
+                    alert = await send_current_gif(update, context)
+                else:
+                    # Mostrar mensaje final
+                    try:
+                        if query.message:
+                            await query.message.edit_caption(
+                                caption="✅ ¡Gracias por votar todos los memes! ⭐",
+                                reply_markup=None,
+                            )
+                        else:
+                            alert = "✅ ¡Gracias por votar todos los memes! ⭐"
+                    except Exception as edit_error:
+                        # Si no se puede editar, enviar mensaje nuevo
                         await query.message.reply_text(
                             "✅ ¡Gracias por votar todos los memes! ⭐"
                         )
-                    else:
-                        await query.answer(
-                            "✅ ¡Gracias por votar todos los memes! ⭐", show_alert=True
-                        )
 
-                # Limpiar datos
-                context.user_data.pop("votable_gifs", None)
-                context.user_data.pop("current_index", None)
+                    # Limpiar datos
+                    clear_votable_gifs(context)
 
         except Exception as e:
             print(f"Error en vote_callback: {str(e)}")
-            await query.answer("❌ Error al registrar el voto", show_alert=True)
+            alert = "❌ Error al registrar el voto"
 
     elif data in ["next", "prev"]:
         try:
-            gifs = context.user_data.get("votable_gifs", [])
-            current_index = context.user_data.get("current_index", 0)
-
-            if data == "next":
-                new_index = min(current_index + 1, len(gifs) - 1)
-            else:  # prev
-                new_index = max(current_index - 1, 0)
+            carousel = get_carousel(context)
+            if not carousel:
+                alert = await send_current_gif(update, context)
+            else:
+                telegram_id = query.from_user.id
+                if data == "next":
+                    moved = await load_votable_gif(
+                        context,
+                        telegram_id,
+                        carousel.position + 1,
+                        carousel.total,
+                        after_id=carousel.gif_id,
+                    )
+                else:  # prev
+                    moved = await load_votable_gif(
+                        context,
+                        telegram_id,
+                        max(carousel.position - 1, 1),
+                        carousel.total,
+                        before_id=carousel.gif_id,
+                    )
 
-            context.user_data["current_index"] = new_index
-            await send_current_gif(update, context)
+                if moved:
+                    alert = await send_current_gif(update, context)
 
         except Exception as e:
             print(f"Error en navegación: {str(e)}")
-            await query.answer("❌ Error al navegar", show_alert=True)
+            alert = "❌ Error al navegar"
 
     elif data == "counter":
         # Solo responder al callback
-        gifs = context.user_data.get("votable_gifs", [])
-        current_index = context.user_data.get("current_index", 0)
-        await query.answer(f"Posición {current_index + 1}/{len(gifs)}")
+        carousel = get_carousel(context)
+        position, total = (carousel.position, carousel.total) if carousel else (1, 0)
+        notice = f"Posición {position}/{total}"
+
+    if alert:
+        await query.answer(alert, show_alert=True)
+    else:
+        await query.answer(notice)
 
 
 # ------------------ Ranking ------------------
 
 
+def ranking_medal(position: int) -> str:
+    """Emoji según la posición en el ranking"""
+    if position == 1:
+        return "🥇"
+    elif position == 2:
+        return "🥈"
+    elif position == 3:
+        return "🥉"
+    return f"{position}\\."
+
+
+def ranking_caption(leaderboard: list, index: int) -> str:
+    """Resumen del ranking más el detalle de la posición mostrada"""
+    header = "*🏆 Ranking de Memes 🏆*\n\n"
+    ranking_text = []
+
+    for i, entry in enumerate(leaderboard, start=1):
+        username = escape_md2(entry.get("username", "Anónimo"))
+        votes = entry.get("votes", 0)
+        ranking_text.append(f"{ranking_medal(i)} ⭐ *{votes}* \\- {username}")
+
+    entry = leaderboard[index]
+    position = index + 1
+    detail = (
+        f"*Posición {position}*\n"
+        f"{ranking_medal(position)} ⭐ *{entry.get('votes', 0)} votos*\n"
+        f"👤 *Usuario:* {escape_md2(entry.get('username', 'Anónimo'))}"
+    )
+    return header + "\n".join(ranking_text) + "\n\n" + detail
+
+
+def ranking_markup(index: int, total: int) -> InlineKeyboardMarkup:
+    """Botones para moverse por el carrusel del ranking"""
+    nav_buttons = []
+    if index > 0:
+        nav_buttons.append(
+            InlineKeyboardButton("⬅️ Anterior", callback_data=f"rank:{index - 1}")
+        )
+    nav_buttons.append(
+        InlineKeyboardButton(f"{index + 1}/{total}", callback_data="rank:counter")
+    )
+    if index < total - 1:
+        nav_buttons.append(
+            InlineKeyboardButton("➡️ Siguiente", callback_data=f"rank:{index + 1}")
+        )
+    return InlineKeyboardMarkup([nav_buttons])
+
+
+@timed_handler
 async def show_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Envía el ranking en un único mensaje con carrusel"""
+    if context.args:
+        # /ranking <página>: el ranking completo en texto
+        if not context.args[0].isdigit() or int(context.args[0]) < 1:
+            await update.message.reply_text("❌ Uso: /ranking <página>")
+            return
+        await send_ranking_page(update, int(context.args[0]))
+        return
+
     try:
-        leaderboard = DB.get_leaderboard(top=10)
+        leaderboard = await VOTES.get_leaderboard(top=10)
     except Exception as e:
         await update.message.reply_text(f"❌ Error al cargar el ranking: {str(e)}")
         return
@@ -387,52 +745,211 @@ async def show_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ No hay GIFs votados todavía.")
         return
 
-    # Enviar mensaje inicial del ranking
-    header = "*🏆 Ranking de Memes 🏆*\n\n"
-    ranking_text = []
+    caption = ranking_caption(leaderboard, 0)
+    try:
+        await update.message.reply_animation(
+            animation=leaderboard[0].get("file_id", ""),
+            caption=caption,
+            parse_mode="MarkdownV2",
+            reply_markup=ranking_markup(0, len(leaderboard)),
+        )
+    except Exception as gif_error:
+        gif_id = leaderboard[0].get("gif_id", 0)
+        print(f"Error al enviar GIF {gif_id}: {str(gif_error)}")
+        # Si falla, enviar solo el resumen
+        await update.message.reply_text(caption, parse_mode="MarkdownV2")
 
-    for i, entry in enumerate(leaderboard, start=1):
-        username = escape_md2(entry.get("username", "Anónimo"))
-        votes = entry.get("votes", 0)
-        gif_id = entry.get("gif_id", 0)
-        file_id = entry.get("file_id", "")
-
-        # Añadir emojis según la posición
-        if i == 1:
-            medal = "🥇"
-        elif i == 2:
-            medal = "🥈"
-        elif i == 3:
-            medal = "🥉"
+
+@timed_handler
+async def ranking_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cambia la posición mostrada en el carrusel del ranking"""
+    query = update.callback_query
+    if not query:
+        return
+
+    if query.data == "rank:counter":
+        await query.answer()
+        return
+
+    try:
+        leaderboard = await VOTES.get_leaderboard(top=10)
+        if not leaderboard or not query.message:
+            await query.answer("❌ El ranking ya no está disponible", show_alert=True)
+            return
+
+        # El ranking puede haber cambiado desde que se envió el mensaje
+        index = min(int(query.data.split(":")[1]), len(leaderboard) - 1)
+        await query.message.edit_media(
+            media=InputMediaAnimation(
+                media=leaderboard[index].get("file_id", ""),
+                caption=ranking_caption(leaderboard, index),
+                parse_mode="MarkdownV2",
+            ),
+            reply_markup=ranking_markup(index, len(leaderboard)),
+        )
+        await query.answer()
+    except Exception as e:
+        print(f"Error en ranking_callback: {str(e)}")
+        await query.answer("❌ Error al mostrar el ranking", show_alert=True)
+
+
+def ranking_page_text(entries: list, page: int, pages: int) -> str:
+    """Una página del ranking completo; los empates comparten puesto"""
+    header = f"*🏆 Ranking completo \\- página {page}/{pages} 🏆*\n\n"
+    lines = [
+        f"{ranking_medal(entry['rank'])} ⭐ *{entry['votes']}* \\- "
+        f"{escape_md2(entry['username'])}"
+        for entry in entries
+    ]
+    return header + "\n".join(lines)
+
+
+def ranking_page_markup(page: int, pages: int) -> InlineKeyboardMarkup:
+    """Botones para cambiar de página del ranking completo"""
+    nav_buttons = []
+    if page > 1:
+        nav_buttons.append(
+            InlineKeyboardButton("⬅️ Anterior", callback_data=f"rankpage:{page - 1}")
+        )
+    nav_buttons.append(
+        InlineKeyboardButton(f"{page}/{pages}", callback_data="rankpage:counter")
+    )
+    if page < pages:
+        nav_buttons.append(
+            InlineKeyboardButton("➡️ Siguiente", callback_data=f"rankpage:{page + 1}")
+        )
+    return InlineKeyboardMarkup([nav_buttons])
+
+
+async def send_ranking_page(update: Update, page: int):
+    """Envía (o edita, desde un botón) una página del ranking completo"""
+    entries, pages = await DB.get_ranking_page(page, RANKING_PAGE_SIZE)
+    if not entries:
+        text = f"❌ El ranking solo tiene {pages} páginas."
+        if update.callback_query:
+            await update.callback_query.answer(text, show_alert=True)
         else:
-            medal = f"{i}\\."
+            await update.message.reply_text(text)
+        return
 
-        line = f"{medal} ⭐ *{votes}* \\- {username}"
-        ranking_text.append(line)
+    text = ranking_page_text(entries, page, pages)
+    markup = ranking_page_markup(page, pages)
+    if update.callback_query:
+        await update.callback_query.message.edit_text(
+            text, parse_mode="MarkdownV2", reply_markup=markup
+        )
+        await update.callback_query.answer()
+    else:
+        await update.message.reply_text(
+            text, parse_mode="MarkdownV2", reply_markup=markup
+        )
 
-        # Enviar el GIF con su información
-        caption = f"*Posición {i}*\n{medal} ⭐ *{
-            votes} votos*\n👤 *Usuario:* {username}"
 
-        try:
-            # Enviar el GIF
-            await update.message.reply_animation(
-                animation=file_id, caption=caption, parse_mode="MarkdownV2"
-            )
-        except Exception as gif_error:
-            print(f"Error al enviar GIF {gif_id}: {str(gif_error)}")
-            # Si falla, enviar solo la información
-            await update.message.reply_text(
-                f"❌ No se pudo cargar el GIF de la posición {i}\n"
-                f"Usuario: {username} - ⭐ {votes} votos"
-            )
+@timed_handler
+async def ranking_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cambia de página en el ranking completo"""
+    query = update.callback_query
+    if not query or not query.message:
+        return
+
+    if query.data == "rankpage:counter":
+        await query.answer()
+        return
 
-    # Enviar resumen final
-    summary = header + "\n".join(ranking_text)
-    await update.message.reply_text(summary, parse_mode="MarkdownV2")
+    try:
+        await send_ranking_page(update, int(query.data.split(":")[1]))
+    except Exception as e:
+        print(f"Error en ranking_page_callback: {str(e)}")
+        await query.answer("❌ Error al mostrar el ranking", show_alert=True)
+
+
+# ------------------ Estadísticas personales ------------------
+
+
+def user_stats_text(info: dict) -> str:
+    """Mensaje de /mis_stats a partir de get_user_info"""
+    lines = ["*📊 Tus estadísticas*", ""]
+    votable = info["total_gifs"]
+    if info["has_gif"]:
+        votable -= 1
+        rank = info["rank"]
+        medal = ranking_medal(rank) if rank <= 3 else "🏅"
+        lines += [
+            f"{medal} Puesto *{rank}* de {info['total_gifs']}",
+            f"⭐ Votos recibidos: *{info['votes_received']}*",
+        ]
+    else:
+        lines.append(escape_md2("🎞️ Aún no has mandado tu meme (/mandar_meme)"))
+    lines.append(f"🗳️ Votos dados: *{info['votes_given']}* de {votable}")
+    return "\n".join(lines)
+
+
+@timed_handler
+async def my_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Muestra el meme, los votos y el puesto del usuario"""
+    try:
+        info = await VOTES.get_user_info(update.effective_user.id)
+    except Exception as e:
+        await update.message.reply_text(
+            f"❌ Error al cargar tus estadísticas: {str(e)}"
+        )
+        return
+
+    if not info["exists"]:
+        await update.message.reply_text(
+            "Todavía no participas: manda tu meme con /mandar_meme "
+            "o vota con /votaciones 🎄"
+        )
+        return
+    await update.message.reply_text(user_stats_text(info), parse_mode="MarkdownV2")
 
 
 # ------------------ Configuración del bot ------------------
+async def on_startup(app):
+    """Arranca el volcado periódico de votos y la carga de los villancicos"""
+    global DEDUP
+    # Sin esperarla: el webhook se registra mientras tanto
+    carols_task()
+    if dedup.available() and PHASH_THRESHOLD >= 0:
+        DEDUP = dedup.PerceptualDedup(partial(download_file, app.bot), PHASH_THRESHOLD)
+        dedup_task()
+    if isinstance(VOTES, VoteBuffer):
+        # Los votos de una caída anterior, antes de aceptar ninguno nuevo
+        if VOTE_JOURNAL and not WORKERS:
+            await recover_journals()
+        elif VOTES.journal:
+            # Un worker que el supervisor ha vuelto a arrancar: los votos que
+            # confirmó antes de caer solo están en su diario
+            recovered = await VOTES.recover()
+            if recovered:
+                directory = VOTES.journal.directory
+                logger.info(f"🗳️ {recovered} votos recuperados de {directory}")
+        VOTES.start()
+
+
+async def recover_journals():
+    """Reaplica a la BD los diarios de votos que hayan quedado en disco.
+
+    Incluye los de todos los workers de un arranque anterior, aunque ahora
+    haya otro número de workers o ninguno.
+    """
+    root = Path(VOTE_JOURNAL)
+    for directory in [root, *sorted(root.glob("worker-*"))]:
+        buffer = VoteBuffer(DB, journal=VoteJournal(directory))
+        recovered = await buffer.recover()
+        if recovered:
+            logger.info(f"🗳️ {recovered} votos recuperados de {directory}")
+
+
+async def shutdown_db(app):
+    """Vuelca los votos pendientes y cierra el pool de la base de datos"""
+    if isinstance(VOTES, VoteBuffer):
+        await VOTES.stop()
+    if DEDUP:
+        DEDUP.close()
+    DB.close()
+
+
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja errores no capturados"""
     logger.error(f"Error no capturado: {context.error}")
@@ -442,14 +959,15 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
-def main():
-    """Función principal para iniciar el bot"""
-    if not TOKEN:
-        logger.error("❌ TELEGRAM_TOKEN no está configurado.")
-        return
-
-    # Crear la aplicación
-    app = ApplicationBuilder().token(TOKEN).build()
+def build_application(builder: ApplicationBuilder) -> Application:
+    """Crea la aplicación con todos los handlers a partir de `builder`"""
+    app = (
+        builder.persistence(PERSISTENCE)
+        .concurrent_updates(SequentialUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(on_startup)
+        .post_shutdown(shutdown_db)
+        .build()
+    )
 
     # Añadir manejador de errores
     app.add_error_handler(error_handler)
@@ -460,6 +978,7 @@ def main():
     app.add_handler(CommandHandler("villancico", carol))
     app.add_handler(CommandHandler("ranking", show_leaderboard))
     app.add_handler(CommandHandler("votaciones", show_memes_to_vote))
+    app.add_handler(CommandHandler("mis_stats", my_stats))
 
     # Conversación para enviar memes
     conv_handler = ConversationHandler(
@@ -470,31 +989,98 @@ def main():
                     filters.ANIMATION | filters.Document.MimeType("image/gif"),
                     receive_meme,
                 ),
-                MessageHandler(
-                    filters.ALL,
-                    lambda u, c: u.message.reply_text("❌ Por favor envía un GIF."),
-                ),
+                MessageHandler(filters.ALL, ask_for_gif),
             ]
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="mandar_meme",
+        persistent=True,
     )
     app.add_handler(conv_handler)
 
+    # Manejador de callbacks para el carrusel del ranking
+    app.add_handler(
+        CallbackQueryHandler(ranking_callback, pattern=r"^rank:(\d+|counter)$")
+    )
+    app.add_handler(
+        CallbackQueryHandler(ranking_page_callback, pattern=r"^rankpage:(\d+|counter)$")
+    )
+
     # Manejador de callbacks para votación
     app.add_handler(
         CallbackQueryHandler(vote_callback, pattern=r"^(vote:\d+|next|prev|counter)$")
     )
 
-    logger.info("🤖 Bot iniciado...")
+    return app
+
+
+def worker_main(shard: int):
+    """Proceso worker: procesa las actualizaciones de su shard de la cola"""
+    DB.preload()
+    if isinstance(VOTES, VoteBuffer) and VOTES.journal:
+        # Un diario por worker: no comparten fichero
+        VOTES.journal = VoteJournal(Path(VOTE_JOURNAL) / f"worker-{shard}")
+    app = build_application(ApplicationBuilder().token(TOKEN).rate_limiter(SCHEDULER))
+    run_worker(app, WorkQueue(QUEUE_URL, WORKERS), shard)
+
+
+def run_workers(**webhook):
+    """Arranca los workers y el webhook que les encola las actualizaciones"""
+    if VOTE_JOURNAL:
+        asyncio.run(recover_journals())
+    # Crear la BD aquí aplica las migraciones una vez, antes que los workers
+    DB.db.engine.dispose()
+    queue = WorkQueue(QUEUE_URL, WORKERS)
+    # Lo pendiente de un arranque con otro número de workers
+    queue.reshard()
+    StatsGauge(
+        "bot_update_queue", "Cola de actualizaciones", lambda: {"depth": queue.depth()}
+    )
+
+    # Los workers que terminan se arrancan de nuevo y reprocesan su lote
+    workers = WorkerSupervisor(worker_main, WORKERS)
+    StatsGauge(
+        "bot_workers",
+        "Workers en marcha y reinicios",
+        lambda: {"alive": workers.alive(), "restarts": workers.restarts},
+    )
+    workers.start()
+    try:
+        run_queue_webhook(Bot(TOKEN), queue, **webhook)
+    finally:
+        # SIGTERM: terminan el lote actual y guardan el estado
+        workers.stop()
+
+
+def main():
+    """Función principal para iniciar el bot"""
+    if not TOKEN:
+        logger.error("❌ TELEGRAM_TOKEN no está configurado.")
+        return
 
-    # Iniciar el bot
-    app.run_webhook(
+    webhook = dict(
         listen="0.0.0.0",
         port=int(os.getenv("PORT", 80)),
         secret_token="AecreTTok1enIHAveChangedByNow",
         webhook_url="https://mi-bot-telegram-2nba.onrender.com",
     )
 
+    if WORKERS:
+        logger.info(f"🤖 Bot iniciado con {WORKERS} workers...")
+        run_workers(**webhook)
+        return
+
+    # La BD se crea mientras la aplicación arranca y contacta con Telegram
+    DB.preload()
+
+    # Crear la aplicación
+    app = build_application(ApplicationBuilder().token(TOKEN).rate_limiter(SCHEDULER))
+
+    logger.info("🤖 Bot iniciado...")
+
+    # Iniciar el bot (webhook y /metrics en el mismo puerto)
+    run_webhook(app, **webhook)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,231 @@
+"""Tareas de mantenimiento de la base de datos del concurso.
+
+Uso:
+    python manage.py recount
+    python manage.py schema
+    python manage.py export copia/ --format csv
+    python manage.py import copia/ --format csv --chunk 10000
+    python manage.py ranking resultados.csv --format csv
+    python manage.py contests
+    CONTEST=navidad-2026 python manage.py archive navidad
+
+CONTEST elige el concurso en curso (por defecto, navidad).
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, TextIO
+
+from sqlalchemy import select
+
+from controllers import ChristmasDB
+from migrations import MIGRATIONS, schema_version
+from models import (
+    DEFAULT_CONTEST,
+    Contest,
+    Gif,
+    GifArchive,
+    User,
+    Vote,
+    VoteArchive,
+)
+
+# Tablas del concurso en orden de dependencias (claves ajenas)
+CONTEST_TABLES = [
+    User.__table__,
+    Contest.__table__,
+    Gif.__table__,
+    Vote.__table__,
+    GifArchive,
+    VoteArchive,
+]
+# Tabla de archivo de cada tabla caliente: comparten la serie de ids
+ARCHIVES = {Gif.__table__: GifArchive, Vote.__table__: VoteArchive}
+
+# ------------------ Comandos ------------------
+
+
+def recount(db: ChristmasDB, args):
+    """Recalcula los contadores de votos desde la tabla votes"""
+    fixed = db.recount_votes()
+    print(f"✅ Contadores recalculados: {fixed} GIFs corregidos")
+
+
+def schema(db: ChristmasDB, args):
+    """Muestra las migraciones aplicadas a la BD"""
+    with db.engine.connect() as connection:
+        applied = dict(
+            connection.execute(
+                select(schema_version.c.version, schema_version.c.applied_at)
+            ).all()
+        )
+    print(f"BD: {db.engine.url.render_as_string(hide_password=True)}")
+    for migration in MIGRATIONS:
+        applied_at = applied.get(migration.version) or "pendiente"
+        print(f"{migration.version:>3}  {migration.description:<50} {applied_at}")
+
+
+def contests(db: ChristmasDB, args):
+    """Lista los concursos con sus GIFs y votos"""
+    for contest in db.get_contests():
+        if contest["archived_at"]:
+            state = f"archivado {contest['archived_at']}"
+        else:
+            state = "en curso"
+        print(
+            f"{contest['id']:>3}  {contest['name']:<20} {contest['gifs']:>7} GIFs"
+            f" {contest['votes']:>9} votos  {state}"
+        )
+
+
+def archive(db: ChristmasDB, args):
+    """Mueve un concurso terminado a las tablas de archivo"""
+    gifs, votes = db.archive_contest(args.name)
+    print(f"📦 {args.name}: {gifs} GIFs y {votes} votos archivados")
+
+
+# ------------------ Importar / exportar ------------------
+
+
+def parse_value(column, value):
+    """Valor leído de un fichero -> tipo de la columna"""
+    if value is None or value == "":
+        return None
+    python_type = column.type.python_type
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    return python_type(value)
+
+
+def read_rows(path: Path, fmt: str, table) -> Iterator[Dict[str, Any]]:
+    """Lee un fichero JSONL o CSV fila a fila"""
+    with open(path, newline="", encoding="utf-8") as f:
+        if fmt == "jsonl":
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = csv.DictReader(f)
+        # En CSV todo es texto y en JSON las fechas también: convertir según
+        # el tipo de la columna
+        for row in rows:
+            yield {
+                name: parse_value(table.c[name], value) for name, value in row.items()
+            }
+
+
+def write_rows(
+    f: TextIO, fmt: str, fieldnames: List[str], rows: Iterable[Dict[str, Any]]
+) -> int:
+    """Escribe las filas en JSONL o CSV según llegan. Devuelve cuántas"""
+    if fmt == "csv":
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+    count = 0
+    for row in rows:
+        if fmt == "csv":
+            writer.writerow(row)
+        else:
+            f.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+        count += 1
+    return count
+
+
+def export(db: ChristmasDB, args):
+    """Vuelca las tablas del concurso a ficheros JSONL o CSV"""
+    directory = Path(args.directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    for table in CONTEST_TABLES:
+        path = directory / f"{table.name}.{args.format}"
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            rows = db.iter_rows(table, args.chunk)
+            count = write_rows(f, args.format, table.columns.keys(), rows)
+        print(f"📤 {table.name}: {count} filas -> {path}")
+
+
+def import_(db: ChristmasDB, args):
+    """Carga las tablas del concurso desde ficheros JSONL o CSV"""
+    directory = Path(args.directory)
+    for table in CONTEST_TABLES:
+        path = directory / f"{table.name}.{args.format}"
+        if not path.exists():
+            continue
+        start = time.perf_counter()
+        read = inserted = 0
+        rows = read_rows(path, args.format, table)
+        with db.deferred_indexes(table):
+            # Una transacción por lote: la memoria no depende del fichero
+            while chunk := list(itertools.islice(rows, args.chunk)):
+                read += len(chunk)
+                inserted += db.insert_rows(table, chunk)
+        elapsed = time.perf_counter() - start
+        print(
+            f"📥 {table.name}: {inserted}/{read} filas nuevas en {elapsed:.1f} s"
+            f" ({read / max(elapsed, 1e-9):.0f} filas/s)"
+        )
+    # Con todo cargado: los ids nuevos siguen también a los archivados
+    for table in CONTEST_TABLES:
+        if table not in ARCHIVES.values():
+            db.reset_sequence(table, ARCHIVES.get(table))
+    # Los ficheros pueden traer votos sin el contador de sus GIFs
+    recount(db, args)
+
+
+def ranking(db: ChristmasDB, args):
+    """Exporta el ranking completo, con los empates en el mismo puesto"""
+    fieldnames = ["rank", "gif_id", "username", "votes", "file_id"]
+    rows = db.iter_ranking(args.chunk)
+    if args.output == "-":
+        write_rows(sys.stdout, args.format, fieldnames, rows)
+        return
+    with open(args.output, "w", newline="", encoding="utf-8") as f:
+        count = write_rows(f, args.format, fieldnames, rows)
+    print(f"🏆 Ranking: {count} GIFs -> {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--db",
+        default=os.getenv("DATABASE_URL", "sqlite:///db.sqlite"),
+        help="URL de la base de datos",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("recount", help=recount.__doc__).set_defaults(func=recount)
+    commands.add_parser("schema", help=schema.__doc__).set_defaults(func=schema)
+    commands.add_parser("contests", help=contests.__doc__).set_defaults(func=contests)
+    command = commands.add_parser("archive", help=archive.__doc__)
+    command.add_argument("name", help="Nombre del concurso")
+    command.set_defaults(func=archive)
+    for name, func in (("export", export), ("import", import_)):
+        command = commands.add_parser(name, help=func.__doc__)
+        command.add_argument("directory", help="Carpeta de los ficheros")
+        command.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+        command.add_argument(
+            "--chunk", type=int, default=10_000, help="Filas por transacción"
+        )
+        command.set_defaults(func=func)
+
+    command = commands.add_parser("ranking", help=ranking.__doc__)
+    command.add_argument("output", nargs="?", default="-", help="Fichero o - (stdout)")
+    command.add_argument("--format", choices=["jsonl", "csv"], default="csv")
+    command.add_argument("--chunk", type=int, default=1000, help="Filas por lote")
+    command.set_defaults(func=ranking)
+
+    args = parser.parse_args()
+    db = ChristmasDB(
+        args.db,
+        profile=os.getenv("DB_PROFILE", "default"),
+        contest=os.getenv("CONTEST", DEFAULT_CONTEST),
+    )
+    args.func(db, args)
+
+
+if __name__ == "__main__":
+    main()
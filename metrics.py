@@ -0,0 +1,210 @@
+"""Métricas del bot en formato de texto de Prometheus.
+
+Latencia de los handlers, consultas SQL por método de ChristmasDB y
+latencia de las llamadas a la API de Telegram, servidas en /metrics.
+"""
+
+import contextvars
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from sqlalchemy import event
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Método de ChristmasDB que está ejecutando el hilo actual
+current_db_method: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "current_db_method", default="other"
+)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Contador monótono con etiquetas"""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(
+                    f"{self.name}{_format_labels(self.labels, labels)} {value}"
+                )
+        return lines
+
+
+class Histogram:
+    """Histograma acumulativo con etiquetas"""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # etiquetas -> ([cuentas por bucket], suma, total)
+        self.values: Dict[Tuple[str, ...], List] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels: str):
+        with self._lock:
+            data = self.values.get(labels)
+            if data is None:
+                data = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[0][i] += 1
+            data[1] += value
+            data[2] += 1
+
+    @contextmanager
+    def time(self, *labels: str):
+        """Mide la duración del bloque"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total_sum, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    bucket = _format_labels(self.labels, labels, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{bucket} {bucket_count}")
+                bucket = _format_labels(self.labels, labels, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{bucket} {count}")
+                label_text = _format_labels(self.labels, labels)
+                lines.append(f"{self.name}_sum{label_text} {total_sum}")
+                lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+class StatsGauge:
+    """Expone como gauges los contadores de un dict de estadísticas"""
+
+    def __init__(self, prefix: str, help: str, stats: Callable[[], Dict[str, float]]):
+        self.prefix = prefix
+        self.help = help
+        self.stats = stats
+        REGISTRY.append(self)
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, value in sorted(self.stats().items()):
+            name = f"{self.prefix}_{key}"
+            lines += [f"# HELP {name} {self.help}", f"# TYPE {name} gauge"]
+            lines.append(f"{name} {value}")
+        return lines
+
+
+REGISTRY: List = []
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_seconds", "Duración de los handlers de Telegram", ["handler"]
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Excepciones no capturadas por handler", ["handler"]
+)
+DB_METHOD_LATENCY = Histogram(
+    "bot_db_method_seconds", "Duración de los métodos de ChristmasDB", ["method"]
+)
+DB_QUERIES = Counter(
+    "bot_db_queries_total", "Sentencias SQL por método de ChristmasDB", ["method"]
+)
+DB_QUERY_LATENCY = Histogram(
+    "bot_db_query_seconds", "Duración de las sentencias SQL", ["method"]
+)
+TELEGRAM_LATENCY = Histogram(
+    "bot_telegram_request_seconds", "Duración de las llamadas a la API", ["endpoint"]
+)
+TELEGRAM_ERRORS = Counter(
+    "bot_telegram_errors_total", "Llamadas a la API que han fallado", ["endpoint"]
+)
+
+
+def render() -> str:
+    """Todas las métricas en formato de texto de Prometheus"""
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+# ------------------ Instrumentación ------------------
+
+
+def timed_handler(handler):
+    """Decorador que mide la latencia de un handler asíncrono"""
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        with HANDLER_LATENCY.time(handler.__name__):
+            try:
+                return await handler(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(handler.__name__)
+                raise
+
+    return wrapper
+
+
+@contextmanager
+def track_db_method(name: str):
+    """Atribuye a `name` las sentencias SQL ejecutadas dentro del bloque"""
+    token = current_db_method.set(name)
+    try:
+        with DB_METHOD_LATENCY.time(name):
+            yield
+    finally:
+        current_db_method.reset(token)
+
+
+def instrument_engine(engine):
+    """Cuenta y cronometra las sentencias SQL de un engine"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        method = current_db_method.get()
+        DB_QUERIES.inc(method)
+        DB_QUERY_LATENCY.observe(elapsed, method)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # La sentencia ha fallado: after_cursor_execute no llegará
+        if context.connection is not None:
+            starts = context.connection.info.get("query_start")
+            if starts:
+                starts.pop()
@@ -0,0 +1,382 @@
+"""Migraciones versionadas del esquema de la base de datos.
+
+Cada migración tiene un número de versión y una función que recibe una
+conexión dentro de su propia transacción. Las versiones aplicadas se guardan
+en la tabla schema_version. Una BD vacía se crea directamente con el esquema
+actual y se marca con la última versión; una BD anterior a las migraciones
+(creada con create_all) se considera en la versión 1.
+
+Las migraciones comprueban el estado antes de cambiarlo, de modo que
+aplicarlas sobre una BD que ya tiene parte de los cambios no falla.
+
+Cada migración escribe las tablas e índices que crea tal como eran en su
+versión, sin tomarlos de los modelos: cambiar los modelos no debe cambiar lo
+que hace una versión ya publicada. Los modelos solo se usan para crear una BD
+vacía con el esquema actual.
+"""
+
+from typing import Callable, List, NamedTuple
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    ForeignKey,
+    Integer,
+    MetaData,
+    PrimaryKeyConstraint,
+    String,
+    Table,
+    Text,
+    UniqueConstraint,
+    func,
+    insert,
+    inspect,
+    select,
+    text,
+)
+from sqlalchemy.engine import Connection, Engine
+
+from models import Base, User
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+
+
+# Fuera de Base.metadata: no forma parte del esquema de los modelos
+schema_version = Table(
+    "schema_version",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime, server_default=func.now()),
+)
+
+
+# ------------------ Utilidades ------------------
+
+
+def _create_index(
+    connection: Connection, name: str, table: str, *columns: str, unique=False
+):
+    """CREATE INDEX IF NOT EXISTS con las columnas (y orden) indicadas"""
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    connection.execute(
+        text(f"CREATE {kind} IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+    )
+
+
+def _has_column(connection: Connection, table: str, column: str) -> bool:
+    return column in {c["name"] for c in inspect(connection).get_columns(table)}
+
+
+# ------------------ Migraciones ------------------
+
+
+def initial_schema(connection: Connection):
+    # Los modelos originales, antes de cualquier migración
+    schema = MetaData()
+    Table(
+        "users",
+        schema,
+        Column("id", Integer, primary_key=True),
+        Column("telegram_id", Integer, unique=True, index=True, nullable=False),
+        Column("username", String),
+    )
+    Table(
+        "gifs",
+        schema,
+        Column("id", Integer, primary_key=True),
+        Column("message_id", Integer, unique=True),
+        Column("file_id", String, unique=True),
+        Column("user_id", Integer, ForeignKey("users.id"), nullable=False),
+    )
+    Table(
+        "votes",
+        schema,
+        Column("id", Integer, primary_key=True),
+        Column("gif_id", Integer, ForeignKey("gifs.id"), nullable=False),
+        Column("voter_id", Integer, ForeignKey("users.id"), nullable=False),
+        UniqueConstraint("gif_id", "voter_id", name="unique_vote"),
+    )
+    schema.create_all(connection)
+
+
+def add_vote_count(connection: Connection):
+    if _has_column(connection, "gifs", "vote_count"):
+        return
+    connection.execute(
+        text("ALTER TABLE gifs ADD COLUMN vote_count INTEGER NOT NULL DEFAULT 0")
+    )
+    connection.execute(
+        text(
+            "UPDATE gifs SET vote_count ="
+            " (SELECT count(votes.id) FROM votes WHERE votes.gif_id = gifs.id)"
+        )
+    )
+
+
+def add_ranking_index(connection: Connection):
+    _create_index(connection, "ix_gifs_ranking", "gifs", "vote_count DESC", "id DESC")
+
+
+def add_carols(connection: Connection):
+    schema = MetaData()
+    carols = Table(
+        "carols",
+        schema,
+        Column("id", Integer, primary_key=True),
+        Column("filename", String, unique=True, nullable=False),
+        Column("file_id", String, nullable=False),
+    )
+    carols.create(connection, checkfirst=True)
+
+
+def add_lookup_indexes(connection: Connection):
+    _create_index(connection, "ix_gifs_user_id", "gifs", "user_id")
+    _create_index(connection, "ix_votes_voter_gif", "votes", "voter_id", "gif_id")
+
+
+def widen_telegram_id(connection: Connection):
+    # En SQLite INTEGER ya es de 64 bits
+    if connection.dialect.name == "postgresql":
+        connection.execute(
+            text("ALTER TABLE users ALTER COLUMN telegram_id TYPE BIGINT")
+        )
+
+
+def add_bot_state(connection: Connection):
+    schema = MetaData()
+    bot_state = Table(
+        "bot_state",
+        schema,
+        Column("kind", String, primary_key=True),
+        Column("key", String, primary_key=True),
+        Column("data", Text, nullable=False),
+    )
+    bot_state.create(connection, checkfirst=True)
+
+
+def add_gif_fingerprints(connection: Connection):
+    for column, type_ in (("file_unique_id", "VARCHAR"), ("phash", "BIGINT")):
+        if not _has_column(connection, "gifs", column):
+            connection.execute(text(f"ALTER TABLE gifs ADD COLUMN {column} {type_}"))
+    _create_index(
+        connection, "ix_gifs_file_unique_id", "gifs", "file_unique_id", unique=True
+    )
+
+
+def _rebuild_sqlite(
+    connection: Connection, table: str, ddl: str, columns: str, contest_id: int
+):
+    """Recrea una tabla de SQLite con `ddl` y copia sus filas.
+
+    SQLite no puede quitar un UNIQUE ni añadir una columna con REFERENCES y
+    DEFAULT: se crea la tabla nueva, se copia y se renombra. Las claves
+    ajenas no están activas (PRAGMA foreign_keys), así que borrar la
+    antigua no toca las que la referencian.
+    """
+    connection.execute(text(f"CREATE TABLE {table}_new ({ddl})"))
+    connection.execute(
+        text(
+            f"INSERT INTO {table}_new (contest_id, {columns})"
+            f" SELECT :contest_id, {columns} FROM {table}"
+        ),
+        {"contest_id": contest_id},
+    )
+    connection.execute(text(f"DROP TABLE {table}"))
+    connection.execute(text(f"ALTER TABLE {table}_new RENAME TO {table}"))
+
+
+def add_contests(connection: Connection):
+    schema = MetaData()
+    contests = Table(
+        "contests",
+        schema,
+        Column("id", Integer, primary_key=True),
+        Column("name", String, unique=True, nullable=False),
+        Column("created_at", DateTime, server_default=func.now()),
+        Column("archived_at", DateTime),
+    )
+    contests.create(connection, checkfirst=True)
+    # Lo que ya había pasa al concurso por defecto
+    contest_id = connection.execute(
+        select(contests.c.id).where(contests.c.name == "navidad")
+    ).scalar()
+    if contest_id is None:
+        contest_id = connection.execute(
+            insert(contests).values(name="navidad")
+        ).inserted_primary_key[0]
+
+    if not _has_column(connection, "gifs", "contest_id"):
+        if connection.dialect.name == "sqlite":
+            # AUTOINCREMENT: archivar vacía las tablas y los ids no deben
+            # volver a empezar
+            _rebuild_sqlite(
+                connection,
+                "gifs",
+                "id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,"
+                " contest_id INTEGER NOT NULL REFERENCES contests (id),"
+                " message_id INTEGER, file_id VARCHAR, file_unique_id VARCHAR,"
+                " phash BIGINT,"
+                " user_id INTEGER NOT NULL REFERENCES users (id),"
+                " vote_count INTEGER NOT NULL DEFAULT 0",
+                "id, message_id, file_id, file_unique_id, phash, user_id,"
+                " vote_count",
+                contest_id,
+            )
+            _rebuild_sqlite(
+                connection,
+                "votes",
+                "id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,"
+                " contest_id INTEGER NOT NULL REFERENCES contests (id),"
+                " gif_id INTEGER NOT NULL REFERENCES gifs (id),"
+                " voter_id INTEGER NOT NULL REFERENCES users (id),"
+                " CONSTRAINT unique_vote UNIQUE (gif_id, voter_id)",
+                "id, gif_id, voter_id",
+                contest_id,
+            )
+        else:
+            for table in ("gifs", "votes"):
+                connection.execute(
+                    text(
+                        f"ALTER TABLE {table} ADD COLUMN contest_id INTEGER NOT NULL"
+                        f" DEFAULT {int(contest_id)} REFERENCES contests (id)"
+                    )
+                )
+                connection.execute(
+                    text(f"ALTER TABLE {table} ALTER COLUMN contest_id DROP DEFAULT")
+                )
+            # message_id y file_id pasan a ser únicos por concurso
+            for column in ("message_id", "file_id"):
+                connection.execute(
+                    text(
+                        f"ALTER TABLE gifs DROP CONSTRAINT IF EXISTS gifs_{column}_key"
+                    )
+                )
+
+    # Los índices globales se sustituyen por los que empiezan por contest_id
+    for index in (
+        "ix_gifs_ranking",
+        "ix_gifs_user_id",
+        "ix_gifs_file_unique_id",
+        "ix_votes_voter_gif",
+    ):
+        connection.execute(text(f"DROP INDEX IF EXISTS {index}"))
+    _create_index(
+        connection,
+        "ix_gifs_contest_ranking",
+        "gifs",
+        "contest_id",
+        "vote_count DESC",
+        "id DESC",
+    )
+    for name, column in (
+        ("ix_gifs_contest_user", "user_id"),
+        ("ix_gifs_contest_file", "file_unique_id"),
+        ("ix_gifs_contest_file_id", "file_id"),
+        ("ix_gifs_contest_message", "message_id"),
+    ):
+        _create_index(connection, name, "gifs", "contest_id", column, unique=True)
+    _create_index(
+        connection,
+        "ix_votes_contest_voter",
+        "votes",
+        "contest_id",
+        "voter_id",
+        "gif_id",
+    )
+
+    # Tablas frías: clave (contest_id, id), sin claves ajenas ni índices
+    Table(
+        "gifs_archive",
+        schema,
+        Column("id", Integer, autoincrement=False),
+        Column("contest_id", Integer, nullable=False),
+        Column("message_id", Integer),
+        Column("file_id", String),
+        Column("file_unique_id", String),
+        Column("phash", BigInteger),
+        Column("user_id", Integer, nullable=False),
+        Column("vote_count", Integer, nullable=False),
+        PrimaryKeyConstraint("contest_id", "id"),
+    )
+    Table(
+        "votes_archive",
+        schema,
+        Column("id", Integer, autoincrement=False),
+        Column("contest_id", Integer, nullable=False),
+        Column("gif_id", Integer, nullable=False),
+        Column("voter_id", Integer, nullable=False),
+        PrimaryKeyConstraint("contest_id", "id"),
+    )
+    schema.create_all(connection)
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "Tablas users, gifs y votes", initial_schema),
+    Migration(2, "Contador gifs.vote_count", add_vote_count),
+    Migration(3, "Índice del ranking", add_ranking_index),
+    Migration(4, "Tabla carols con los file_id de los villancicos", add_carols),
+    Migration(5, "Índices por autor del GIF y por votante", add_lookup_indexes),
+    Migration(6, "users.telegram_id de 64 bits", widen_telegram_id),
+    Migration(7, "Tabla bot_state para la persistencia compartida", add_bot_state),
+    Migration(8, "gifs.file_unique_id único y hash perceptual", add_gif_fingerprints),
+    Migration(9, "Concursos y tablas de archivo", add_contests),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+# ------------------ API ------------------
+
+
+def current_version(connection: Connection) -> int:
+    """Última versión aplicada; 0 si la BD no está versionada"""
+    if not inspect(connection).has_table(schema_version.name):
+        return 0
+    return connection.execute(select(func.max(schema_version.c.version))).scalar() or 0
+
+
+def _stamp(connection: Connection, migration: Migration):
+    connection.execute(
+        insert(schema_version).values(
+            version=migration.version, description=migration.description
+        )
+    )
+
+
+def pending_migrations(engine: Engine) -> List[Migration]:
+    """Migraciones que faltan por aplicar"""
+    with engine.connect() as connection:
+        version = current_version(connection)
+        if version == 0 and inspect(connection).has_table(User.__tablename__):
+            version = 1
+    return [m for m in MIGRATIONS if m.version > version]
+
+
+def migrate(engine: Engine) -> List[Migration]:
+    """Lleva la BD a la última versión. Devuelve las migraciones aplicadas"""
+    with engine.begin() as connection:
+        schema_version.create(connection, checkfirst=True)
+        if current_version(connection) == 0:
+            if not inspect(connection).has_table(User.__tablename__):
+                # BD nueva: esquema actual completo
+                Base.metadata.create_all(connection)
+                for migration in MIGRATIONS:
+                    _stamp(connection, migration)
+                return []
+            # BD creada con create_all antes de las migraciones
+            _stamp(connection, MIGRATIONS[0])
+
+    pending = pending_migrations(engine)
+    for migration in pending:
+        # Una transacción por migración: si falla, las anteriores se quedan
+        with engine.begin() as connection:
+            print(f"Migración {migration.version}: {migration.description}")
+            migration.upgrade(connection)
+            _stamp(connection, migration)
+    return pending
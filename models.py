@@ -1,8 +1,25 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, UniqueConstraint
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    PrimaryKeyConstraint,
+    String,
+    Table,
+    Text,
+    UniqueConstraint,
+    func,
+)
 from sqlalchemy.orm import declarative_base, relationship
 
 Base = declarative_base()
 
+# Concurso al que van los GIFs y votos si no se indica otro (y el de los datos
+# anteriores a que hubiera concursos)
+DEFAULT_CONTEST = "navidad"
+
 # --------------------
 # USERS
 # --------------------
@@ -12,7 +29,8 @@ class User(Base):
     __tablename__ = "users"
 
     id = Column(Integer, primary_key=True)
-    telegram_id = Column(Integer, unique=True, index=True, nullable=False)
+    # Los ids de Telegram no caben en 32 bits (INTEGER en PostgreSQL)
+    telegram_id = Column(BigInteger, unique=True, index=True, nullable=False)
     username = Column(String)
 
     gif = relationship("Gif", back_populates="user", cascade="all, delete-orphan")
@@ -21,6 +39,21 @@ class User(Base):
     )
 
 
+# --------------------
+# CONCURSOS
+# --------------------
+
+
+class Contest(Base):
+    __tablename__ = "contests"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True, nullable=False)
+    created_at = Column(DateTime, server_default=func.now())
+    # Al archivarlo, sus GIFs y votos pasan a gifs_archive y votes_archive
+    archived_at = Column(DateTime)
+
+
 # --------------------
 # GIFS
 # --------------------
@@ -28,17 +61,40 @@ class User(Base):
 
 class Gif(Base):
     __tablename__ = "gifs"
+    # Archivar vacía la tabla: sin AUTOINCREMENT, SQLite volvería a dar los
+    # mismos ids y un botón de un concurso anterior votaría otro GIF
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id = Column(Integer, primary_key=True)
-    message_id = Column(Integer, unique=True)
-    file_id = Column(String, unique=True)
+    contest_id = Column(Integer, ForeignKey("contests.id"), nullable=False)
+    message_id = Column(Integer)
+    file_id = Column(String)
+    # Igual en todas las subidas del mismo fichero, a diferencia de file_id
+    file_unique_id = Column(String)
+    # dHash de 64 bits (con signo) de la miniatura, si se pudo calcular
+    phash = Column(BigInteger)
 
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     user = relationship("User", back_populates="gif")
 
+    # Contador desnormalizado de votos, mantenido por ChristmasDB
+    vote_count = Column(Integer, nullable=False, default=0, server_default="0")
+
     votes = relationship("Vote", back_populates="gif", cascade="all, delete-orphan")
 
 
+# Todos los índices empiezan por contest_id: las consultas del concurso
+# activo no dependen de cuántos haya habido
+# El top del ranking es una lectura de rango sobre este índice
+Index("ix_gifs_contest_ranking", Gif.contest_id, Gif.vote_count.desc(), Gif.id.desc())
+# Un GIF por usuario y concurso
+Index("ix_gifs_contest_user", Gif.contest_id, Gif.user_id, unique=True)
+# Un mismo fichero solo puede entrar una vez en cada concurso
+Index("ix_gifs_contest_file", Gif.contest_id, Gif.file_unique_id, unique=True)
+Index("ix_gifs_contest_file_id", Gif.contest_id, Gif.file_id, unique=True)
+Index("ix_gifs_contest_message", Gif.contest_id, Gif.message_id, unique=True)
+
+
 # --------------------
 # VOTES
 # --------------------
@@ -48,11 +104,79 @@ class Vote(Base):
     __tablename__ = "votes"
 
     id = Column(Integer, primary_key=True)
+    contest_id = Column(Integer, ForeignKey("contests.id"), nullable=False)
     gif_id = Column(Integer, ForeignKey("gifs.id"), nullable=False)
     voter_id = Column(Integer, ForeignKey("users.id"), nullable=False)
 
-    # Un usuario solo puede votar un gif una vez
-    __table_args__ = (UniqueConstraint("gif_id", "voter_id", name="unique_vote"),)
+    __table_args__ = (
+        # Un usuario solo puede votar un gif una vez
+        UniqueConstraint("gif_id", "voter_id", name="unique_vote"),
+        # Votos de un usuario en el concurso (GIFs votables, estadísticas)
+        # sin tocar la tabla
+        Index("ix_votes_contest_voter", "contest_id", "voter_id", "gif_id"),
+        {"sqlite_autoincrement": True},
+    )
 
     gif = relationship("Gif", back_populates="votes")
     voter_user = relationship("User", back_populates="votes")
+
+
+# --------------------
+# CONCURSOS ARCHIVADOS
+# --------------------
+
+
+def archive_table(table: Table) -> Table:
+    """Tabla fría con las mismas columnas, sin claves ajenas ni índices: solo
+    se escribe al archivar y se lee por concurso.
+
+    La clave primaria es (contest_id, id): un id solo es único dentro de su
+    concurso, también si alguna vez se reutiliza en la tabla caliente.
+    """
+    return Table(
+        f"{table.name}_archive",
+        Base.metadata,
+        *(
+            Column(
+                column.name,
+                column.type,
+                nullable=column.nullable,
+                autoincrement=False,
+            )
+            for column in table.columns
+        ),
+        PrimaryKeyConstraint("contest_id", "id"),
+    )
+
+
+GifArchive = archive_table(Gif.__table__)
+VoteArchive = archive_table(Vote.__table__)
+
+
+# --------------------
+# VILLANCICOS
+# --------------------
+
+
+class Carol(Base):
+    __tablename__ = "carols"
+
+    id = Column(Integer, primary_key=True)
+    # Nombre del .ogg en files/ y file_id de Telegram tras la primera subida
+    filename = Column(String, unique=True, nullable=False)
+    file_id = Column(String, nullable=False)
+
+
+# --------------------
+# ESTADO DEL BOT
+# --------------------
+
+
+class BotState(Base):
+    __tablename__ = "bot_state"
+
+    # user_data, chat_data, bot_data y conversaciones de python-telegram-bot,
+    # serializados en JSON para compartirlos entre procesos
+    kind = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    data = Column(Text, nullable=False)
@@ -0,0 +1,96 @@
+import json
+from typing import Any, Dict, Optional, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from controllers import AsyncChristmasDB
+
+
+class DBPersistence(BasePersistence[Dict, Dict, Dict]):
+    """Persistencia de python-telegram-bot en la tabla bot_state de la BD.
+
+    Guarda en JSON user_data, chat_data, bot_data y el estado de las
+    conversaciones, de modo que sobreviven a un reinicio y los comparten los
+    workers. Cada worker recibe siempre las actualizaciones de los mismos
+    usuarios, así que su copia en memoria es la buena y no hace falta
+    recargarla en cada actualización.
+    """
+
+    def __init__(self, db: AsyncChristmasDB, update_interval: float = 5):
+        super().__init__(
+            store_data=PersistenceInput(callback_data=False),
+            update_interval=update_interval,
+        )
+        self.db = db
+
+    async def _load(self, kind: str) -> Dict[int, Dict]:
+        states = await self.db.get_states(kind)
+        return {int(key): json.loads(data) for key, data in states.items()}
+
+    async def _store(self, kind: str, key: Any, data: Any):
+        stored = None if data is None else json.dumps(data)
+        await self.db.set_states(kind, {str(key): stored})
+
+    # --------------------
+    # LECTURA AL ARRANCAR
+    # --------------------
+    async def get_user_data(self) -> Dict[int, Dict]:
+        return await self._load("user_data")
+
+    async def get_chat_data(self) -> Dict[int, Dict]:
+        return await self._load("chat_data")
+
+    async def get_bot_data(self) -> Dict:
+        states = await self.db.get_states("bot_data")
+        return json.loads(states[""]) if "" in states else {}
+
+    async def get_callback_data(self) -> Optional[Any]:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[Tuple[int, ...], object]:
+        states = await self.db.get_states(f"conversation:{name}")
+        return {
+            tuple(json.loads(key)): json.loads(state) for key, state in states.items()
+        }
+
+    # --------------------
+    # ESCRITURA
+    # --------------------
+    async def update_user_data(self, user_id: int, data: Dict):
+        # Un dict vacío (carrusel cerrado) no se guarda
+        await self._store("user_data", user_id, data or None)
+
+    async def update_chat_data(self, chat_id: int, data: Dict):
+        await self._store("chat_data", chat_id, data or None)
+
+    async def update_bot_data(self, data: Dict):
+        await self._store("bot_data", "", data or None)
+
+    async def update_callback_data(self, data: Any):
+        pass
+
+    async def update_conversation(
+        self, name: str, key: Tuple[int, ...], new_state: Optional[object]
+    ):
+        await self._store(f"conversation:{name}", json.dumps(key), new_state)
+
+    async def drop_user_data(self, user_id: int):
+        await self._store("user_data", user_id, None)
+
+    async def drop_chat_data(self, chat_id: int):
+        await self._store("chat_data", chat_id, None)
+
+    # --------------------
+    # SIN CAMBIOS ENTRE ACTUALIZACIONES
+    # --------------------
+    async def refresh_user_data(self, user_id: int, user_data: Dict):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict):
+        pass
+
+    async def flush(self):
+        pass
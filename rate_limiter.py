@@ -0,0 +1,162 @@
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Dict, Optional
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import TELEGRAM_ERRORS, TELEGRAM_LATENCY
+
+# Llamadas que responden a una acción del usuario y no cuentan para los
+# límites de mensajes de Telegram
+UNTHROTTLED_ENDPOINTS = {"answerCallbackQuery", "answerInlineQuery", "getMe"}
+
+
+class TokenBucket:
+    """Cubo de tokens: `rate` peticiones por segundo con ráfagas de `capacity`"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, not_before: float = 0) -> float:
+        """Reserva un token y devuelve cuántos segundos hay que esperar.
+
+        Con `not_before` (el fin de una pausa por RetryAfter) el turno se
+        calcula desde ese instante, así que al acabar la pausa las peticiones
+        salen al ritmo del cubo y no todas a la vez.
+        """
+        now = time.monotonic()
+        start = max(now, not_before, self.updated)
+        self.tokens = min(
+            self.capacity, self.tokens + (start - self.updated) * self.rate
+        )
+        self.updated = start
+        self.tokens -= 1
+        wait = 0 if self.tokens >= 0 else -self.tokens / self.rate
+        return start - now + wait
+
+
+class OutboundScheduler(BaseRateLimiter[int]):
+    """Planificador de las llamadas salientes a la API de Telegram.
+
+    Reparte las peticiones con un cubo de tokens global y otro por chat para
+    no superar los límites de la API, y cuando Telegram responde con
+    RetryAfter detiene todos los envíos el tiempo indicado y reintenta.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 30,
+        private_rate: float = 1,
+        group_rate: float = 20 / 60,
+        burst: int = 5,
+        max_retries: int = 3,
+        max_chats: int = 10_000,
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+
+        self.chat_buckets: OrderedDict[Any, TokenBucket] = OrderedDict()
+        self.paused_until = 0.0
+        self.stats = {
+            "requests": 0,
+            "queued": 0,
+            "throttled": 0,
+            "throttled_seconds": 0.0,
+            "retries": 0,
+        }
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self.chat_buckets.clear()
+
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Los grupos (id negativo) tienen un límite mucho más bajo
+            is_group = isinstance(chat_id, int) and chat_id < 0
+            rate = self.group_rate if is_group else self.private_rate
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, self.burst)
+            if len(self.chat_buckets) > self.max_chats:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def _wait_turn(self, bucket: TokenBucket):
+        """Espera un token del cubo, respetando las pausas por RetryAfter"""
+        while True:
+            delay = bucket.reserve(self.paused_until)
+            if delay <= 0:
+                return
+
+            self.stats["throttled"] += 1
+            self.stats["throttled_seconds"] += delay
+            self.stats["queued"] += 1
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self.stats["queued"] -= 1
+            if self.paused_until <= time.monotonic():
+                return
+            # Un RetryAfter llegó durante la espera: se pide otro turno para
+            # después de la pausa. El perdido no se devuelve, porque el cubo ya
+            # cuenta la pausa como tiempo de relleno
+
+    async def _throttle(self, endpoint: str, data: Dict[str, Any]):
+        """Espera hasta que la petición pueda enviarse"""
+        if endpoint in UNTHROTTLED_ENDPOINTS:
+            return
+        # Primero el chat y luego el global: un turno global reservado
+        # mientras se espera al chat se gastaría tarde, junto a los siguientes
+        chat_id = data.get("chat_id")
+        if chat_id is not None:
+            await self._wait_turn(self._chat_bucket(chat_id))
+        await self._wait_turn(self.global_bucket)
+
+    async def process_request(
+        self,
+        callback,
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ):
+        self.stats["requests"] += 1
+        await self._throttle(endpoint, data)
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                with TELEGRAM_LATENCY.time(endpoint):
+                    return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                TELEGRAM_ERRORS.inc(endpoint)
+                if attempt == self.max_retries:
+                    raise
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                print(f"RetryAfter en {endpoint}: esperando {retry_after} s")
+                # Telegram pide parar: se detienen todos los envíos
+                self.paused_until = max(
+                    self.paused_until, time.monotonic() + retry_after
+                )
+                self.stats["retries"] += 1
+                await asyncio.sleep(retry_after)
+                # El reintento también pide turno, detrás de los que esperan
+                await self._throttle(endpoint, data)
+            except Exception:
+                TELEGRAM_ERRORS.inc(endpoint)
+                raise
@@ -0,0 +1,73 @@
+"""Procesado concurrente de actualizaciones con orden por usuario.
+
+Con el procesador por defecto de python-telegram-bot las actualizaciones se
+procesan de una en una: un /ranking lento retrasa los votos de todos los
+demás. SequentialUpdateProcessor procesa a la vez las de usuarios distintos,
+pero las de un mismo usuario (o chat, si no hay usuario) en orden de llegada y
+sin solaparse. Así las pulsaciones de next/prev/vote del carrusel no se
+adelantan unas a otras ni se pisan los cambios en su user_data.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Dict, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+def update_key(update: object) -> Optional[int]:
+    """Usuario (o chat) cuyas actualizaciones se procesan en orden"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class SequentialUpdateProcessor(BaseUpdateProcessor):
+    """Hasta `max_concurrent_updates` a la vez, en serie por usuario.
+
+    Cada usuario con actualizaciones en curso tiene un asyncio.Lock, que
+    despierta a los que esperan en orden de llegada. El lock se borra cuando
+    no queda ninguna actualización suya, así que solo hay tantos como
+    usuarios activos. Se espera el turno del usuario antes de ocupar uno de
+    los `max_concurrent_updates` huecos: un usuario que pulsa muy deprisa
+    ocupa como mucho uno y no deja sin sitio a los demás.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._pending: Dict[int, int] = {}
+
+    # BaseUpdateProcessor lo marca como final porque toma el hueco antes de
+    # llamar a do_process_update; aquí hay que esperar al usuario primero
+    async def process_update(  # type: ignore[misc]
+        self, update: object, coroutine: Awaitable[Any]
+    ):
+        key = update_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._pending[key] = self._pending.get(key, 0) + 1
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            self._pending[key] -= 1
+            if not self._pending[key]:
+                del self._pending[key]
+                del self._locks[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
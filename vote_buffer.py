@@ -0,0 +1,235 @@
+import asyncio
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Set, Tuple
+
+from controllers import AsyncChristmasDB, VoteResult
+from vote_journal import VoteJournal
+
+
+class VoteBuffer:
+    """Cola de votos en memoria que se vuelca a la BD por lotes.
+
+    Los votos se aceptan al momento comprobando en memoria los autovotos y los
+    duplicados, y se escriben en la tabla votes cada `flush_interval` segundos
+    o cuando se acumulan `max_batch` votos, en una única transacción.
+
+    Con `journal`, cada voto aceptado se escribe antes en el diario en disco,
+    de modo que una caída no pierde los pendientes: recover() los reaplica a
+    la BD al arrancar.
+
+    Las lecturas que dependen de los votos (carrusel, ranking y /mis_stats)
+    pasan también por aquí para sumar los votos que aún no están en la BD. El
+    puesto de /mis_stats y /ranking <página> se actualizan al volcar.
+    """
+
+    def __init__(
+        self,
+        db: AsyncChristmasDB,
+        flush_interval: float = 0.5,
+        max_batch: int = 200,
+        journal: VoteJournal | None = None,
+    ):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.journal = journal
+        # Segmentos del diario cuyos votos están en `pending` o ya en la BD
+        self._closed_segments: List[Path] = []
+
+        self.pending: List[Tuple[int, str, int]] = []
+        # (telegram_id, gif_id) ya votados, en la BD o pendientes
+        self.voted: Set[Tuple[int, int]] = set()
+        self.loaded_voters: Set[int] = set()
+        # gif_id -> telegram_id del autor (None si no existe)
+        self.gif_owners: Dict[int, int | None] = {}
+        # Votos aceptados que aún no se han confirmado en la BD (pendientes o
+        # en un volcado en curso), por votante y por GIF
+        self.unsaved_by_voter: Dict[int, Set[int]] = {}
+        self.unsaved_by_gif: Counter[int] = Counter()
+
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    # --------------------
+    # VOTOS
+    # --------------------
+    async def vote_gif(
+        self, telegram_id: int, username: str, gif_id: int
+    ) -> VoteResult:
+        """Acepta un voto sin esperar a que se escriba en la BD"""
+        if gif_id not in self.gif_owners:
+            self.gif_owners[gif_id] = await self.db.get_gif_owner(gif_id)
+        owner = self.gif_owners[gif_id]
+
+        # ❌ El GIF no existe
+        if owner is None:
+            # No se cachea: puede ser un GIF recién enviado
+            del self.gif_owners[gif_id]
+            return VoteResult.MISSING_GIF
+
+        # ❌ No votarte a ti mismo
+        if owner == telegram_id:
+            return VoteResult.OWN_GIF
+
+        # Cargar una vez los votos que el usuario ya tiene en la BD
+        if telegram_id not in self.loaded_voters:
+            voted = await self.db.get_voted_gif_ids(telegram_id)
+            self.voted.update((telegram_id, voted_id) for voted_id in voted)
+            self.loaded_voters.add(telegram_id)
+
+        # ❌ No votar dos veces el mismo GIF
+        if (telegram_id, gif_id) in self.voted:
+            return VoteResult.DUPLICATE
+
+        self.voted.add((telegram_id, gif_id))
+        self.unsaved_by_voter.setdefault(telegram_id, set()).add(gif_id)
+        self.unsaved_by_gif[gif_id] += 1
+        # En `pending` antes de escribirlo en el diario: un segmento cerrado
+        # por flush() solo contiene votos que ese volcado ya incluye
+        self.pending.append((telegram_id, username, gif_id))
+        if len(self.pending) >= self.max_batch:
+            self._wakeup.set()
+        if self.journal:
+            await self.journal.append(telegram_id, username, gif_id)
+        return VoteResult.OK
+
+    async def flush(self) -> int:
+        """Escribe en la BD todos los votos pendientes"""
+        if not self.pending:
+            return 0
+        if self.journal:
+            try:
+                self._closed_segments.append(await self.journal.rotate())
+            except OSError as e:
+                print(f"Error al cerrar el segmento del diario: {str(e)}")
+        batch, self.pending = self.pending, []
+        try:
+            inserted = await self.db.add_votes(batch)
+        except Exception as e:
+            print(f"Error al volcar {len(batch)} votos: {str(e)}")
+            # Reintentarlos en el siguiente volcado
+            self.pending[:0] = batch
+            return 0
+        # Ya están en la BD: sus segmentos sobran
+        VoteJournal.drop(self._closed_segments)
+        self._closed_segments.clear()
+        for telegram_id, _, gif_id in batch:
+            self._forget_unsaved(telegram_id, gif_id)
+        return inserted
+
+    def _forget_unsaved(self, telegram_id: int, gif_id: int):
+        gif_ids = self.unsaved_by_voter.get(telegram_id)
+        if gif_ids is not None:
+            gif_ids.discard(gif_id)
+            if not gif_ids:
+                del self.unsaved_by_voter[telegram_id]
+        self.unsaved_by_gif[gif_id] -= 1
+        if self.unsaved_by_gif[gif_id] <= 0:
+            del self.unsaved_by_gif[gif_id]
+
+    # --------------------
+    # LECTURAS
+    # --------------------
+    async def count_votable_gifs(self, telegram_id: int) -> int:
+        """Como en la BD, sin los GIFs con un voto pendiente del usuario"""
+        return await self.db.count_votable_gifs(
+            telegram_id, frozenset(self.unsaved_by_voter.get(telegram_id, ()))
+        )
+
+    async def get_votable_gifs_page(
+        self,
+        telegram_id: int,
+        after_id: int | None = None,
+        before_id: int | None = None,
+        limit: int = 10,
+    ) -> List[Tuple[int, str]]:
+        """Como en la BD, sin los GIFs con un voto pendiente del usuario"""
+        return await self.db.get_votable_gifs_page(
+            telegram_id,
+            after_id,
+            before_id,
+            limit,
+            frozenset(self.unsaved_by_voter.get(telegram_id, ())),
+        )
+
+    async def get_leaderboard(self, top: int = 10) -> List[Dict[str, Any]]:
+        """Ranking de la BD con los votos pendientes sumados.
+
+        Los votos pendientes solo suben puestos, así que basta el ranking de
+        la BD más los GIFs que tienen votos pendientes. Durante un volcado un
+        voto puede contarse dos veces hasta que termina.
+        """
+        unsaved = dict(self.unsaved_by_gif)
+        leaderboard = await self.db.get_leaderboard(top)
+        if not unsaved:
+            return leaderboard
+        listed = {entry["gif_id"] for entry in leaderboard}
+        missing = [gif_id for gif_id in unsaved if gif_id not in listed]
+        if missing:
+            leaderboard += await self.db.get_leaderboard_entries(missing)
+        for entry in leaderboard:
+            entry["votes"] += unsaved.get(entry["gif_id"], 0)
+        leaderboard.sort(key=lambda entry: (-entry["votes"], -entry["gif_id"]))
+        return leaderboard[:top]
+
+    async def get_user_info(self, telegram_id: int) -> Dict[str, Any]:
+        """get_user_info de la BD con los votos pendientes dados y recibidos"""
+        info = await self.db.get_user_info(telegram_id)
+        if info["exists"]:
+            info["votes_given"] += len(self.unsaved_by_voter.get(telegram_id, ()))
+            if info["has_gif"]:
+                info["votes_received"] += self.unsaved_by_gif.get(info["gif_id"], 0)
+        return info
+
+    async def recover(self, batch_size: int = 5000) -> int:
+        """Reaplica a la BD los votos del diario que no llegaron a volcarse.
+
+        add_votes descarta los repetidos, así que reaplicar un segmento que
+        sí se volcó no cambia nada. Devuelve cuántos votos se han insertado.
+        """
+        if not self.journal:
+            return 0
+        segments = self.journal.segments()
+        inserted = 0
+        batch = []
+        for vote in self.journal.replay(segments):
+            batch.append(vote)
+            if len(batch) >= batch_size:
+                inserted += await self.db.add_votes(batch)
+                batch = []
+        inserted += await self.db.add_votes(batch)
+        VoteJournal.drop(segments)
+        return inserted
+
+    # --------------------
+    # CICLO DE VIDA
+    # --------------------
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        """Arranca el volcado periódico en el event loop actual"""
+        if self._task is None:
+            if self.journal:
+                self.journal.open()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Detiene el volcado periódico y escribe los votos pendientes"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self.journal:
+            await self.journal.close()
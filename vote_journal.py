@@ -0,0 +1,140 @@
+"""Diario de votos en disco, solo de escritura al final.
+
+Con diario, un voto se da por registrado cuando su línea está en disco (tras
+el fsync), no cuando se escribe en la BD: escribir al final de un fichero es
+mucho más barato que una transacción. Los fsync se agrupan: los votos que
+llegan mientras se hace uno esperan juntos al siguiente.
+
+El diario se guarda en segmentos votes-<n>.jsonl, una línea JSON por voto:
+[timestamp, telegram_id, username, gif_id]. VoteBuffer vuelca los votos a la
+BD por lotes (la BD es la instantánea) y borra los segmentos ya volcados; al
+arrancar, los que queden se reaplican a la BD antes de aceptar votos.
+"""
+
+import asyncio
+import json
+import os
+import time
+from pathlib import Path
+from typing import Iterator, List, Optional, Set, Tuple
+
+SEGMENT_PREFIX = "votes-"
+
+
+class VoteJournal:
+    def __init__(self, directory: str | os.PathLike):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._file = None
+        self._segment: Optional[Path] = None
+        # Votos escritos que esperan al próximo fsync
+        self._waiters: List[asyncio.Future] = []
+        self._lock = asyncio.Lock()
+        self._tasks: Set[asyncio.Task] = set()
+
+    # --------------------
+    # SEGMENTOS
+    # --------------------
+    def segments(self) -> List[Path]:
+        """Segmentos en disco, del más antiguo al más reciente"""
+        return sorted(
+            self.directory.glob(f"{SEGMENT_PREFIX}*.jsonl"),
+            key=lambda path: int(path.stem[len(SEGMENT_PREFIX) :]),
+        )
+
+    def open(self):
+        """Empieza un segmento nuevo a continuación de los existentes"""
+        existing = self.segments()
+        number = int(existing[-1].stem[len(SEGMENT_PREFIX) :]) + 1 if existing else 1
+        self._segment = self.directory / f"{SEGMENT_PREFIX}{number}.jsonl"
+        self._file = open(self._segment, "ab")
+
+    def replay(self, segments: List[Path]) -> Iterator[Tuple[int, str, int]]:
+        """Votos (telegram_id, username, gif_id) de los segmentos, en orden"""
+        for segment in segments:
+            with open(segment, "rb") as f:
+                for line in f:
+                    try:
+                        _, telegram_id, username, gif_id = json.loads(line)
+                    except ValueError:
+                        # Última línea a medias de una caída: nunca se confirmó
+                        print(f"Línea incompleta en {segment.name}, se descarta")
+                        continue
+                    yield telegram_id, username, gif_id
+
+    @staticmethod
+    def drop(segments: List[Path]):
+        """Borra segmentos ya volcados a la BD"""
+        for segment in segments:
+            segment.unlink(missing_ok=True)
+
+    # --------------------
+    # ESCRITURA
+    # --------------------
+    async def append(self, telegram_id: int, username: str, gif_id: int):
+        """Escribe un voto y espera a que esté en disco"""
+        record = [round(time.time(), 3), telegram_id, username, gif_id]
+        self._file.write(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        if len(self._waiters) == 1:
+            # El primero de un grupo lanza el fsync; el resto se suma
+            task = asyncio.create_task(self.sync())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        await waiter
+
+    @staticmethod
+    def _fsync(file):
+        file.flush()
+        os.fsync(file.fileno())
+
+    async def _confirm(self, waiters: List[asyncio.Future], file):
+        """fsync de `file` y respuesta a los votos escritos en él"""
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._fsync, file)
+        except OSError as e:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+            raise
+        for waiter in waiters:
+            # Un handler cancelado ya no espera la respuesta
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def sync(self):
+        """Lleva a disco lo escrito y confirma a los votos que esperaban"""
+        async with self._lock:
+            # Los que lleguen durante el fsync esperan al siguiente
+            waiters, self._waiters = self._waiters, []
+            if waiters:
+                try:
+                    await self._confirm(waiters, self._file)
+                except OSError as e:
+                    print(f"Error al escribir el diario de votos: {str(e)}")
+
+    async def rotate(self) -> Path:
+        """Cierra el segmento actual, ya en disco, y abre el siguiente.
+
+        Devuelve el segmento cerrado: se puede borrar cuando sus votos
+        estén en la BD.
+        """
+        async with self._lock:
+            old_file, closed = self._file, self._segment
+            waiters, self._waiters = self._waiters, []
+            # Sin await hasta aquí: lo que se escriba a partir de ahora va al
+            # segmento nuevo
+            self.open()
+            try:
+                await self._confirm(waiters, old_file)
+            finally:
+                old_file.close()
+            return closed
+
+    async def close(self):
+        if self._file is not None:
+            await self.sync()
+            self._file.close()
+            self._file = None
@@ -0,0 +1,193 @@
+"""Servidor del webhook de Telegram con la ruta /metrics.
+
+Sustituye a Application.run_webhook: recibe las actualizaciones en la ruta
+del webhook y las pone en la cola de la aplicación, y sirve las métricas en
+formato de Prometheus en el mismo puerto.
+
+Con run_queue_webhook las actualizaciones se guardan en una WorkQueue para
+que las procesen los workers en otros procesos.
+"""
+
+import asyncio
+import json
+import signal
+from http import HTTPStatus
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+from telegram import Bot, Update
+from telegram.ext import Application
+
+import metrics
+from work_queue import WorkQueue
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+    """Comprueba el token secreto y lee el JSON que envía Telegram"""
+
+    def initialize(self, secret_token: str):
+        self.secret_token = secret_token
+
+    def read_update(self) -> dict:
+        if self.request.headers.get(SECRET_HEADER) != self.secret_token:
+            raise tornado.web.HTTPError(HTTPStatus.FORBIDDEN)
+        try:
+            return json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(HTTPStatus.BAD_REQUEST)
+
+
+class TelegramHandler(WebhookHandler):
+    """Pone las actualizaciones en la cola de la aplicación"""
+
+    def initialize(self, bot_app: Application, secret_token: str):
+        # `application` ya es el atributo de tornado con la app web
+        super().initialize(secret_token)
+        self.bot_app = bot_app
+
+    async def post(self):
+        update = Update.de_json(self.read_update(), self.bot_app.bot)
+        await self.bot_app.update_queue.put(update)
+        self.set_status(HTTPStatus.OK)
+
+
+class QueueHandler(WebhookHandler):
+    """Guarda las actualizaciones en la WorkQueue de los workers"""
+
+    def initialize(self, queue: WorkQueue, secret_token: str):
+        super().initialize(secret_token)
+        self.queue = queue
+
+    def post(self):
+        self.queue.put(self.read_update())
+        self.set_status(HTTPStatus.OK)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Sirve las métricas en formato de texto de Prometheus"""
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render())
+
+
+def make_app(
+    application: Application, secret_token: str, url_path: str = ""
+) -> tornado.web.Application:
+    return tornado.web.Application(
+        [
+            (r"/metrics", MetricsHandler),
+            (
+                rf"{url_path}/?",
+                TelegramHandler,
+                {"bot_app": application, "secret_token": secret_token},
+            ),
+        ]
+    )
+
+
+def make_queue_app(
+    queue: WorkQueue, secret_token: str, url_path: str = ""
+) -> tornado.web.Application:
+    return tornado.web.Application(
+        [
+            (r"/metrics", MetricsHandler),
+            (
+                rf"{url_path}/?",
+                QueueHandler,
+                {"queue": queue, "secret_token": secret_token},
+            ),
+        ]
+    )
+
+
+def _stop_event() -> asyncio.Event:
+    """Evento que se activa al recibir SIGINT o SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+
+async def serve(
+    application: Application,
+    listen: str,
+    port: int,
+    webhook_url: str,
+    secret_token: str,
+    url_path: str = "",
+):
+    """Arranca la aplicación y el servidor hasta recibir SIGINT o SIGTERM"""
+    stop = _stop_event()
+
+    # set_webhook solo necesita el bot (getMe): se registra mientras la
+    # aplicación carga la persistencia y ejecuta post_init, que esperan a la BD
+    await application.bot.initialize()
+    webhook = asyncio.create_task(
+        application.bot.set_webhook(
+            url=webhook_url + url_path,
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    )
+    try:
+        async with application:
+            if application.post_init:
+                await application.post_init(application)
+            await webhook
+            await application.start()
+
+            server = HTTPServer(make_app(application, secret_token, url_path))
+            server.listen(port, listen)
+            try:
+                await stop.wait()
+            finally:
+                server.stop()
+                await application.stop()
+                if application.post_stop:
+                    await application.post_stop(application)
+    finally:
+        # Si la aplicación no llega a arrancar
+        webhook.cancel()
+
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+async def serve_queue(
+    bot: Bot,
+    queue: WorkQueue,
+    listen: str,
+    port: int,
+    webhook_url: str,
+    secret_token: str,
+    url_path: str = "",
+):
+    """Registra el webhook y encola las actualizaciones hasta SIGINT o SIGTERM"""
+    stop = _stop_event()
+
+    async with bot:
+        await bot.set_webhook(
+            url=webhook_url + url_path,
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        server = HTTPServer(make_queue_app(queue, secret_token, url_path))
+        server.listen(port, listen)
+        try:
+            await stop.wait()
+        finally:
+            server.stop()
+
+
+def run_webhook(application: Application, **kwargs):
+    """Equivalente a Application.run_webhook con la ruta /metrics"""
+    asyncio.run(serve(application, **kwargs))
+
+
+def run_queue_webhook(bot: Bot, queue: WorkQueue, **kwargs):
+    """Webhook que solo encola: las actualizaciones las procesan los workers"""
+    asyncio.run(serve_queue(bot, queue, **kwargs))
@@ -0,0 +1,260 @@
+"""Cola local de actualizaciones entre el webhook y los workers.
+
+El proceso del webhook guarda cada actualización en una tabla de SQLite y N
+procesos worker las consumen. Se reparten por usuario (shard = |user_id| % N),
+así que las de un mismo usuario las procesa siempre el mismo worker, que
+respeta su orden de llegada. Cada lote se borra después de procesarlo: si un worker
+muere a medias, WorkerSupervisor lo arranca de nuevo y vuelve a procesarlo.
+"""
+
+import asyncio
+import json
+import multiprocessing
+import signal
+import threading
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    Index,
+    Integer,
+    MetaData,
+    Table,
+    Text,
+    create_engine,
+    delete,
+    func,
+    insert,
+    select,
+    update,
+)
+from telegram import Update
+from telegram.ext import Application
+
+from controllers import SQLITE_PROFILES, apply_pragmas
+
+updates = Table(
+    "updates",
+    MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("shard", Integer, nullable=False),
+    Column("user_key", BigInteger, nullable=False),
+    Column("payload", Text, nullable=False),
+    Index("ix_updates_shard_id", "shard", "id"),
+)
+
+
+def shard_key(data: Dict[str, Any]) -> int:
+    """Usuario (o chat, si no hay usuario) al que pertenece una actualización"""
+    update = Update.de_json(data, None)
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return 0
+
+
+class WorkQueue:
+    """Tabla de actualizaciones pendientes repartidas en `shards` workers"""
+
+    def __init__(self, url: str = "sqlite:///queue.sqlite", shards: int = 1):
+        self.engine = create_engine(url, echo=False)
+        if self.engine.dialect.name == "sqlite":
+            apply_pragmas(self.engine, SQLITE_PROFILES["production"])
+        updates.metadata.create_all(self.engine)
+        self.shards = shards
+
+    def shard(self, user_key: int) -> int:
+        return abs(user_key) % self.shards
+
+    def reshard(self) -> int:
+        """Reparte las pendientes entre los workers actuales (si ha cambiado N)"""
+        with self.engine.begin() as connection:
+            return connection.execute(
+                update(updates).values(shard=func.abs(updates.c.user_key) % self.shards)
+            ).rowcount
+
+    def put(self, data: Dict[str, Any]):
+        """Encola una actualización en el shard de su usuario"""
+        user_key = shard_key(data)
+        with self.engine.begin() as connection:
+            connection.execute(
+                insert(updates).values(
+                    shard=self.shard(user_key),
+                    user_key=user_key,
+                    payload=json.dumps(data),
+                )
+            )
+
+    def get(self, shard: int, limit: int = 100) -> List[Tuple[int, str]]:
+        """Las `limit` actualizaciones más antiguas de un shard"""
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                select(updates.c.id, updates.c.payload)
+                .where(updates.c.shard == shard)
+                .order_by(updates.c.id)
+                .limit(limit)
+            )
+            return [(row_id, payload) for row_id, payload in rows]
+
+    def ack(self, ids: List[int]):
+        """Borra las actualizaciones ya procesadas"""
+        with self.engine.begin() as connection:
+            connection.execute(delete(updates).where(updates.c.id.in_(ids)))
+
+    def depth(self) -> int:
+        """Actualizaciones pendientes en todos los shards"""
+        with self.engine.connect() as connection:
+            return connection.execute(select(func.count(updates.c.id))).scalar()
+
+
+# ------------------ Worker ------------------
+
+
+async def consume(
+    application: Application,
+    queue: WorkQueue,
+    shard: int,
+    poll_interval: float = 0.05,
+    drain: bool = False,
+):
+    """Procesa las actualizaciones de un shard hasta recibir SIGINT o SIGTERM.
+
+    Con `drain` termina en cuanto el shard se queda vacío.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        try:
+            while not stop.is_set():
+                batch = await loop.run_in_executor(None, queue.get, shard)
+                if not batch:
+                    if drain:
+                        break
+                    try:
+                        await asyncio.wait_for(stop.wait(), poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                # Por el procesador de la aplicación, como las de su cola: las
+                # de un mismo usuario en orden y las de distintos a la vez
+                updates = [
+                    Update.de_json(json.loads(payload), application.bot)
+                    for _, payload in batch
+                ]
+                await asyncio.gather(
+                    *(
+                        application.update_processor.process_update(
+                            update, application.process_update(update)
+                        )
+                        for update in updates
+                    )
+                )
+                await loop.run_in_executor(
+                    None, queue.ack, [row_id for row_id, _ in batch]
+                )
+        finally:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+def run_worker(application: Application, queue: WorkQueue, shard: int, **kwargs):
+    """Bucle de un proceso worker"""
+    asyncio.run(consume(application, queue, shard, **kwargs))
+
+
+class WorkerSupervisor:
+    """Un proceso worker por shard, que se arranca de nuevo si termina.
+
+    Una excepción que se escapa de consume (la BD bloqueada, un error de la
+    cola) termina el proceso: sin nadie que lo arranque, su shard crecería para
+    siempre mientras el webhook sigue respondiendo 200. Un hilo del proceso
+    del webhook comprueba cada `check_interval` segundos qué procesos siguen
+    vivos. Si uno muere poco después de arrancar, la espera antes del
+    siguiente intento se dobla, hasta `max_delay`.
+    """
+
+    def __init__(
+        self,
+        target: Callable[[int], None],
+        shards: int,
+        check_interval: float = 1.0,
+        max_delay: float = 60.0,
+    ):
+        self.target = target
+        self.shards = shards
+        self.check_interval = check_interval
+        self.max_delay = max_delay
+        self.restarts = 0
+        # spawn: el proceso del webhook tiene hilos y un event loop en marcha
+        self._context = multiprocessing.get_context("spawn")
+        self._processes: List[multiprocessing.Process] = []
+        self._started_at: List[float] = []
+        self._delays = [0.0] * shards
+        self._restart_at: List[float | None] = [None] * shards
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._watch, name="worker-supervisor", daemon=True
+        )
+
+    def _spawn(self, shard: int) -> multiprocessing.Process:
+        process = self._context.Process(
+            target=self.target, args=(shard,), name=f"worker-{shard}"
+        )
+        process.start()
+        return process
+
+    def start(self):
+        self._processes = [self._spawn(shard) for shard in range(self.shards)]
+        self._started_at = [time.monotonic()] * self.shards
+        self._thread.start()
+
+    def _watch(self):
+        while not self._stop.wait(self.check_interval):
+            for shard, process in enumerate(self._processes):
+                if process.is_alive():
+                    continue
+                now = time.monotonic()
+                if self._restart_at[shard] is None:
+                    process.join()
+                    if now - self._started_at[shard] > self.max_delay:
+                        # Llevaba tiempo funcionando: no es un fallo al arrancar
+                        self._delays[shard] = 0
+                    delay = min(max(self._delays[shard] * 2, 1.0), self.max_delay)
+                    self._delays[shard] = delay
+                    self._restart_at[shard] = now + delay
+                    print(
+                        f"El worker {shard} ha terminado (código {process.exitcode});"
+                        f" se arranca de nuevo en {delay:.0f} s"
+                    )
+                if now >= self._restart_at[shard]:
+                    self._processes[shard] = self._spawn(shard)
+                    self._started_at[shard] = now
+                    self._restart_at[shard] = None
+                    self.restarts += 1
+
+    def alive(self) -> int:
+        """Workers en marcha"""
+        return sum(process.is_alive() for process in self._processes)
+
+    def stop(self):
+        """Para la vigilancia y los workers (SIGTERM: terminan el lote actual)"""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            process.join()